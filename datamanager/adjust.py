@@ -4,8 +4,14 @@ Created on Thu Jun 04 21:06:13 2015
 @author: Niel
 """
 
+import datetime as dt
+import numpy as np
 import pandas as pd
 from datamanager.load import empty_dataframe
+from datamanager.profiling import instrument
+
+# dividend adjustments are only applied from this date onwards
+ADJUSTMENT_START = dt.date(2000, 1, 1)
 
 def __backwards_calc__(multiplier):
     '''
@@ -45,33 +51,122 @@ def calc_dividend_multiplier(div, close):
     mult = (1-(div/close)).dropna()
     return __backwards_calc__(mult)
 
+def calc_dividend_multipliers(close, divs, equities, startdate = ADJUSTMENT_START, enddate = None):
+    '''
+    Calculate the backwards dividend multiplier matrix for all tickers in one vectorized pass
+
+    The multiplier on a date is the product of (1 - div/close) of all the dividends going ex on or after that date,
+    i.e. a reversed cumulative product down the dates axis of the per dividend multipliers.
+
+    Parameters
+    ----------
+    close : pandas.DataFrame
+        The closing prices (dates x tickers)
+
+    divs : pandas.DataFrame
+        The dividends on the ex dates (dates x tickers)
+
+    equities : list
+        The tickers to calculate the multipliers for
+
+    startdate : date
+        The first date of the multiplier matrix
+
+    enddate : date
+        The last date of the multiplier matrix
+
+    Return
+    ------
+    divm : pandas.DataFrame
+        The dividend multipliers on the business day grid from startdate to enddate
+    '''
+
+    equities = list(equities)
+    divs = divs.sort_index().reindex(columns = equities)
+    close = close.reindex(index = divs.index, columns = equities)
+
+    # multiplier for each dividend payment, 1 where there is no dividend (or no close to relate it to)
+    # in float64 whatever the dtype of the fields, the multipliers are compounded over the full history
+    mult = 1 - divs.values.astype(float) / close.values.astype(float)
+    mult[np.isnan(mult)] = 1
+
+    # backwards calculate from newest to oldest
+    bmult = np.cumprod(mult[::-1], axis = 0)[::-1]
+    bmult = pd.DataFrame(bmult, index = divs.index, columns = equities)
+
+    # expand to the business day grid, after the last dividend the multiplier is 1
+    grid = empty_dataframe(equities, startdate, enddate = enddate)
+    divm = bmult.reindex(grid.index, method = 'bfill')
+    return divm.fillna(1)
+
+def adjust_prices(prices, divm):
+    '''
+    Apply a dividend multiplier matrix to several price fields at once
+
+    Parameters
+    ----------
+    prices : dict
+        The price fields (name -> dates x tickers DataFrame) to adjust
+
+    divm : pandas.DataFrame
+        The dividend multipliers as calculated by calc_dividend_multipliers
+
+    Return
+    ------
+    adjusted : dict
+        The adjusted price fields with the same keys as prices
+    '''
+
+    fields = list(prices.keys())
+    if len(fields) == 0:
+        return {}
+
+    # align all fields on a common grid so that the multiplier is broadcast over all of them in one go
+    index = divm.index
+    columns = divm.columns
+    for f in fields:
+        index = index.union(prices[f].index)
+        columns = columns.union(prices[f].columns)
+
+    stacked = np.stack([prices[f].reindex(index = index, columns = columns).values for f in fields])
+    mult = divm.reindex(index = index, columns = columns).values
+    adjusted = stacked * mult[np.newaxis, :, :]
+
+    return dict((f, pd.DataFrame(adjusted[i], index = index, columns = columns)) for i, f in enumerate(fields))
+
+def calc_adjusted_prices(prices, divs, equities, enddate = None):
+    '''
+    Calculate the dividend adjusted version of several price fields, computing the dividend multipliers only once
+
+    Parameters
+    ----------
+    prices : dict
+        The price fields to adjust, must contain 'Close' that the dividends are related to
+
+    divs : pandas.DataFrame
+        The dividends on the ex dates
+
+    equities : list
+        The tickers to adjust
+
+    Return
+    ------
+    adjusted : dict
+        The adjusted price fields with the same keys as prices
+    '''
+
+    divm = calc_dividend_multipliers(prices['Close'], divs, equities, enddate = enddate)
+    return adjust_prices(prices, divm)
+
 def calc_adj_close(close, divs, equities, enddate = None):
     '''
     Calculate the adjusted close
     '''
 
-    # fillna with pad.
-    divmult = empty_dataframe(equities, enddate=enddate)
-    for ticker in divs.columns:
-        # get the dividends and close of a single ticker and drop all NaN values
-        tmp_div = divs[ticker].dropna()
-        tmp_close = close[ticker].dropna()
-        
-        # now calculate the dividend multiplier for each ticker
-        tmp_mult = calc_dividend_multiplier(tmp_div, tmp_close)
-        divmult[ticker] = tmp_mult
-
-    # get the new index 
-    startdate = pd.datetime(2000, 1, 1).date()
-    divm = empty_dataframe(equities, startdate, enddate=enddate)
-
-    # update the blank dataframe - expand to the actual index
-    divm.update(divmult) 
-    # fillna with pad
-    divm = divm.bfill()
-    divm = divm.fillna(1)
+    divm = calc_dividend_multipliers(close, divs, equities, enddate = enddate)
     adj_close = close * divm
 
-    # Save to file
     return adj_close
-    
+
+# wrap the public functions when profiling is enabled, see datamanager.profiling
+instrument(globals(), __name__)
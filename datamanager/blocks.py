@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Ticker block (out-of-core) execution of the column independent transforms
+
+Transforms like the dividend adjustment, the book-to-market ratio, the PEAD momentum and the merge calculate every
+ticker on its own, but need several full dates x tickers matrices and their intermediate copies in memory. In block
+mode the tickers are split in blocks that fit in a memory ceiling, every block is read from the store (only its
+columns are parsed), processed, and written to a part file. The part files of each output are joined line by line
+into the output file, so no more than a few blocks are ever in memory.
+'''
+
+from os import path, remove
+from concurrent.futures import ThreadPoolExecutor
+from datamanager.envs import MEMORY_LIMIT, BLOCK_WORKERS
+from datamanager.load import _read_field
+from datamanager.storage import atomic_write
+
+# the number of copies of every input and output a transform holds at the same time, e.g. the data, an aligned copy
+# and an intermediate result
+COPIES = 3
+
+def block_size(nrows, nframes, memory_limit = MEMORY_LIMIT, workers = BLOCK_WORKERS, itemsize = 8, copies = COPIES):
+    '''
+    The number of tickers per block so that the blocks processed in parallel fit in the memory ceiling
+
+    Parameters
+    ----------
+    nrows : int
+        The number of dates
+
+    nframes : int
+        The number of inputs and outputs of the transform
+
+    memory_limit : int
+        The memory ceiling in megabytes
+
+    workers : int
+        The number of blocks processed in parallel
+    '''
+
+    per_ticker = nrows * nframes * itemsize * copies
+    return max(1, int(memory_limit * 1024 * 1024 // (max(1, workers) * max(1, per_ticker))))
+
+def ticker_blocks(tickers, size):
+    '''
+    Split the tickers in consecutive blocks of at most size tickers
+    '''
+
+    tickers = list(tickers)
+    return [tickers[i:i + size] for i in range(0, len(tickers), size)]
+
+def read_block(fpath, field, tickers):
+    '''
+    Read the columns of a block of tickers of a field from the store, in the dtype of the field
+    '''
+
+    return _read_field(fpath, field, tickers = tickers)
+
+def part_path(target, i):
+    return target + '.part' + str(i)
+
+def assemble(parts, target):
+    '''
+    Join the csv part files of the ticker blocks of an output column wise, line by line
+
+    The parts must have the same index (the first field of every line) in the same order.
+    '''
+
+    files = [open(p, 'r') for p in parts]
+    try:
+        with atomic_write(target) as out:
+            for lines in zip(*files):
+                first = lines[0].rstrip('\n')
+                key = first.split(',', 1)[0]
+
+                row = [first]
+                for line in lines[1:]:
+                    k, values = line.rstrip('\n').split(',', 1)
+                    if k != key:
+                        raise ValueError('The blocks of ' + target + ' have different indices: ' + key + ', ' + k)
+                    row.append(values)
+
+                out.write(','.join(row) + '\n')
+
+            if any(f.readline() for f in files):
+                raise ValueError('The blocks of ' + target + ' have a different number of rows')
+    finally:
+        for f in files:
+            f.close()
+
+    for p in parts:
+        remove(p)
+
+def run_blocks(func, inputs, targets, tickers, nrows, memory_limit = MEMORY_LIMIT, workers = BLOCK_WORKERS):
+    '''
+    Run a column independent transform block by block of tickers
+
+    Parameters
+    ----------
+    func : function
+        func(data, tickers) is called for every block, with data a dict of the input name -> block of the input
+        (dates x tickers), and returns a dict of the target -> block of the output
+
+    inputs : dict
+        The input name -> (path, field) of the inputs in the store
+
+    targets : list
+        The output files
+
+    tickers : list
+        All the tickers, the outputs have their columns in this order
+
+    nrows : int
+        The (approximate) number of dates, used to size the blocks
+
+    memory_limit : int
+        The memory ceiling in megabytes
+
+    workers : int
+        The number of blocks read and processed in parallel
+    '''
+
+    size = block_size(nrows, len(inputs) + len(targets), memory_limit, workers)
+    blocks = ticker_blocks(tickers, size)
+
+    def process(i):
+        data = dict((name, read_block(inputs[name][0], inputs[name][1], blocks[i])) for name in inputs)
+        out = func(data, blocks[i])
+        for t in targets:
+            out[t].to_csv(part_path(t, i))
+
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+        list(pool.map(process, range(len(blocks))))
+
+    for t in targets:
+        assemble([part_path(t, i) for i in range(len(blocks))], t)
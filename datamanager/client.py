@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+Client of the local data server, see datamanager.server
+
+When DATAMANAGER_SERVER holds the address of a running data server, datamanager.load.load_field (and with it
+load_close, load_adj_close and the other load_* functions) requests its slices from the server instead of parsing
+the csv files, so research code moves to the server without changes.
+
+Every message is a frame of an 8 byte big-endian length followed by the payload. A request is a JSON frame, a
+response is a JSON header frame followed by an npy frame of the dates (int64 nanoseconds) and an npy frame of the
+values.
+'''
+
+import io
+from os import path
+import json
+import socket
+import struct
+import numpy as np
+import pandas as pd
+from datamanager.envs import DATA_SERVER
+from datamanager.dtypes import as_field_dtype
+
+_LENGTH = struct.Struct('>Q')
+
+def parse_address(address):
+    '''
+    A host:port address is a localhost TCP address, anything else is the path of a Unix socket
+    '''
+
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+
+    return socket.AF_UNIX, address
+
+def connect(address = DATA_SERVER):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(addr)
+    return sock
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        part = sock.recv(min(n - len(buf), 1 << 20))
+        if not part:
+            raise IOError('The data server closed the connection')
+        buf.extend(part)
+
+    return bytes(buf)
+
+def send_frame(sock, payload):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+def recv_frame(sock):
+    n = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))[0]
+    return _recv_exactly(sock, n)
+
+def to_npy(values):
+    buf = io.BytesIO()
+    np.save(buf, values, allow_pickle = False)
+    return buf.getvalue()
+
+def from_npy(payload):
+    return np.load(io.BytesIO(payload), allow_pickle = False)
+
+def fetch(fpath, field, tickers = None, start = None, end = None, address = DATA_SERVER):
+    '''
+    Request a slice of a field from the data server
+
+    Parameters
+    ----------
+    fpath : str
+        The directory of the field files, e.g. the master data
+
+    field : str
+        The name of the field
+
+    tickers : list
+        The tickers to return, all the tickers if None
+
+    start, end : str
+        The date range to return
+
+    address : str
+        The address of the server, a Unix socket path or host:port
+
+    Return
+    ------
+    data : pandas.DataFrame
+        The slice in the dtype of the field
+    '''
+
+    request = {'fpath': path.abspath(fpath), 'field': field,
+               'tickers': None if tickers is None else [str(t) for t in tickers],
+               'start': None if start is None else str(start),
+               'end': None if end is None else str(end)}
+
+    sock = connect(address)
+    try:
+        send_frame(sock, json.dumps(request).encode('utf-8'))
+        header = json.loads(recv_frame(sock).decode('utf-8'))
+        if 'error' in header:
+            raise IOError('The data server could not load ' + field + ': ' + header['error'])
+
+        index = from_npy(recv_frame(sock))
+        values = from_npy(recv_frame(sock))
+    finally:
+        sock.close()
+
+    data = pd.DataFrame(values, index = pd.DatetimeIndex(index.astype('datetime64[ns]'), name = header['index_name']),
+                        columns = header['columns'])
+
+    return as_field_dtype(data, field)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''
+Per field dtype policy of the market data
+
+Every field used to be held as float64. The policy below stores each field in the smallest type that keeps the
+precision the calculations need, and is applied when the data is converted, merged, written and loaded:
+
+=============================  ========  ===========================================================================
+field                          dtype     precision
+=============================  ========  ===========================================================================
+Close, High, Low, Open,        float32   7 significant digits, prices in whole cents are exact below 2**24 cents
+Last Bid, Last Offer, VWAP               (R167 772.16). Returns and adjustments are calculated in float64.
+DY, EY, PE, Market Cap,        float32   7 significant digits
+Book Value per Share, ratios
+Dividend Ex, Declaration and   float32   7 significant digits, the dividend multipliers are calculated in float64
+Payment Date (amounts)
+Volume, Total Number Of        Int64     exact
+Shares
+Number Of Trades               Int32     exact below 2**31
+everything else                float64   the default, e.g. the adjusted prices and the derived signals
+=============================  ========  ===========================================================================
+
+The integer fields use the pandas nullable integer types (pandas 0.24 or later), older versions of pandas keep them
+as float64, which is exact for integers below 2**53. A count field with non integral values is also kept as float64
+rather than being rounded.
+'''
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_DTYPE = 'float64'
+
+# nullable integer dtypes need pandas 0.24 or later
+NULLABLE_INTEGERS = hasattr(pd, 'Int64Dtype')
+INTEGER_DTYPES = ['Int32', 'Int64']
+
+FIELD_DTYPES = {'Close': 'float32',
+                'High': 'float32',
+                'Low': 'float32',
+                'Open': 'float32',
+                'Last Bid': 'float32',
+                'Last Offer': 'float32',
+                'VWAP': 'float32',
+                'DY': 'float32',
+                'EY': 'float32',
+                'PE': 'float32',
+                'Market Cap': 'float32',
+                'Book Value per Share': 'float32',
+                'Book-to-Market': 'float32',
+                'Earnings-to-Price': 'float32',
+                'Dividend Ex Date': 'float32',
+                'Dividend Declaration Date': 'float32',
+                'Dividend Payment Date': 'float32',
+                'Volume': 'Int64',
+                'Total Number Of Shares': 'Int64',
+                'Number Of Trades': 'Int32'}
+
+def field_dtype(field):
+    '''
+    The dtype a field is held in, see FIELD_DTYPES
+    '''
+
+    dtype = FIELD_DTYPES.get(field, DEFAULT_DTYPE)
+    if dtype in INTEGER_DTYPES and not NULLABLE_INTEGERS:
+        return DEFAULT_DTYPE
+
+    return dtype
+
+def grid_dtype(field):
+    '''
+    The numpy dtype of the dense grid a field is merged on, the integer fields are merged as float64 and converted
+    to their nullable integer type afterwards
+    '''
+
+    dtype = field_dtype(field)
+    if dtype in INTEGER_DTYPES:
+        return DEFAULT_DTYPE
+
+    return dtype
+
+def as_field_dtype(data, field):
+    '''
+    Convert a dates x tickers DataFrame of a field to the dtype of the field
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The data of the field
+
+    field : str
+        The name of the field
+
+    Return
+    ------
+    data : pandas.DataFrame
+    '''
+
+    dtype = field_dtype(field)
+
+    if dtype in INTEGER_DTYPES:
+        values = data.astype(DEFAULT_DTYPE).values
+        integral = np.isnan(values) | (values == np.round(values))
+        if not integral.all():
+            return data.astype(DEFAULT_DTYPE)
+
+    return data.astype(dtype)
+
+def memory_usage(data):
+    '''
+    The number of bytes held by a DataFrame or a dict of DataFrames, excluding the index
+    '''
+
+    if isinstance(data, dict):
+        return sum(memory_usage(data[k]) for k in data)
+
+    return int(data.memory_usage(index = False).sum())
@@ -4,7 +4,7 @@ Created on Tue May 19 20:17:57 2015
 
 @author: Niel
 """
-from os import path
+from os import path, environ
 
 dir = path.dirname(__file__)
 DATA_ROOT = path.join(dir , '..')
@@ -12,3 +12,27 @@ DL_PATH = path.join(DATA_ROOT, 'downloads')
 MASTER_DATA_PATH = path.join(DATA_ROOT, 'master')    
 CONVERT_PATH = path.join(DATA_ROOT, 'converted')
 MERGED_PATH = path.join(DATA_ROOT, 'merged')
+SNAPSHOT_PATH = path.join(DATA_ROOT, 'snapshots')
+PROVISIONAL_PATH = path.join(DATA_ROOT, 'provisional')
+
+# the cache of the header-only schemas of the data files, see datamanager.schema
+SCHEMA_CACHE = path.join(DATA_ROOT, 'schema.json')
+
+# rows per chunk when the time local transforms run in streaming mode, 0 loads the full history in memory
+STREAM_CHUNKSIZE = int(environ.get('DATAMANAGER_STREAM_CHUNKSIZE', '0'))
+
+# memory ceiling in megabytes of the ticker block (out-of-core) mode of the column independent transforms and the
+# number of blocks processed in parallel, a ceiling of 0 loads all the tickers in memory
+MEMORY_LIMIT = int(environ.get('DATAMANAGER_MEMORY_LIMIT', '0'))
+BLOCK_WORKERS = int(environ.get('DATAMANAGER_BLOCK_WORKERS', '2'))
+
+
+# the address of the local data server, a Unix socket path or host:port, the load functions read from the files when
+# it is empty, and the memory budget in megabytes of the slice cache of the server
+DATA_SERVER = environ.get('DATAMANAGER_SERVER', '')
+SERVER_CACHE_LIMIT = int(environ.get('DATAMANAGER_SERVER_CACHE', '1024'))
+
+# profiling of the public functions of load, transforms and adjust: 1 to enable, memory to also record the peak memory,
+# and the path prefix the profiles are written to when the process exits, see datamanager.profiling
+PROFILE = environ.get('DATAMANAGER_PROFILE', '')
+PROFILE_OUTPUT = environ.get('DATAMANAGER_PROFILE_OUTPUT', '')
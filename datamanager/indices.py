@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''
+Construction of custom equity indices from the merged market data
+
+An index is defined by a membership mask (dates x tickers) and a weighting scheme. The constituents and their
+weights are fixed on the rebalance dates and drift with the prices in between, so the index level on a date is
+the level on the previous rebalance date times the weighted price growth since then. All the indices are
+calculated together as batched matrix operations over an (indices x dates x tickers) array.
+'''
+
+import numpy as np
+import pandas as pd
+
+# industries that are excluded from the ex resources index
+RESOURCE_INDUSTRIES = ['Basic Materials', 'Oil & Gas']
+
+def rebalance_positions(index, freq = 'M'):
+    '''
+    The row positions of the rebalance dates: the first date and the last trading day of every period
+
+    Parameters
+    ----------
+    index : pandas.DatetimeIndex
+        The trading days
+
+    freq : str
+        The rebalance frequency, 'D' (daily), 'M' (monthly) or 'Q' (quarterly)
+    '''
+
+    if freq == 'D':
+        return np.arange(len(index))
+
+    periods = pd.DatetimeIndex(index).to_period(freq)
+    last = np.asarray(periods[1:] != periods[:-1])
+
+    return np.concatenate([[0], np.nonzero(last)[0]])
+
+def _weights(masks, caps, prices, anchors, scheme):
+    '''
+    The normalised constituent weights of every index on every rebalance date - (indices x rebalances x tickers)
+    '''
+
+    members = masks[:, anchors, :] & np.isfinite(prices[anchors])[np.newaxis, :, :]
+
+    if scheme == 'cap':
+        cap = np.nan_to_num(caps[anchors])
+        cap[cap < 0] = 0
+        w = members * cap[np.newaxis, :, :]
+    elif scheme == 'equal':
+        w = members.astype(float)
+    else:
+        raise ValueError('Unknown weighting scheme: ' + str(scheme))
+
+    total = w.sum(axis = 2)
+    empty = total == 0
+    total[empty] = 1
+
+    return w / total[:, :, np.newaxis], empty
+
+def _levels(w, empty, prices, anchors, base):
+    '''
+    Chain the weighted price growth between rebalance dates to index levels - (indices x dates)
+    '''
+
+    T = prices.shape[0]
+
+    # the rebalance in force on each date is the last one strictly before it
+    j = np.searchsorted(anchors, np.arange(T), side = 'left') - 1
+    j[0] = 0
+
+    growth = prices / prices[anchors[j]]
+    growth[~np.isfinite(growth)] = 0
+
+    # one index at a time, so only one dates x tickers copy of the weights is held on top of the weights
+    ratio = np.empty((w.shape[0], T))
+    wk = np.empty((T, w.shape[2]))
+    for k in range(w.shape[0]):
+        np.take(w[k], j, axis = 0, out = wk)
+        ratio[k] = np.einsum('tn,tn->t', wk, growth)
+    ratio[empty[:, j]] = 1
+    ratio[:, 0] = 1
+
+    # level on every rebalance date, then on every date relative to the previous rebalance
+    at_anchor = base * np.cumprod(ratio[:, anchors], axis = 1)
+    levels = at_anchor[:, j] * ratio
+    levels[:, 0] = base
+
+    return levels
+
+def build_indices(masks, close, adj_close = None, caps = None, scheme = 'cap', freq = 'M', base = 100.0):
+    '''
+    Calculate the daily price and total return levels of several custom indices at once
+
+    Parameters
+    ----------
+    masks : dict
+        The index name -> boolean membership mask (dates x tickers)
+
+    close : pandas.DataFrame
+        The closing prices, used for the price index levels
+
+    adj_close : pandas.DataFrame
+        The dividend adjusted closing prices, used for the total return levels (optional)
+
+    caps : pandas.DataFrame
+        The market capitalisation, required by the 'cap' weighting scheme
+
+    scheme : str
+        'cap' for market capitalisation weights or 'equal' for equal weights
+
+    freq : str
+        The rebalance frequency, see rebalance_positions
+
+    base : float
+        The index level on the first date
+
+    Returns
+    -------
+    levels, tr_levels : pandas.DataFrame
+        The price and total return index levels (dates x indices), tr_levels is None without adj_close
+    '''
+
+    names = list(masks.keys())
+    dates = close.index
+    tickers = close.columns
+
+    stacked = np.stack([masks[n].reindex(index = dates, columns = tickers).fillna(False).values.astype(bool) for n in names])
+    prices = close.ffill().values
+    cap = caps.reindex(index = dates, columns = tickers).ffill().values if caps is not None else None
+
+    anchors = rebalance_positions(dates, freq)
+    w, empty = _weights(stacked, cap, prices, anchors, scheme)
+
+    levels = pd.DataFrame(_levels(w, empty, prices, anchors, base).T, index = dates, columns = names)
+
+    tr_levels = None
+    if adj_close is not None:
+        # the total return index holds the same constituents and weights
+        tr_prices = adj_close.reindex(index = dates, columns = tickers).ffill().values
+        tr_prices = np.where(np.isfinite(tr_prices), tr_prices, prices)
+        tr_levels = pd.DataFrame(_levels(w, empty, tr_prices, anchors, base).T, index = dates, columns = names)
+
+    return levels, tr_levels
+
+def _restrict(mask, columns):
+    '''
+    Restrict a membership mask to a boolean selection of its columns
+    '''
+
+    restricted = mask.copy()
+    restricted.loc[:, ~columns] = False
+    return restricted
+
+def default_memberships(caps, universe = None, refdata = None):
+    '''
+    Membership masks of the standard set of custom indices: the all share, size buckets by market capitalisation,
+    ex resources and one index per industry
+
+    Parameters
+    ----------
+    caps : pandas.DataFrame
+        The market capitalisation (dates x tickers)
+
+    universe : pandas.DataFrame
+        Boolean point-in-time universe mask (dates x tickers), see ListingIndex.mask (optional)
+
+    refdata : pandas.DataFrame
+        Equity reference data indexed by ticker with an industry column (optional)
+
+    Returns
+    -------
+    masks : dict
+        The index name -> boolean membership mask
+    '''
+
+    listed = caps.notnull() & (caps > 0)
+    if universe is not None:
+        listed = listed & universe.reindex(index = caps.index, columns = caps.columns).fillna(False).astype(bool)
+
+    size = caps.where(listed).rank(axis = 1, ascending = False)
+
+    masks = {'All Share': listed,
+             'Top 40': listed & (size <= 40),
+             'Mid Cap': listed & (size > 40) & (size <= 100),
+             'Small Cap': listed & (size > 100)}
+
+    if refdata is not None and 'industry' in refdata.columns:
+        industry = refdata['industry'].reindex(caps.columns)
+        masks['Ex Resources'] = _restrict(listed, ~industry.isin(RESOURCE_INDUSTRIES).values)
+
+        for ind in sorted(industry.dropna().unique()):
+            if ind == 'Unclassified':
+                continue
+            masks[ind] = _restrict(listed, (industry == ind).values)
+
+    return masks
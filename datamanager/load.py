@@ -8,9 +8,25 @@ Created on Tue Feb 10 09:38:31 2015
 import numpy as np
 import pandas as pd
 from os import path
-from datamanager.envs import MASTER_DATA_PATH
+from concurrent.futures import ThreadPoolExecutor
+from datamanager.envs import MASTER_DATA_PATH, DATA_SERVER
+from datamanager.universe import ListingIndex
+from datamanager.referencedata import ReferenceHistory
+from datamanager.steps import StepField, STEPS_EXT
+from datamanager.dtypes import field_dtype, grid_dtype, as_field_dtype
+import datamanager.snapshots as snapshots
+import datamanager.client as client
+import datamanager.schema as schema
+import datamanager.provisional as prov
+from datamanager.profiling import instrument
 from datetime import datetime as dt
 
+# the maximum number of field files that are read and parsed concurrently
+LOAD_WORKERS = 8
+
+# the number of cross-sections per block read by iter_cross_sections
+CROSS_SECTION_ROWS = 250
+
 def marketdata_fields():
     return ['Close',
             'High',
@@ -31,6 +47,29 @@ def marketdata_fields():
             'Dividend Payment Date'
         ]
 
+def price_fields():
+    '''
+    The price like market data fields that are adjusted for corporate actions
+    '''
+
+    return ['Close',
+            'High',
+            'Low',
+            'Open',
+            'Last Bid',
+            'Last Offer',
+            'VWAP'
+        ]
+
+def step_fields():
+    '''
+    The step-like market data fields that only change a few times a year and are merged as change points
+    '''
+
+    return ['Total Number Of Shares',
+            'Book Value per Share'
+        ]
+
 def equity_ref_fields():
     '''
     Should be based on the actual data
@@ -59,19 +98,25 @@ def equity_ref_fields():
 
 def get_equity_ref_fields_from_files(dirpath):
     '''
+    The fields of the reference data workbooks in a directory, read from the header rows only
     '''
 
+    return schema.reference_fields(dirpath)
+
 def get_marketdata_fields_from_files(dirpath):
     '''
+    The market data fields of the time series files in a directory, read from the header rows only. The known
+    fields come first in the order of marketdata_fields, followed by any new fields.
     '''
 
+    found = schema.field_names(dirpath)
+    return [f for f in marketdata_fields() if f in found] + sorted(f for f in found if f not in marketdata_fields())
+
 
 
 def get_all_equities_from_data(all_path, new_path, field):
-    field_all = load_market_data(all_path, field)
-    all = list(field_all.columns)
-    field_current = load_market_data(new_path, field)
-    current = list(field_current.columns)
+    all = field_tickers(all_path, field)
+    current = field_tickers(new_path, field)
 
     return equities_from_data(current, all)
 
@@ -137,28 +182,136 @@ def load_ts(filepath):
     temp = pd.read_csv(filepath, header=0, index_col=0, parse_dates=True) 
     return temp
 
+def _fetch_fields(fpath, fields, tickers = None, start = None, end = None):
+    # the slices are requested from the local data server, see datamanager.server
+    return dict((f, client.fetch(fpath, f, tickers = tickers, start = start, end = end, address = DATA_SERVER))
+                for f in fields)
+
 def load_field_ts(fpath, field='Close', startdate='1990-01-01', enddate = None):
     '''
+    The field or fields are requested from the local data server when DATAMANAGER_SERVER is set
     '''
+
+    if DATA_SERVER:
+        data = _fetch_fields(fpath, field if type(field) == list else [field], start = startdate, end = enddate)
+        return data if type(field) == list else data[field]
     
     if type(field) == str:
-        temp = pd.read_csv(path.join(fpath, field + '.csv'), sep=',', header=0, 
-                        index_col=0, parse_dates=True)
+        temp = _read_field(fpath, field)
                         
         temp = temp.ix[startdate:enddate]                          
         data = temp
                         
     if type(field) == list:
-        data = {}
+        data = read_fields(fpath, field)
         for f in field:
-            temp = pd.read_csv(path.join(fpath, f + '.csv'), sep=',', header=0, 
-                        index_col=0, parse_dates=True)
-                        
-            temp = temp.ix[startdate:enddate]  
-            data[f] = temp
+            data[f] = data[f].ix[startdate:enddate]
     
     return data
 
+def field_file(fpath, field):
+    '''
+    The file a field is stored in, the change points file of a step-like field takes precedence over a csv file
+    '''
+
+    steps = path.join(fpath, field + STEPS_EXT)
+    if path.isfile(steps):
+        return steps
+
+    return path.join(fpath, field + '.csv')
+
+def field_tickers(fpath, field):
+    '''
+    The tickers of a field, read from the header of its file only
+    '''
+
+    filepath = field_file(fpath, field)
+    if filepath.endswith(STEPS_EXT):
+        with open(filepath, 'r') as f:
+            return f.readline().lstrip('#').rstrip('\n').split(',')[2:]
+
+    return list(pd.read_csv(filepath, sep=',', header=0, index_col=0, nrows=0).columns)
+
+def _read_field(fpath, field, parse_dates = True, tickers = None):
+    '''
+    Read the file of a field in the dtype of the field, see datamanager.dtypes. A step-like field stored as change
+    points is expanded to its dense grid. Only the columns of the tickers are parsed if tickers are given, tickers
+    that are not in the file are all NaN.
+    '''
+
+    if field_file(fpath, field).endswith(STEPS_EXT):
+        steps = load_step_field(fpath, field)
+        return as_field_dtype(steps.dense if tickers is None else steps.decode(tickers), field)
+
+    filepath = path.join(fpath, field + '.csv')
+    columns = pd.read_csv(filepath, sep=',', header=0, index_col=0, nrows=0).columns
+
+    usecols = None
+    if tickers is not None:
+        keep = set(tickers)
+        usecols = [0] + [i + 1 for i, c in enumerate(columns) if c in keep]
+        columns = [c for c in columns if c in keep]
+
+    # float fields are parsed straight to their dtype, integer fields are parsed as float64 and converted
+    dtype = grid_dtype(field)
+    data = pd.read_csv(filepath, sep=',', header=0, index_col=0, parse_dates=parse_dates, usecols=usecols,
+                       dtype=dict((c, dtype) for c in columns))
+
+    if tickers is not None:
+        data = data.reindex(columns = tickers)
+
+    return as_field_dtype(data, field)
+
+def _read_raw_field(fpath, field):
+    return _read_field(fpath, field, parse_dates = False)
+
+def _share_date_index(data):
+    '''
+    Parse the date index of the fields, the dates of fields with identical date columns are parsed only once
+    and the resulting DatetimeIndex is shared between them
+    '''
+
+    parsed = []
+    for f in data:
+        raw = data[f].index.values
+        for known, ix in parsed:
+            if len(known) == len(raw) and (known == raw).all():
+                data[f].index = ix
+                break
+        else:
+            ix = pd.DatetimeIndex(pd.to_datetime(raw))
+            parsed.append((raw, ix))
+            data[f].index = ix
+
+    return data
+
+def read_fields(fpath, fields, workers = LOAD_WORKERS):
+    '''
+    Read several field files concurrently with a bounded thread pool
+
+    Parameters
+    ----------
+    fpath : str
+        the path of the files to load excluding the filenames
+
+    fields : list
+        the names and filenames of the fields to load
+
+    workers : int
+        the maximum number of files read at the same time
+
+    Return
+    --------
+    data : dict
+        The field name -> pandas.DataFrame with a time series index and the tickers as column headers
+    '''
+
+    workers = max(1, min(workers, len(fields)))
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        frames = list(pool.map(lambda f: _read_raw_field(fpath, f), fields))
+
+    return _share_date_index(dict(zip(fields, frames)))
+
 def load_market_data(fpath, field):
     '''
     load market data for a specific field from a csv file with name field
@@ -174,10 +327,10 @@ def load_market_data(fpath, field):
     data : pandas.DataFrame
         Returns a pandas dateframe with a time series index and the tickers as column headers
     '''
-    data = pd.read_csv(path.join(fpath, field + '.csv'), sep = ',', index_col = 0, parse_dates=True)
+    data = _read_field(fpath, field)
     return data  
 
-def empty_dataframe(equities,  startdate = pd.datetime(1990, 1 , 1).date(), enddate = None):
+def empty_dataframe(equities,  startdate = pd.datetime(1990, 1 , 1).date(), enddate = None, dtype = 'float64'):
     '''
     Creates an empty dataframe with a time series index and a column index populated with the equities supplied
 
@@ -192,6 +345,9 @@ def empty_dataframe(equities,  startdate = pd.datetime(1990, 1 , 1).date(), endd
     enddate : date
         The end date of the time series index
 
+    dtype : str
+        The numpy dtype of the data, see datamanager.dtypes.grid_dtype
+
     Return
     ------
     data : pandas.DataFrame
@@ -210,17 +366,38 @@ def empty_dataframe(equities,  startdate = pd.datetime(1990, 1 , 1).date(), endd
     cols = equities
         
     # create new blank data frame
-    dat = np.empty((len(rows), len(cols)))
+    dat = np.empty((len(rows), len(cols)), dtype = dtype)
     dat[:] = np.NAN
         
     template = pd.DataFrame(dat, index = rows, columns = cols)
     return template
 
-def load_field(fpath=MASTER_DATA_PATH, field = 'Close', tickers=None, start='1990-01-01', end=str(dt.today().date())):
+def load_field(fpath=MASTER_DATA_PATH, field = 'Close', tickers=None, start='1990-01-01', end=str(dt.today().date()), as_of_snapshot=None, provisional=False):
     '''
+    Parameters
+    ----------
+    as_of_snapshot : str
+        Load the field as it was in a snapshot of the master data instead of from fpath, the name of the snapshot or
+        a date to use the last snapshot on or before it (optional). Only the years between start and end are read.
+
+    provisional : bool
+        Append the provisional rows of the current month of the daily refresh, see datamanager.provisional
+
+    The slice is requested from the local data server when DATAMANAGER_SERVER is set, see datamanager.server.
     '''
+
+    if provisional:
+        data = load_field(fpath, field, tickers = tickers, start = start, end = None, as_of_snapshot = as_of_snapshot)
+        data = prov.extend(data, prov.load(field))
+        return data.loc[:end]
+
+    if as_of_snapshot is not None:
+        return snapshots.load_field(as_of_snapshot, field, tickers = tickers, start = start, end = end)
+
+    if DATA_SERVER:
+        return _fetch_fields(fpath, [field], tickers = tickers, start = start, end = end)[field]
     
-    data = pd.read_csv(path.join(fpath, field + '.csv'), sep = ',', index_col = 0, parse_dates = True)
+    data = _read_field(fpath, field)
     data = data.ix[start:end]
     
     if (tickers==None):
@@ -230,15 +407,16 @@ def load_field(fpath=MASTER_DATA_PATH, field = 'Close', tickers=None, start='199
 
 def load_fields(fpath=MASTER_DATA_PATH, fields = ['Close'], tickers=None, start='2010-01-01', end=str(dt.today().date())):
     '''
+    The fields are requested from the local data server when DATAMANAGER_SERVER is set
     '''
     
     assert type(fields) == list
-    data = {}
+    if DATA_SERVER:
+        return _fetch_fields(fpath, fields, tickers = tickers, start = start, end = end)
+
+    data = read_fields(fpath, fields)
     for f in fields:
-        temp = pd.read_csv(path.join(fpath, f + '.csv'), sep=',', header=0, 
-                    index_col=0, parse_dates=True)
-                           
-        temp = temp.ix[start:end]  
+        temp = data[f].ix[start:end]
         
         if (tickers is not None):
             temp = temp[tickers]
@@ -247,6 +425,162 @@ def load_fields(fpath=MASTER_DATA_PATH, fields = ['Close'], tickers=None, start=
         
     return data 
     
+def _field_chunks(fpath, field, tickers, start, end, rows):
+    '''
+    The date ordered chunks of the columns of the tickers of a field between start and end, in the grid dtype
+    '''
+
+    if field_file(fpath, field).endswith(STEPS_EXT):
+        yield load_step_field(fpath, field).decode(tickers).loc[start:end]
+        return
+
+    filepath = path.join(fpath, field + '.csv')
+    columns = pd.read_csv(filepath, sep=',', header=0, index_col=0, nrows=0).columns
+    keep = set(tickers)
+    usecols = [0] + [i + 1 for i, c in enumerate(columns) if c in keep]
+    dtype = grid_dtype(field)
+
+    reader = pd.read_csv(filepath, sep=',', header=0, index_col=0, parse_dates=True, usecols=usecols,
+                         dtype=dict((c, dtype) for c in columns if c in keep), chunksize=rows)
+    for chunk in reader:
+        if end is not None and len(chunk.index) > 0 and chunk.index[0] > pd.Timestamp(end):
+            break
+
+        chunk = chunk.loc[start:end]
+        if len(chunk.index) > 0:
+            yield chunk.reindex(columns = tickers)
+
+def _date_blocks(chunks, bounds):
+    '''
+    Regroup date ordered chunks in blocks that end at the bounds, a block without rows is None
+    '''
+
+    pending = None
+    for b in bounds:
+        parts = []
+        while True:
+            if pending is None:
+                pending = next(chunks, None)
+                if pending is None:
+                    break
+
+            n = pending.index.searchsorted(b, side = 'right')
+            parts.append(pending.iloc[:n])
+            if n < len(pending.index):
+                pending = pending.iloc[n:]
+                break
+            pending = None
+
+        yield pd.concat(parts) if len(parts) > 0 else None
+
+def _field_dates(fpath, field):
+    filepath = field_file(fpath, field)
+    if filepath.endswith(STEPS_EXT):
+        with open(filepath, 'r') as f:
+            header = f.readline().lstrip('#').rstrip('\n').split(',')
+        return pd.bdate_range(header[0], header[1])
+
+    return pd.read_csv(filepath, sep=',', header=0, index_col=0, usecols=[0], parse_dates=True).index
+
+def trading_days(fpath=MASTER_DATA_PATH, field='Close', rows=CROSS_SECTION_ROWS):
+    '''
+    The dates on which any ticker has a value of a field, the field is read in chunks of rows so the whole field is
+    never in memory. The holidays of the business day grid are not trading days.
+    '''
+
+    tickers = field_tickers(fpath, field)
+    days = [c.index[c.notnull().any(axis = 1).values] for c in _field_chunks(fpath, field, tickers, None, None, rows)]
+    return pd.DatetimeIndex(np.concatenate([d.values for d in days])) if days else pd.DatetimeIndex([])
+
+def iter_cross_sections(fpath=MASTER_DATA_PATH, fields = ['Close'], tickers=None, start=None, end=None, freq=None,
+                        listings=None, rows=CROSS_SECTION_ROWS, prefetch=True):
+    '''
+    Iterate over the cross-sections of several fields date by date, e.g. to walk through a backtest
+
+    The fields are read from the store in blocks of dates, every block is held as one tickers array per field and
+    the cross-section of a date is a view of a row of each array, so no row lookups are done per field per date.
+    A background thread reads the next block while the current block is consumed.
+
+    Parameters
+    ----------
+    fields : list
+        The fields, the dates of the first field are the dates of the cross-sections. The other fields are NaN on
+        dates they do not have.
+
+    tickers : list
+        The tickers, defaults to the tickers of the first field
+
+    start, end : str
+        The date range (optional)
+
+    freq : str
+        None for every date, 'M' for the last date of every month
+
+    listings : datamanager.universe.ListingIndex
+        Only return the tickers listed on the date of every cross-section (optional)
+
+    rows : int
+        The number of cross-sections per block
+
+    prefetch : bool
+        Read the next block in a background thread
+
+    Return
+    ------
+    cross-sections : generator of (pandas.Timestamp, pandas.DataFrame)
+        The date and the tickers x fields cross-section, in the grid dtype of every field (the integer fields are
+        float64)
+    '''
+
+    assert type(fields) == list
+    if tickers is None:
+        tickers = field_tickers(fpath, fields[0])
+    tickers = list(tickers)
+
+    dates = _field_dates(fpath, fields[0])
+    dates = dates[(dates >= pd.Timestamp(start if start is not None else dates[0])) &
+                  (dates <= pd.Timestamp(end if end is not None else dates[-1]))]
+    if freq == 'M':
+        months = dates.to_period('M')
+        dates = dates[np.append(months[1:] != months[:-1], True)] if len(dates) > 0 else dates
+    elif freq is not None:
+        raise ValueError('Unknown cross-section frequency ' + str(freq))
+
+    blocks = [dates[i:i + rows] for i in range(0, len(dates), rows)]
+    bounds = [b[-1] for b in blocks]
+    readers = [_date_blocks(_field_chunks(fpath, f, tickers, start, end, rows), bounds) for f in fields]
+    columns = np.asarray(tickers, dtype = object)
+
+    def read(i):
+        values = []
+        for r in readers:
+            data = next(r)
+            if data is None:
+                data = pd.DataFrame(index = blocks[i], columns = tickers, dtype = 'float64')
+            values.append(data.reindex(index = blocks[i]).values)
+
+        mask = listings.mask(blocks[i], tickers).values if listings is not None else None
+        return values, mask
+
+    pool = ThreadPoolExecutor(max_workers = 1) if prefetch and len(blocks) > 1 else None
+    try:
+        future = None
+        for i in range(len(blocks)):
+            if future is not None:
+                values, mask = future.result()
+            else:
+                values, mask = read(i)
+
+            future = pool.submit(read, i + 1) if pool is not None and i + 1 < len(blocks) else None
+
+            for j, d in enumerate(blocks[i]):
+                keep = mask[j] if mask is not None else slice(None)
+                yield d, pd.DataFrame(dict((f, v[j, keep]) for f, v in zip(fields, values)),
+                                      index = columns[keep], columns = fields)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
 def load_panel(fpath=MASTER_DATA_PATH, fields = ['Close']):
     '''
     
@@ -279,6 +613,27 @@ def load_panel(fpath=MASTER_DATA_PATH, fields = ['Close']):
     panel = panel.swapaxes(0, 2)
     return panel
 
+def load_step_field(fpath=MASTER_DATA_PATH, field = 'Total Number Of Shares', dense = False):
+    '''
+    load a step-like field that is stored as change points
+
+    Parameters
+    ----------
+    dense : bool
+        return the expanded dates x tickers DataFrame instead of the compact form
+
+    Return
+    ------
+    data : datamanager.steps.StepField or pandas.DataFrame
+        The compact field, its dense view is expanded lazily on first access
+    '''
+
+    data = StepField.read_csv(path.join(fpath, field + STEPS_EXT))
+    if dense:
+        return data.dense
+
+    return data
+
 def load_close(fpath=MASTER_DATA_PATH, tickers=None, start='1990-01-01', end=str(dt.today().date())):
     '''
     load the closing price data from the supplied path
@@ -336,9 +691,49 @@ def load_equities(fpath = MASTER_DATA_PATH):
     
     return EQUITIES
     
+def load_signals(fpath = MASTER_DATA_PATH, name = 'Momentum'):
+    '''
+    load a multi-signal file with (signal, ticker) columns, e.g. the momentum signals
+
+    Return
+    ------
+    signals : dict
+        signal name -> pandas.DataFrame with a time series index and the tickers as column headers
+    '''
+
+    data = pd.read_csv(path.join(fpath, name + '.csv'), sep = ',', header = [0, 1], index_col = 0, parse_dates = True)
+    return dict((s, data[s]) for s in data.columns.levels[0] if s in data.columns)
+
+def load_listings(fpath = MASTER_DATA_PATH):
+    '''
+    load the point-in-time listing index of the equity universe
+
+    Return
+    ------
+    listings : datamanager.universe.ListingIndex
+    '''
+
+    frame = pd.read_csv(path.join(fpath, 'Listings.csv'), sep = ',', index_col = 0, parse_dates = ['start', 'end'])
+    return ListingIndex.from_frame(frame)
+
+def load_reference_history(fpath = MASTER_DATA_PATH):
+    '''
+    load the point-in-time history of the equity reference data
+
+    Return
+    ------
+    history : datamanager.referencedata.ReferenceHistory
+    '''
+
+    frame = pd.read_csv(path.join(fpath, 'jse_equities_history.csv'), sep = ',', parse_dates = ['start', 'end'])
+    return ReferenceHistory.from_frame(frame)
+
 def get_equities():
     '''
     '''
     
     eq = load_equities().copy()
     return eq
+
+# wrap the public functions when profiling is enabled, see datamanager.profiling
+instrument(globals(), __name__)
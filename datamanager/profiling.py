@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''
+Opt-in profiling of the public functions of the loaders, transforms and adjustments
+
+Set DATAMANAGER_PROFILE=1 to wrap the public functions of datamanager.load, datamanager.transforms and
+datamanager.adjust when they are imported. Every call records the call count, the cumulative and self time, the shapes
+of the array inputs and the bytes of the output per function, and the self time per call stack. Set
+DATAMANAGER_PROFILE=memory to also record the peak memory of each call above the memory at its start with tracemalloc,
+which counts the temporaries freed before the call returns (much slower, Python 3.9 or later). When profiling is
+disabled the functions are not wrapped at all.
+
+The profiles are exported as aggregated JSON (write_json) and as collapsed stacks (write_collapsed) that
+flamegraph.pl, speedscope and similar tools read. Set DATAMANAGER_PROFILE_OUTPUT to a path prefix to write
+<prefix>.json and <prefix>.folded when the process exits.
+'''
+
+import json
+import time
+import atexit
+import inspect
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from datamanager.envs import PROFILE, PROFILE_OUTPUT
+
+ENABLED = PROFILE in ['1', 'memory']
+# the peak of a call needs tracemalloc.reset_peak (Python 3.9 or later)
+MEMORY = PROFILE == 'memory' and hasattr(tracemalloc, 'reset_peak')
+
+# the number of distinct input shapes kept per function
+MAX_SHAPES = 10
+
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+_stacks = {}
+
+def _shape(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return list(value.shape)
+    if isinstance(value, dict):
+        return dict((str(k), _shape(v)) for k, v in value.items() if _shape(v) is not None) or None
+
+    return None
+
+def _nbytes(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index = True)))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+
+    return 0
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    return _local.stack
+
+def _record(name, elapsed, child, shapes, output, peak):
+    stack = ';'.join(f[0] for f in _stack()) + (';' if _stack() else '') + name
+
+    with _lock:
+        s = _stats.get(name)
+        if s is None:
+            s = _stats[name] = {'calls': 0, 'cumulative': 0.0, 'self': 0.0, 'output_bytes': 0, 'peak_bytes': 0,
+                                'shapes': []}
+
+        s['calls'] += 1
+        s['cumulative'] += elapsed
+        s['self'] += elapsed - child
+        s['output_bytes'] += output
+        s['peak_bytes'] = max(s['peak_bytes'], peak)
+        if shapes and shapes not in s['shapes'] and len(s['shapes']) < MAX_SHAPES:
+            s['shapes'].append(shapes)
+
+        _stacks[stack] = _stacks.get(stack, 0.0) + elapsed - child
+
+@contextmanager
+def profile(name, *inputs):
+    '''
+    Profile a block of code under a name, the shapes of the inputs are recorded
+
+        with profile('merge', old, new):
+            ...
+    '''
+
+    # the name, the time spent in profiled calls and the peak traced memory of the block so far
+    frame = [name, 0.0, 0]
+    stack = _stack()
+
+    before = 0
+    if MEMORY:
+        # the peak is reset for the block, the peak of the enclosing block so far is kept in its frame
+        before, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][2] = max(stack[-1][2], peak)
+        tracemalloc.reset_peak()
+
+    stack.append(frame)
+    start = time.perf_counter()
+    result = {}
+    try:
+        yield result
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+
+        peak = 0
+        if MEMORY:
+            frame[2] = max(frame[2], tracemalloc.get_traced_memory()[1])
+            peak = max(0, frame[2] - before)
+            if stack:
+                stack[-1][2] = max(stack[-1][2], frame[2])
+
+        shapes = [s for s in (_shape(i) for i in inputs) if s is not None]
+        _record(name, elapsed, frame[1], shapes, _nbytes(result.get('output')), peak)
+        if stack:
+            stack[-1][1] += elapsed
+
+def profiled(func, name = None):
+    '''
+    Wrap a function so that its calls are profiled
+    '''
+
+    name = name or func.__module__.split('.')[-1] + '.' + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile(name, *(list(args) + list(kwargs.values()))) as result:
+            result['output'] = func(*args, **kwargs)
+        return result['output']
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+def instrument(namespace, module):
+    '''
+    Wrap the public functions defined in a module when profiling is enabled, called at the end of the module with
+    its globals(). Generator functions are not wrapped, their work is done after they return.
+    '''
+
+    if not ENABLED:
+        return
+
+    for key, value in list(namespace.items()):
+        if key.startswith('_') or not inspect.isfunction(value) or value.__module__ != module:
+            continue
+        if inspect.isgeneratorfunction(value) or getattr(value, '__profiled__', False):
+            continue
+
+        namespace[key] = profiled(value)
+
+def stats():
+    '''
+    The aggregated profile: function name -> calls, cumulative and self seconds, output bytes, the largest peak
+    memory of a call above the memory at its start and the distinct input shapes
+    '''
+
+    with _lock:
+        return dict((k, dict(v)) for k, v in _stats.items())
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _stacks.clear()
+
+def write_json(filepath):
+    with open(filepath, 'w') as f:
+        json.dump(stats(), f, indent = 1, sort_keys = True)
+
+def write_collapsed(filepath):
+    '''
+    Write the self time of every call stack in microseconds as collapsed stacks, one "a;b;c count" line per stack
+    '''
+
+    with _lock:
+        stacks = sorted(_stacks.items())
+
+    with open(filepath, 'w') as f:
+        for stack, seconds in stacks:
+            f.write(stack + ' ' + str(int(round(seconds * 1e6))) + '\n')
+
+def _export():
+    write_json(PROFILE_OUTPUT + '.json')
+    write_collapsed(PROFILE_OUTPUT + '.folded')
+
+if ENABLED:
+    if MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    if PROFILE_OUTPUT:
+        atexit.register(_export)
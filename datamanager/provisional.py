@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+The provisional layer of the daily refresh
+
+The monthly update only converts and merges the data up to the last month end. The daily refresh keeps the rows of
+the current (partial) month of every field in a separate provisional directory, merges the days of every download
+into it (a day that is downloaded again replaces its old values) and recomputes the daily derived outputs for the provisional days from the tail of the master data, so the master
+history is never rewritten during the month. When the month closes the monthly update merges the closed month into
+the master data and the provisional rows up to the last date of the master data are dropped.
+'''
+
+import io
+import numpy as np
+import pandas as pd
+from os import path
+from datamanager.envs import PROVISIONAL_PATH
+from datamanager.dtypes import grid_dtype, as_field_dtype
+
+def split_month(data, month_end):
+    '''
+    Split the rows of a dates x tickers DataFrame in the closed rows up to the month end and the provisional rows
+    after it
+    '''
+
+    closed = data.index.values.astype('datetime64[D]') <= np.datetime64(month_end)
+    return data[closed], data[~closed]
+
+def merge_days(old, new):
+    '''
+    Merge new provisional rows into the existing provisional rows, the values of the new rows replace the old values
+    of the same days
+    '''
+
+    if old is None or len(old.index) == 0:
+        return new.sort_index()
+
+    merged = old.reindex(index = old.index.union(new.index), columns = old.columns.union(new.columns))
+    merged.update(new)
+
+    return merged
+
+def prune(data, last_closed):
+    '''
+    Drop the provisional rows up to the last date of the master data, these rows have been merged when the month
+    closed
+    '''
+
+    if last_closed is None:
+        return data
+
+    return data[data.index > pd.Timestamp(last_closed)]
+
+def read_tail(filepath, nrows, field = None, blocksize = 1 << 16):
+    '''
+    Read the header and the last rows of a dates x tickers csv file, the file is read from the end so the cost does
+    not depend on the length of the history
+
+    Parameters
+    ----------
+    nrows : int
+        The number of rows to read
+
+    field : str
+        The field of the file, the rows are read in the grid dtype of the field (optional)
+    '''
+
+    with open(filepath, 'rb') as f:
+        header = f.readline()
+        start_of_data = f.tell()
+
+        f.seek(0, 2)
+        end = f.tell()
+        data = b''
+        while end > start_of_data and data.count(b'\n') <= nrows:
+            start = max(start_of_data, end - blocksize)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+
+    lines = data.rstrip(b'\r\n').split(b'\n')
+    if end > start_of_data:
+        # the first line may be partial
+        lines = lines[1:]
+    lines = [l for l in lines[-nrows:] if l.strip()] if nrows > 0 else []
+
+    text = (header + b'\n'.join(lines) + (b'\n' if lines else b'')).decode('utf-8')
+    columns = pd.read_csv(io.StringIO(header.decode('utf-8')), sep = ',', header = 0, index_col = 0, nrows = 0).columns
+    dtype = grid_dtype(field) if field is not None else 'float64'
+
+    return pd.read_csv(io.StringIO(text), sep = ',', header = 0, index_col = 0, parse_dates = True,
+                       dtype = dict((c, dtype) for c in columns))
+
+def read_trading_tail(filepath, ndays, field = None):
+    '''
+    Read the header and the last rows of a dates x tickers csv file that hold ndays trading days (rows on which any
+    ticker has a value), the holiday rows between them are kept. The trading day windows skip the holidays, so a
+    tail of ndays rows would hold fewer than ndays trading days.
+    '''
+
+    nrows = ndays
+    while True:
+        tail = read_tail(filepath, nrows, field)
+        trading = np.flatnonzero(tail.notnull().any(axis = 1).values)
+
+        if len(trading) >= ndays:
+            return tail.iloc[trading[-ndays]:] if ndays > 0 else tail.iloc[len(tail.index):]
+        if len(tail.index) < nrows:
+            # the file holds fewer trading days
+            return tail
+
+        nrows += ndays - len(trading)
+
+def provisional_file(field, fpath = PROVISIONAL_PATH):
+    return path.join(fpath, field + '.csv')
+
+def load(field, fpath = PROVISIONAL_PATH):
+    '''
+    Load the provisional rows of a field, None if there are none
+    '''
+
+    filepath = provisional_file(field, fpath)
+    if not path.isfile(filepath):
+        return None
+
+    data = pd.read_csv(filepath, sep = ',', header = 0, index_col = 0, parse_dates = True)
+    return as_field_dtype(data.astype(grid_dtype(field)), field)
+
+def extend(data, provisional):
+    '''
+    Append the provisional rows after the last date of the data
+    '''
+
+    if provisional is None:
+        return data
+
+    rows = provisional[provisional.index > data.index[-1]] if len(data.index) > 0 else provisional
+    if len(rows.index) == 0:
+        return data
+
+    return pd.concat([data, rows.reindex(columns = data.columns).astype(data.dtypes.to_dict())])
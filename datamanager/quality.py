@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Vectorized data quality checks of the new rows of the downloads
+
+Bad vendor rows (zero prices, 100x price jumps from a cents/rands confusion, negative volumes) poison the adjusted
+prices and every signal derived from them. The checks run on the new rows of every field while they are converted,
+each check is a single numpy pass over the dates x tickers matrix, and the anomalies are reported in a compact long
+format: one row per (date, ticker, field, check) with the offending value.
+
+==============  ============================================================================================
+check           anomaly
+==============  ============================================================================================
+zero            a price of zero
+negative        a negative price, count or market cap
+jump            a log return with a robust z-score above JUMP_ZSCORE and a size above MIN_JUMP
+scale           a price that changed by a factor of about 100 (cents vs rands)
+market-cap      a market cap that differs from close x shares by more than a factor of 2 from the market wide
+                ratio of the date
+==============  ============================================================================================
+'''
+
+import warnings
+import numpy as np
+import pandas as pd
+from datamanager.load import price_fields
+
+REPORT_COLUMNS = ['date', 'ticker', 'field', 'check', 'value']
+
+# the fields that can not be negative, the price fields are also checked for zeros, jumps and scale changes
+NON_NEGATIVE_FIELDS = price_fields() + ['Volume', 'Number Of Trades', 'Total Number Of Shares', 'Market Cap']
+
+# a return is a jump if its robust z-score and its size are both above these limits
+JUMP_ZSCORE = 10.0
+MIN_JUMP = np.log(1.5)
+
+# a price change of SCALE within a factor of SCALE_TOLERANCE is reported as a scale change
+SCALE = 100.0
+SCALE_TOLERANCE = np.log(1.25)
+
+# the rows before the new rows used to estimate the scale of the returns
+CONTEXT_ROWS = 252
+
+MARKET_CAP_TOLERANCE = np.log(2.0)
+
+def _report(mask, values, index, columns, field, check):
+    rows, cols = np.nonzero(mask)
+    return pd.DataFrame({'date': np.asarray(index)[rows],
+                         'ticker': np.asarray(columns)[cols],
+                         'field': field,
+                         'check': check,
+                         'value': values[rows, cols]},
+                        columns = REPORT_COLUMNS)
+
+def empty_report():
+    return pd.DataFrame(columns = REPORT_COLUMNS)
+
+def jump_zscores(r):
+    '''
+    The robust z-scores of the log returns of every column, scaled by the median absolute deviation of the column
+    '''
+
+    # columns without returns have a NaN median
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(r, axis = 0)
+        mad = np.nanmedian(np.abs(r - med), axis = 0) * 1.4826
+
+    # a column that hardly moves gets the scale of a 1% daily move so that ticks are not reported as jumps
+    mad = np.where(np.isfinite(mad), np.maximum(mad, 0.01), 0.01)
+
+    with np.errstate(invalid = 'ignore'):
+        return np.abs(r - med) / mad
+
+def scan_field(data, field, context = None):
+    '''
+    Check the new rows of a field
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The new rows (dates x tickers)
+
+    field : str
+        The name of the field
+
+    context : pandas.DataFrame
+        The rows before the new rows, used for the first return and the scale of the returns (optional)
+
+    Return
+    ------
+    report : pandas.DataFrame
+        The anomalies of the new rows, see REPORT_COLUMNS
+    '''
+
+    if field not in NON_NEGATIVE_FIELDS or len(data.index) == 0:
+        return empty_report()
+
+    v = data.astype(float).values
+    reports = []
+
+    with np.errstate(invalid = 'ignore'):
+        reports.append(_report(v < 0, v, data.index, data.columns, field, 'negative'))
+
+        if field in price_fields():
+            reports.append(_report(v == 0, v, data.index, data.columns, field, 'zero'))
+
+            n = 0
+            p = v
+            if context is not None and len(context.index) > 0:
+                prior = context.reindex(columns = data.columns).astype(float).values
+                n = len(prior)
+                p = np.vstack([prior, v])
+
+            # the returns from the last valid price, zero and negative prices are reported on their own
+            p = np.where(p > 0, p, np.nan)
+            logp = pd.DataFrame(np.log(p)).ffill().values
+            r = np.empty_like(logp)
+            r[0] = np.nan
+            r[1:] = logp[1:] - logp[:-1]
+            r[~np.isfinite(p)] = np.nan
+
+            scale = np.abs(np.abs(r) - np.log(SCALE)) < SCALE_TOLERANCE
+            jump = (jump_zscores(r) > JUMP_ZSCORE) & (np.abs(r) > MIN_JUMP) & ~scale
+
+            reports.append(_report(scale[n:], v, data.index, data.columns, field, 'scale'))
+            reports.append(_report(jump[n:], v, data.index, data.columns, field, 'jump'))
+
+    return pd.concat(reports, ignore_index = True)
+
+def scan_market_cap(close, shares, mcap):
+    '''
+    Check that the market cap is close x shares, up to the units of the market cap. The units are the median ratio
+    of all the tickers on every date, so the check does not depend on them.
+    '''
+
+    c = close.astype(float).values
+    s = shares.reindex(index = close.index, columns = close.columns).astype(float).values
+    m = mcap.reindex(index = close.index, columns = close.columns).astype(float).values
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        ratio = np.log(m / (c * s))
+        ratio[~np.isfinite(ratio)] = np.nan
+        units = np.nanmedian(ratio, axis = 1)[:, np.newaxis] if ratio.size else ratio
+        off = np.abs(ratio - units) > MARKET_CAP_TOLERANCE
+
+    return _report(off, m, close.index, close.columns, 'Market Cap', 'market-cap')
+
+def summary(report):
+    '''
+    The number of anomalies per field and check
+    '''
+
+    if len(report.index) == 0:
+        return pd.Series([], dtype = 'int64')
+
+    return report.groupby(['field', 'check']).size()
+
+def read_report(filepath):
+    return pd.read_csv(filepath, sep = ',', parse_dates = ['date'])
@@ -9,7 +9,6 @@ import pandas as pd
 import numpy as np
 from os import path, listdir
 import datetime as dt
-from datamanager.datamodel import Equity
 from datamanager.envs import *
 
 class ReferenceData(object):
@@ -40,7 +39,11 @@ class ReferenceData(object):
                      ('listing_status', 'Listing Status', lambda x: ('CURRENT' if x.strip() == 'Current' else x.strip()) if (type(x) == unicode or type(x) == str) else x),
                      ('fullname', 'Name', lambda x: x.strip() if type(x) == unicode or type(x) == str else x)]
 
-    def convert(self, old, new):
+    def convert(self, old, new, history = None, date = None):
+        '''
+        Update the reference data with a new download, the updated fields are also recorded in the point-in-time
+        history if one is given (see ReferenceHistory.record)
+        '''
         
         upd = old.copy()
         
@@ -61,5 +64,212 @@ class ReferenceData(object):
                     upd.set_value(i, f1, conv_val)
                     
             upd.set_value(i, 'last_update', str(dt.date.today()))
+
+        if history is not None:
+            history.record(upd[[f1 for f1, f2, func in self.fieldmap]], dt.date.today() if date is None else date)
             
         return upd
+
+# the last date an open (current) value is valid
+OPEN_END = np.datetime64('2262-04-11', 'D')
+
+def _to_day(date):
+    return np.datetime64(pd.Timestamp(date).date(), 'D')
+
+class ReferenceHistory(object):
+    '''
+    Point-in-time reference data stored as validity intervals [start, end) per (ticker, field) value
+
+    The intervals of each field are kept sorted by start date, so the value of every ticker on a date and the value
+    matrix over a range of dates are answered with vectorized searches instead of scans of the snapshots.
+    '''
+
+    COLUMNS = ['ticker', 'field', 'value', 'start', 'end']
+
+    def __init__(self, intervals = None):
+        '''
+        Parameters
+        ----------
+        intervals : pandas.DataFrame
+            The ticker, field, value, start and end of every interval, a NaT end is still valid (optional)
+        '''
+
+        if intervals is None:
+            intervals = pd.DataFrame(columns = self.COLUMNS)
+
+        self.intervals = intervals[self.COLUMNS].reset_index(drop = True)
+        self._index = {}
+
+    def __len__(self):
+        return len(self.intervals.index)
+
+    @property
+    def fields(self):
+        return sorted(self.intervals['field'].unique())
+
+    def _field_index(self, field):
+        '''
+        The (tickers, values, starts, ends) arrays of the intervals of a field sorted by start date
+        '''
+
+        if field not in self._index:
+            iv = self.intervals[self.intervals['field'] == field]
+            starts = pd.to_datetime(iv['start']).values.astype('datetime64[D]')
+            ends = pd.to_datetime(iv['end']).values.astype('datetime64[D]')
+            ends = np.where(pd.isnull(ends), OPEN_END, ends)
+
+            order = np.argsort(starts, kind = 'mergesort')
+            self._index[field] = (np.asarray(iv['ticker'], dtype = object)[order],
+                                  np.asarray(iv['value'], dtype = object)[order],
+                                  starts[order],
+                                  ends[order])
+
+        return self._index[field]
+
+    def record(self, snapshot, date):
+        '''
+        Record a snapshot of the reference data that is valid from a date: the intervals of the values that changed
+        are closed on the date and new intervals are opened for the new values. The tickers that are not in the
+        snapshot keep their values.
+
+        Parameters
+        ----------
+        snapshot : pandas.DataFrame
+            The reference data indexed by ticker with a column per field
+
+        date : date
+            The date the snapshot is valid from
+        '''
+
+        day = pd.Timestamp(_to_day(date))
+
+        new = snapshot.copy()
+        new.index.name = 'ticker'
+        new = new.stack(dropna = False).reset_index()
+        new.columns = ['ticker', 'field', 'value']
+        new['value'] = new['value'].where(new['value'].notnull(), None)
+
+        iv = self.intervals
+        current = iv[iv['end'].isnull()]
+
+        keys = ['ticker', 'field']
+        joined = new.merge(current.reset_index(), on = keys, how = 'left', suffixes = ('', '_current'))
+
+        # a value is unchanged if it equals the open value, two missing values are equal
+        same = (joined['value'] == joined['value_current']) | (joined['value'].isnull() & joined['value_current'].isnull() & joined['index'].notnull())
+        changed = joined[~same.values]
+
+        # close the open intervals of the values that changed, an interval that would be empty is dropped
+        closing = changed['index'].dropna().astype(np.int64).values
+        self.intervals.loc[closing, 'end'] = day
+        empty = self.intervals['start'] == self.intervals['end']
+        self.intervals = self.intervals[~empty.values].reset_index(drop = True)
+
+        opened = changed[keys + ['value']].copy()
+        opened['start'] = day
+        opened['end'] = pd.NaT
+        self.intervals = pd.concat([self.intervals, opened[self.COLUMNS]], ignore_index = True)
+
+        self._index = {}
+        return self
+
+    def as_of(self, field, date, tickers = None):
+        '''
+        The value of a field of every ticker on a date
+
+        Parameters
+        ----------
+        field : str
+            The reference data field, e.g. sector
+
+        date : date
+            The date of the values
+
+        tickers : list
+            The tickers to return the values for, defaults to all the tickers with a value on the date
+
+        Return
+        ------
+        values : pandas.Series
+            The value indexed by ticker
+        '''
+
+        names, values, starts, ends = self._field_index(field)
+        d = _to_day(date)
+
+        # all intervals that started on or before the date and have not ended
+        n = np.searchsorted(starts, d, side = 'right')
+        valid = ends[:n] > d
+        out = pd.Series(values[:n][valid], index = names[:n][valid])
+
+        if tickers is not None:
+            out = out.reindex(tickers)
+
+        return out
+
+    def matrix(self, field, dates, tickers = None):
+        '''
+        The value of a field of every ticker on every date
+
+        Parameters
+        ----------
+        field : str
+            The reference data field
+
+        dates : pandas.DatetimeIndex
+            The dates (rows) of the matrix
+
+        tickers : list
+            The tickers (columns) of the matrix, defaults to all the tickers of the field
+
+        Return
+        ------
+        values : pandas.DataFrame
+            The values (dates x tickers), None where the ticker has no value on the date
+        '''
+
+        names, values, starts, ends = self._field_index(field)
+        if tickers is None:
+            tickers = sorted(set(names))
+
+        columns = pd.Index(tickers)
+        days = pd.DatetimeIndex(dates).values.astype('datetime64[D]')
+        cols = columns.get_indexer(list(names))
+        keep = cols >= 0
+
+        # the intervals of a ticker do not overlap, so numbering the start of interval i 2i + 1 and its end 2i + 2 in
+        # start order makes the last event on or before each date the one in force: odd in an interval, even outside
+        i = np.arange(len(names))
+        start_rows = np.searchsorted(days, starts, side = 'left')
+        end_rows = np.searchsorted(days, ends, side = 'left')
+
+        events = np.empty((len(days) + 1, len(columns)), dtype = np.int64)
+        events[:] = 0
+        np.maximum.at(events, (start_rows[keep], cols[keep]), 2 * i[keep] + 1)
+        np.maximum.at(events, (end_rows[keep], cols[keep]), 2 * i[keep] + 2)
+        events = np.maximum.accumulate(events[:-1], axis = 0)
+
+        inside = (events % 2) == 1
+        out = np.empty(events.shape, dtype = object)
+        out[inside] = values[(events[inside] - 1) // 2]
+
+        return pd.DataFrame(out, index = dates, columns = columns)
+
+    def membership(self, field, value, dates, tickers = None):
+        '''
+        Boolean dates x tickers mask, True where the field of the ticker had the value on the date, e.g. the members
+        of a sector
+        '''
+
+        return self.matrix(field, dates, tickers) == value
+
+    def to_frame(self):
+        return self.intervals.copy()
+
+    @classmethod
+    def from_frame(cls, frame):
+        frame = frame.copy()
+        frame['start'] = pd.to_datetime(frame['start'])
+        frame['end'] = pd.to_datetime(frame['end'])
+        frame['value'] = frame['value'].where(frame['value'].notnull(), None)
+        return cls(frame)
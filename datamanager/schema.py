@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+Header-only schema discovery of the data files
+
+The schema of a file (its kind, the tickers, the date range and for reference workbooks the fields) is read from the
+header rows and the first and last date only, without parsing the data. The schemas are cached by the size and
+modification time of every file, so a file is only read again when it changes.
+
+The kinds of files are
+
+=========== ===================================================================================================
+timeseries  a dates x tickers csv file or I-Net BFA time series workbook, e.g. downloads/Close.xlsx
+steps       the change points of a step-like field, see datamanager.steps
+reference   an I-Net BFA reference data workbook, the second header row holds the fields of every column
+table       any other csv file, e.g. jse_equities.csv or Listings.csv
+=========== ===================================================================================================
+'''
+
+import re
+import json
+import csv
+from os import path, listdir, stat
+import pandas as pd
+from datamanager.envs import SCHEMA_CACHE
+from datamanager.storage import atomic_write, MANIFEST, TMP_EXT
+from datamanager.steps import STEPS_EXT
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# the time series files that do not hold a market data field
+NON_FIELD_FILES = ['Indices']
+
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+# the layout of the I-Net BFA workbooks: the tickers (ticker:exchange) are in the first row from the fourth column,
+# the dates in the third column from the fifth row
+_XL_FIRST_COLUMN = 3
+_XL_FIRST_ROW = 5
+_XL_INDEX_COLUMN = 3
+
+def file_signature(filepath):
+    st = stat(filepath)
+    return [st.st_size, st.st_mtime]
+
+def _file_name(filename):
+    for ext in [STEPS_EXT, '.csv', '.xlsx']:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+
+    return None
+
+def _to_date(value):
+    try:
+        return str(pd.Timestamp(value).date())
+    except (ValueError, TypeError):
+        return None
+
+def _last_line(filepath, blocksize = 4096):
+    '''
+    The last non empty line of a text file, read from the end of the file
+    '''
+
+    with open(filepath, 'rb') as f:
+        f.seek(0, 2)
+        end = f.tell()
+        data = b''
+        while end > 0:
+            start = max(0, end - blocksize)
+            f.seek(start)
+            data = f.read(end - start) + data
+            lines = data.rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1 or start == 0:
+                return lines[-1].decode('utf-8').rstrip('\r')
+            end = start
+
+    return ''
+
+def _csv_schema(filepath):
+    if filepath.endswith(STEPS_EXT):
+        with open(filepath, 'r') as f:
+            header = f.readline().lstrip('#').rstrip('\n').split(',')
+        return {'kind': 'steps', 'tickers': header[2:], 'start': header[0], 'end': header[1]}
+
+    with open(filepath, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        first = f.readline()
+
+    if _DATE.match(first) is None:
+        return {'kind': 'table', 'columns': header}
+
+    return {'kind': 'timeseries', 'tickers': header[1:], 'start': first[:10], 'end': _last_line(filepath)[:10]}
+
+def _xlsx_schema(filepath):
+    if openpyxl is None:
+        # without openpyxl the workbook is parsed by pandas
+        raw = pd.read_excel(filepath, header = None)
+        header = list(raw.iloc[0]) if len(raw.index) > 0 else []
+        second = list(raw.iloc[1]) if len(raw.index) > 1 else []
+        first = raw.iloc[_XL_FIRST_ROW - 1, _XL_INDEX_COLUMN - 1] if len(raw.index) >= _XL_FIRST_ROW else None
+        last = raw.iloc[-1, _XL_INDEX_COLUMN - 1] if len(raw.index) >= _XL_FIRST_ROW else None
+    else:
+        wb = openpyxl.load_workbook(filepath, read_only = True, data_only = True)
+        try:
+            ws = wb.worksheets[0]
+            rows = ws.iter_rows(min_row = 1, max_row = 2, values_only = True)
+            header = list(next(rows, []))
+            second = list(next(rows, []))
+
+            first = _xl_cell(ws, _XL_FIRST_ROW)
+            last = _xl_cell(ws, ws.max_row) if ws.max_row is not None else None
+        finally:
+            wb.close()
+
+    tickers = [str(t).split(':')[0] for t in header[_XL_FIRST_COLUMN:] if isinstance(t, str)]
+
+    if _to_date(first) is None:
+        fields = []
+        for f in second[_XL_FIRST_COLUMN:]:
+            if isinstance(f, str) and f not in fields:
+                fields.append(f)
+        return {'kind': 'reference', 'tickers': tickers, 'fields': fields}
+
+    return {'kind': 'timeseries', 'tickers': tickers, 'start': _to_date(first), 'end': _to_date(last)}
+
+def _xl_cell(ws, row):
+    for values in ws.iter_rows(min_row = row, max_row = row, min_col = _XL_INDEX_COLUMN, max_col = _XL_INDEX_COLUMN,
+                               values_only = True):
+        return values[0]
+
+    return None
+
+def read_schema(filepath):
+    '''
+    Read the schema of a csv file or workbook from its header rows
+
+    Return
+    ------
+    schema : dict
+        The kind of the file and, depending on the kind, the tickers, start and end date, fields or columns
+    '''
+
+    if filepath.endswith('.xlsx'):
+        return _xlsx_schema(filepath)
+
+    return _csv_schema(filepath)
+
+def _read_cache(cache_path):
+    if cache_path is None or not path.isfile(cache_path):
+        return {}
+
+    with open(cache_path, 'r') as f:
+        return json.load(f)
+
+def discover(dirpath, cache_path = SCHEMA_CACHE):
+    '''
+    The schemas of the csv files and workbooks in a directory, only the files that changed since they were cached
+    are read
+
+    Return
+    ------
+    schemas : dict
+        The name of the file without its extension -> schema of the file
+    '''
+
+    if not path.isdir(dirpath):
+        return {}
+
+    cache = _read_cache(cache_path)
+    changed = False
+    schemas = {}
+
+    for f in sorted(listdir(dirpath)):
+        name = _file_name(f)
+        if name is None or f == MANIFEST or f.endswith(TMP_EXT) or f.startswith('~$'):
+            continue
+
+        filepath = path.abspath(path.join(dirpath, f))
+        signature = file_signature(filepath)
+
+        known = cache.get(filepath)
+        if known is None or known['signature'] != signature:
+            known = {'signature': signature, 'schema': read_schema(filepath)}
+            cache[filepath] = known
+            changed = True
+
+        schema = dict(known['schema'])
+        schema['file'] = f
+        schemas[name] = schema
+
+    if changed and cache_path is not None:
+        with atomic_write(cache_path) as out:
+            json.dump(cache, out, sort_keys = True)
+
+    return schemas
+
+def field_names(dirpath, cache_path = SCHEMA_CACHE):
+    '''
+    The market data fields of the time series files in a directory
+    '''
+
+    schemas = discover(dirpath, cache_path)
+    return [n for n in schemas
+            if schemas[n]['kind'] in ['timeseries', 'steps'] and n not in NON_FIELD_FILES]
+
+def reference_fields(dirpath, cache_path = SCHEMA_CACHE):
+    '''
+    The fields of the reference data workbooks in a directory
+    '''
+
+    schemas = discover(dirpath, cache_path)
+    fields = []
+    for n in schemas:
+        if schemas[n]['kind'] == 'reference':
+            fields.extend(f for f in schemas[n]['fields'] if f not in fields)
+
+    return fields
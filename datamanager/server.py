@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''
+Local read-only data server with an LRU cache of slices
+
+Research processes that each call load_close, load_adj_close or load_field parse the same master csv files over
+and over. The data server parses every field file once, keeps it in memory (reloading a field when its file
+changes, e.g. after a promotion) and serves (field, tickers, date range) slices over a Unix socket or a localhost
+TCP port as npy arrays, see datamanager.client for the wire format. The encoded responses of the most recently used
+slices are kept in a cache with a memory budget, so a hot slice costs no more than a send.
+
+Start the server with
+
+    python -m datamanager.server [address [field ...]]
+
+and set DATAMANAGER_SERVER to the same address in the research processes. The fields given are parsed before the
+server starts serving, any other field is parsed on its first request.
+'''
+
+import sys
+import json
+import socket
+import threading
+import socketserver
+from os import path, remove
+from collections import OrderedDict
+from datamanager.envs import MASTER_DATA_PATH, DATA_SERVER, SERVER_CACHE_LIMIT
+from datamanager.dtypes import DEFAULT_DTYPE, INTEGER_DTYPES, field_dtype
+from datamanager.load import _read_field, field_file
+import datamanager.client as client
+
+class SliceCache(object):
+    '''
+    A least recently used cache of encoded slices with a budget in bytes
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        nbytes = sum(len(v) for v in value)
+        if nbytes > self.limit:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self.size -= sum(len(v) for v in self._items.pop(key))
+
+            self._items[key] = value
+            self.size += nbytes
+
+            while self.size > self.limit:
+                _, old = self._items.popitem(last = False)
+                self.size -= sum(len(v) for v in old)
+
+    def clear(self, fpath, field):
+        with self._lock:
+            for key in [k for k in self._items if k[0] == fpath and k[1] == field]:
+                self.size -= sum(len(v) for v in self._items.pop(key))
+
+    def __len__(self):
+        return len(self._items)
+
+class FieldStore(object):
+    '''
+    The fields parsed once and held in memory, a field is parsed again when the modification time of its file changes
+    '''
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def field(self, fpath, field):
+        mtime = path.getmtime(field_file(fpath, field))
+
+        with self._lock:
+            known = self._fields.get((fpath, field))
+            if known is not None and known[0] == mtime:
+                return known[1]
+
+            data = _read_field(fpath, field)
+            self._fields[(fpath, field)] = (mtime, data)
+            self.cache.clear(fpath, field)
+            return data
+
+    def slice(self, fpath, field, tickers = None, start = None, end = None):
+        '''
+        The encoded response of a slice: the JSON header, the dates and the values
+        '''
+
+        key = (fpath, field, None if tickers is None else tuple(tickers), start, end)
+
+        # the field is checked first, so a changed file clears its cached slices
+        data = self.field(fpath, field)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        data = data.loc[start:end]
+        if tickers is not None:
+            data = data.reindex(columns = tickers)
+
+        # the nullable integer fields are sent as float64, the client converts them back
+        values = data.astype(DEFAULT_DTYPE).values if field_dtype(field) in INTEGER_DTYPES else data.values
+
+        header = {'columns': [str(c) for c in data.columns], 'index_name': data.index.name}
+        encoded = (json.dumps(header).encode('utf-8'), client.to_npy(data.index.values.astype('int64')),
+                   client.to_npy(values))
+
+        self.cache.put(key, encoded)
+        return encoded
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        request = json.loads(client.recv_frame(self.request).decode('utf-8'))
+
+        try:
+            encoded = self.server.store.slice(request['fpath'], request['field'], request['tickers'],
+                                              request['start'], request['end'])
+        except Exception as e:
+            client.send_frame(self.request, json.dumps({'error': repr(e)}).encode('utf-8'))
+            return
+
+        for payload in encoded:
+            client.send_frame(self.request, payload)
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(address = DATA_SERVER, cache_limit = SERVER_CACHE_LIMIT):
+    '''
+    Create a data server, serve_forever() starts serving
+
+    Parameters
+    ----------
+    address : str
+        A Unix socket path or host:port
+
+    cache_limit : int
+        The memory budget of the slice cache in megabytes
+    '''
+
+    family, addr = client.parse_address(address)
+    if family == socket.AF_UNIX:
+        if path.exists(addr):
+            remove(addr)
+        server = _UnixServer(addr, _Handler)
+    else:
+        server = _TCPServer(addr, _Handler)
+
+    server.store = FieldStore(SliceCache(cache_limit * 1024 * 1024))
+    return server
+
+def serve(address = DATA_SERVER, fields = None, fpath = MASTER_DATA_PATH, cache_limit = SERVER_CACHE_LIMIT):
+    '''
+    Serve the fields of a directory until interrupted, the fields given are parsed before serving starts
+    '''
+
+    server = make_server(address, cache_limit)
+    for f in fields or []:
+        server.store.field(path.abspath(fpath), f)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    serve(sys.argv[1] if len(sys.argv) > 1 else DATA_SERVER, sys.argv[2:])
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+'''
+Content-addressed, deduplicated snapshots of the master data
+
+The dates x tickers files are split in one chunk per field and year, holding only the tickers with data in that
+year, so a new listing or a new month only changes the chunk of the current year. Every other file is a single chunk.
+A chunk is stored once under the hash of its content, and a snapshot is a manifest of the chunk hashes of every file,
+so a monthly snapshot only costs the chunks that changed. The values are kept as the exact text of the csv files.
+'''
+
+from os import path, makedirs, listdir
+import re
+import io
+import gzip
+import json
+import hashlib
+import pandas as pd
+from datamanager.envs import SNAPSHOT_PATH
+from datamanager.storage import atomic_write, data_files
+from datamanager.dtypes import grid_dtype, as_field_dtype
+from datamanager.steps import StepField, STEPS_EXT
+
+CHUNKS = 'chunks'
+MANIFESTS = 'manifests'
+
+# the rows read at a time when a file is split in year chunks
+READ_ROWS = 2500
+
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+def _chunk_path(root, digest):
+    return path.join(root, CHUNKS, digest[:2], digest + '.csv.gz')
+
+def manifest_path(root, name):
+    return path.join(root, MANIFESTS, name + '.json')
+
+def store_chunk(content, root = SNAPSHOT_PATH):
+    '''
+    Store the bytes of a chunk under the hash of its content, a chunk that is already stored is not written again
+
+    Return
+    ------
+    digest : str
+    '''
+
+    digest = hashlib.sha1(content).hexdigest()
+    filepath = _chunk_path(root, digest)
+
+    if not path.isfile(filepath):
+        if not path.isdir(path.dirname(filepath)):
+            makedirs(path.dirname(filepath))
+
+        with atomic_write(filepath, 'wb') as f:
+            f.write(gzip.compress(content))
+
+    return digest
+
+def read_chunk(digest, root = SNAPSHOT_PATH):
+    with open(_chunk_path(root, digest), 'rb') as f:
+        return gzip.decompress(f.read())
+
+def _is_timeseries(filepath):
+    '''
+    A dates x tickers file has a single header line followed by lines that start with a date
+    '''
+
+    with open(filepath, 'r') as f:
+        f.readline()
+        return _DATE.match(f.readline()) is not None
+
+def _year_chunks(filepath, root):
+    '''
+    Split a dates x tickers file in year chunks of the tickers with data in the year, keeping the text of the values
+    '''
+
+    reader = pd.read_csv(filepath, sep = ',', header = 0, index_col = 0, dtype = str, keep_default_na = False,
+                         na_filter = False, chunksize = READ_ROWS)
+
+    columns = None
+    index_name = None
+    chunks = {}
+    pending = None
+
+    def store(rows):
+        year = rows.index[0][:4]
+        keep = (rows != '').any(axis = 0)
+        chunks[year] = store_chunk(rows.loc[:, keep.values].to_csv().encode('utf-8'), root)
+
+    for rows in reader:
+        columns = list(rows.columns)
+        index_name = rows.index.name
+
+        if pending is not None:
+            rows = pd.concat([pending, rows])
+
+        if len(rows.index) == 0:
+            continue
+
+        years = rows.index.str[:4]
+        last = years == years[-1]
+
+        # the rows of the last year may continue in the next rows
+        for y in sorted(set(years[~last])):
+            store(rows[years == y])
+        pending = rows[last]
+
+    if pending is not None and len(pending.index) > 0:
+        store(pending)
+
+    if columns is None:
+        columns = list(pd.read_csv(filepath, sep = ',', header = 0, index_col = 0, nrows = 0).columns)
+
+    return {'kind': 'years', 'columns': columns, 'index_name': index_name, 'chunks': chunks}
+
+def _file_chunk(filepath, root):
+    with open(filepath, 'rb') as f:
+        return {'kind': 'file', 'chunk': store_chunk(f.read(), root)}
+
+def take_snapshot(name, src, root = SNAPSHOT_PATH):
+    '''
+    Snapshot the data files of a directory
+
+    Parameters
+    ----------
+    name : str
+        The name of the snapshot, by convention the date of the data, e.g. 2016-01-31
+
+    src : str
+        The directory to snapshot, e.g. the master data
+
+    root : str
+        The snapshot store
+
+    Return
+    ------
+    manifest : dict
+        The file name -> chunks of the file
+    '''
+
+    manifest = {}
+    for f in data_files(src):
+        filepath = path.join(src, f)
+        manifest[f] = _year_chunks(filepath, root) if f.endswith('.csv') and _is_timeseries(filepath) else _file_chunk(filepath, root)
+
+    if not path.isdir(path.join(root, MANIFESTS)):
+        makedirs(path.join(root, MANIFESTS))
+
+    with atomic_write(manifest_path(root, name)) as out:
+        json.dump(manifest, out, indent = 1, sort_keys = True)
+
+    return manifest
+
+def snapshots(root = SNAPSHOT_PATH):
+    '''
+    The names of the snapshots in the store, in order
+    '''
+
+    if not path.isdir(path.join(root, MANIFESTS)):
+        return []
+
+    return sorted(f[:-len('.json')] for f in listdir(path.join(root, MANIFESTS)) if f.endswith('.json'))
+
+def resolve(as_of, root = SNAPSHOT_PATH):
+    '''
+    The snapshot with a name, or else the last snapshot named on or before a date
+    '''
+
+    names = snapshots(root)
+    if str(as_of) in names:
+        return str(as_of)
+
+    day = str(pd.Timestamp(as_of).date())
+    before = [n for n in names if n <= day]
+    if len(before) == 0:
+        raise ValueError('No snapshot on or before ' + day)
+
+    return before[-1]
+
+def read_manifest(name, root = SNAPSHOT_PATH):
+    with open(manifest_path(root, resolve(name, root)), 'r') as f:
+        return json.load(f)
+
+def load_field(as_of, field, tickers = None, start = None, end = None, root = SNAPSHOT_PATH):
+    '''
+    Load a dates x tickers field as it was in a snapshot, only the year chunks between start and end are read
+
+    Parameters
+    ----------
+    as_of : str
+        The name of the snapshot, or a date to use the last snapshot on or before it
+
+    field : str
+        The name of the field
+
+    tickers : list
+        The tickers to return (optional)
+
+    start, end : str
+        The date range to return (optional)
+
+    Return
+    ------
+    data : pandas.DataFrame
+        The data of the field in the dtype of the field
+    '''
+
+    manifest = read_manifest(as_of, root)
+
+    # step-like fields are stored as their change points
+    if field + STEPS_EXT in manifest:
+        text = read_chunk(manifest[field + STEPS_EXT]['chunk'], root).decode('utf-8')
+        steps = StepField.read_csv(io.StringIO(text))
+        data = steps.dense if tickers is None else steps.decode(tickers)
+        return as_field_dtype(data.loc[start:end], field)
+
+    entry = manifest[field + '.csv']
+    if entry['kind'] != 'years':
+        raise ValueError(field + ' is not a dates x tickers field')
+
+    years = sorted(entry['chunks'])
+    if start is not None:
+        years = [y for y in years if y >= str(pd.Timestamp(start).year)]
+    if end is not None:
+        years = [y for y in years if y <= str(pd.Timestamp(end).year)]
+
+    columns = entry['columns'] if tickers is None else list(tickers)
+    dtype = grid_dtype(field)
+
+    frames = []
+    for y in years:
+        text = read_chunk(entry['chunks'][y], root).decode('utf-8')
+        header = pd.read_csv(io.StringIO(text), sep = ',', header = 0, index_col = 0, nrows = 0).columns
+        frames.append(pd.read_csv(io.StringIO(text), sep = ',', header = 0, index_col = 0, parse_dates = True,
+                                  dtype = dict((c, dtype) for c in header)).reindex(columns = columns))
+
+    if len(frames) == 0:
+        data = pd.DataFrame(columns = columns, index = pd.DatetimeIndex([], name = entry['index_name']), dtype = dtype)
+    else:
+        data = pd.concat(frames)
+
+    data.index.name = entry['index_name']
+    data = data.loc[start:end] if start is not None or end is not None else data
+
+    return as_field_dtype(data, field)
+
+def restore(as_of, dst, root = SNAPSHOT_PATH):
+    '''
+    Write all the files of a snapshot to a directory
+    '''
+
+    manifest = read_manifest(as_of, root)
+    for f in manifest:
+        entry = manifest[f]
+        if entry['kind'] == 'file':
+            with atomic_write(path.join(dst, f), 'wb') as out:
+                out.write(read_chunk(entry['chunk'], root))
+            continue
+
+        with atomic_write(path.join(dst, f)) as out:
+            frames = [pd.read_csv(io.StringIO(read_chunk(entry['chunks'][y], root).decode('utf-8')), sep = ',',
+                                  header = 0, index_col = 0, dtype = str, keep_default_na = False, na_filter = False)
+                      for y in sorted(entry['chunks'])]
+
+            if len(frames) == 0:
+                data = pd.DataFrame(columns = entry['columns'])
+            else:
+                data = pd.concat(frames).reindex(columns = entry['columns']).fillna('')
+
+            data.index.name = entry['index_name']
+            data.to_csv(out)
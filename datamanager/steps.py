@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''
+Change-point (run-length) encoding of step-like fields
+
+Fields like the total number of shares or the book value per share only change a few times a year, but are
+merged on a daily business day grid. The compact form only keeps the (date, ticker, value) change points,
+including a change to NaN, so that the dense grid can be restored exactly.
+'''
+
+import numpy as np
+import pandas as pd
+from datamanager.storage import atomic_write
+
+STEPS_EXT = '.steps.csv'
+
+class StepField(object):
+    '''
+    A step-like field stored as change points on a business day grid, the dense view is expanded lazily
+    '''
+
+    def __init__(self, compact, index, columns):
+        '''
+        Parameters
+        ----------
+        compact : pandas.DataFrame
+            The change points with a date, ticker and value column in date order
+
+        index : pandas.DatetimeIndex
+            The dates of the dense grid
+
+        columns : list
+            The tickers of the dense grid
+        '''
+
+        self.compact = compact
+        self.index = pd.DatetimeIndex(index)
+        self.columns = pd.Index(columns)
+        self._dense = None
+
+    @classmethod
+    def encode(cls, data):
+        '''
+        Encode a dense dates x tickers DataFrame to its change points
+        '''
+
+        v = data.values.astype(float)
+        prev = np.empty_like(v)
+        prev[0] = np.nan
+        prev[1:] = v[:-1]
+
+        same = (v == prev) | (np.isnan(v) & np.isnan(prev))
+        rows, cols = np.nonzero(~same)
+
+        compact = pd.DataFrame({'date': data.index.values[rows],
+                                'ticker': np.asarray(data.columns)[cols],
+                                'value': v[rows, cols]},
+                               columns = ['date', 'ticker', 'value'])
+
+        return cls(compact, data.index, data.columns)
+
+    def _positions(self):
+        rows = self.index.get_indexer(pd.DatetimeIndex(self.compact['date']))
+        cols = self.columns.get_indexer(self.compact['ticker'])
+        return rows, cols
+
+    def decode(self, tickers = None):
+        '''
+        Expand the change points to a dense dates x tickers DataFrame
+
+        Parameters
+        ----------
+        tickers : list
+            Only expand these tickers (optional)
+        '''
+
+        columns = self.columns if tickers is None else pd.Index(tickers)
+        rows = self.index.get_indexer(pd.DatetimeIndex(self.compact['date']))
+        cols = columns.get_indexer(self.compact['ticker'])
+        keep = (rows >= 0) & (cols >= 0)
+
+        # number every change point and carry the number of the last change forward down each column
+        last = np.empty((len(self.index), len(columns)), dtype = np.int64)
+        last[:] = -1
+        last[rows[keep], cols[keep]] = np.nonzero(keep)[0]
+        last = np.maximum.accumulate(last, axis = 0)
+
+        values = np.append(self.compact['value'].values.astype(float), np.nan)
+        dense = values[last]
+
+        return pd.DataFrame(dense, index = self.index, columns = columns)
+
+    def select(self, tickers):
+        '''
+        The change points of a subset of the tickers
+        '''
+
+        keep = self.compact['ticker'].isin(list(tickers)).values
+        return StepField(self.compact[keep].reset_index(drop = True), self.index, tickers)
+
+    @property
+    def dense(self):
+        '''
+        The lazily expanded and cached dense view of the field
+        '''
+
+        if self._dense is None:
+            self._dense = self.decode()
+
+        return self._dense
+
+    def events(self):
+        '''
+        The valid change points as (column positions, dates, values, last observed dates) arrays, see
+        transforms.asof_gather. A value is observed on every day of its run, up to the day before the next change
+        point of its ticker or the end of the grid.
+        '''
+
+        valid = self.compact['value'].notnull().values
+        rows, cols = self._positions()
+
+        order = np.lexsort((rows, cols))
+        last = np.empty(len(rows), dtype = np.int64)
+        last[:] = len(self.index) - 1
+        same = cols[order][1:] == cols[order][:-1]
+        last[order[:-1][same]] = rows[order][1:][same] - 1
+
+        return (cols[valid], self.index.values[rows[valid]], self.compact['value'].values[valid],
+                self.index.values[last[valid]])
+
+    def to_csv(self, filepath):
+        '''
+        Write the change points, the first line holds the dense grid: start date, end date and the tickers
+        '''
+
+        if not self.index.equals(pd.bdate_range(self.index[0], self.index[-1])):
+            raise ValueError('Only fields on a business day grid can be stored as change points')
+
+        with atomic_write(filepath) as f:
+            header = [str(self.index[0].date()), str(self.index[-1].date())] + [str(t) for t in self.columns]
+            f.write('#' + ','.join(header) + '\n')
+            self.compact.to_csv(f, index = False)
+
+    @classmethod
+    def read_csv(cls, filepath):
+        '''
+        Read change points written by to_csv, from a file path or an open file
+        '''
+
+        if hasattr(filepath, 'readline'):
+            header = filepath.readline().lstrip('#').rstrip('\n').split(',')
+            compact = pd.read_csv(filepath, sep = ',', header = 0, parse_dates = ['date'])
+        else:
+            with open(filepath, 'r') as f:
+                header = f.readline().lstrip('#').rstrip('\n').split(',')
+                compact = pd.read_csv(f, sep = ',', header = 0, parse_dates = ['date'])
+
+        index = pd.bdate_range(header[0], header[1])
+        return cls(compact, index, header[2:])
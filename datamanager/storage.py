@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''
+Atomic writes and checksum manifests of the data directories
+
+Every output is written to a temporary file next to it and renamed over the output when it is complete, so an
+interrupted task never leaves a half written file behind. A manifest in every directory records the checksum, size
+and modification time of the completed outputs. The promotion of the merged data to the master data compares the
+manifests and copies only the files that changed, every file again with a temporary file and a rename.
+'''
+
+from os import path, listdir, remove, replace, stat
+from contextlib import contextmanager
+import shutil
+import pandas as pd
+from datamanager.utils import file_digest
+
+MANIFEST = 'manifest.csv'
+TMP_EXT = '.tmp'
+
+@contextmanager
+def atomic_write(filepath, mode = 'w'):
+    '''
+    Open a temporary file to write an output to, the temporary file replaces the output when the block completes
+    and is removed if it fails
+    '''
+
+    tmp = filepath + TMP_EXT
+    f = open(tmp, mode)
+    try:
+        yield f
+    except BaseException:
+        f.close()
+        remove(tmp)
+        raise
+
+    f.close()
+    replace(tmp, filepath)
+
+def to_csv(data, filepath, **kwargs):
+    '''
+    Write a DataFrame to a csv file atomically, the keyword arguments are passed to DataFrame.to_csv
+    '''
+
+    with atomic_write(filepath) as f:
+        data.to_csv(f, **kwargs)
+
+def read_manifest(dirpath):
+    '''
+    The manifest of a directory: the digest, size and modification time of every recorded file, indexed by file name
+    '''
+
+    filepath = path.join(dirpath, MANIFEST)
+    if not path.isfile(filepath):
+        return pd.DataFrame(columns = ['digest', 'size', 'mtime'], index = pd.Index([], name = 'file'))
+
+    return pd.read_csv(filepath, sep = ',', index_col = 0, dtype = {'digest': str})
+
+def write_manifest(dirpath, manifest):
+    manifest.index.name = 'file'
+    to_csv(manifest.sort_index(), path.join(dirpath, MANIFEST), float_format = '%.6f')
+
+def _entry(filepath, manifest):
+    '''
+    The manifest entry of a file, the recorded digest is reused as long as the size and modification time match
+    '''
+
+    st = stat(filepath)
+    name = path.basename(filepath)
+    mtime = round(st.st_mtime, 6)
+
+    if name in manifest.index:
+        known = manifest.loc[name]
+        if known['size'] == st.st_size and abs(known['mtime'] - mtime) < 1e-6:
+            return known['digest'], st.st_size, mtime
+
+    return file_digest(filepath), st.st_size, mtime
+
+def _update(dirpath, manifest, names):
+    entries = [_entry(path.join(dirpath, n), manifest) for n in names]
+    update = pd.DataFrame(entries, index = names, columns = ['digest', 'size', 'mtime'])
+
+    manifest = manifest[~manifest.index.isin(names)]
+    return pd.concat([manifest, update])
+
+def record(filepaths):
+    '''
+    Record the checksums of completed outputs in the manifests of their directories
+    '''
+
+    dirs = {}
+    for f in filepaths:
+        dirs.setdefault(path.dirname(path.abspath(f)), []).append(path.basename(f))
+
+    for dirpath in dirs:
+        names = [n for n in dirs[dirpath] if path.isfile(path.join(dirpath, n))]
+        write_manifest(dirpath, _update(dirpath, read_manifest(dirpath), names))
+
+def data_files(dirpath):
+    '''
+    The data files in a directory, excluding the manifest and temporary files
+    '''
+
+    return sorted(f for f in listdir(dirpath)
+                  if path.isfile(path.join(dirpath, f)) and f != MANIFEST and not f.endswith(TMP_EXT))
+
+def promote(src, dst):
+    '''
+    Copy the files of a directory that differ from the files in another directory, e.g. the merged data to the
+    master data. Every file is copied to a temporary file and renamed, and the manifests of both directories are
+    updated, so an interrupted promotion is resumed by promoting again.
+
+    Return
+    ------
+    changed : list
+        The names of the files that were copied
+    '''
+
+    src_manifest = _update(src, read_manifest(src), data_files(src))
+    write_manifest(src, src_manifest)
+
+    dst_manifest = read_manifest(dst)
+    dst_manifest = _update(dst, dst_manifest, [f for f in data_files(dst) if f in src_manifest.index])
+
+    changed = [f for f in src_manifest.index
+               if f not in dst_manifest.index or dst_manifest.loc[f, 'digest'] != src_manifest.loc[f, 'digest']]
+
+    for f in changed:
+        tmp = path.join(dst, f + TMP_EXT)
+        shutil.copyfile(path.join(src, f), tmp)
+        replace(tmp, path.join(dst, f))
+
+    write_manifest(dst, _update(dst, dst_manifest, changed))
+    return changed
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''
+Chunked streaming versions of the time local transforms
+
+The daily data is read in date ordered chunks and passed through a pipeline of generators. Each stage only
+carries the small boundary state it needs between chunks (the partial month for resampling, the previous
+prices for returns and momentum), so the memory use is bounded by the chunk size and not the history length.
+'''
+
+import numpy as np
+import pandas as pd
+import datamanager.transforms as transf
+from contextlib import ExitStack
+from datamanager.storage import atomic_write
+
+# default number of rows per chunk
+CHUNKSIZE = 2500
+
+def read_chunks(filepath, chunksize = CHUNKSIZE):
+    '''
+    Read a dates x tickers csv file in date ordered chunks
+
+    Parameters
+    ----------
+    filepath : str
+        The file to read, the dates should be sorted
+
+    chunksize : int
+        The number of rows per chunk
+
+    Returns
+    -------
+    chunks : generator of pandas.DataFrame
+    '''
+
+    reader = pd.read_csv(filepath, sep = ',', header = 0, index_col = 0, parse_dates = True, chunksize = chunksize)
+    for chunk in reader:
+        yield chunk
+
+def resample_monthly(chunks, how = 'last'):
+    '''
+    Resample a stream of daily chunks to a monthly frequency, the rows of the last (possibly partial) month
+    of a chunk are carried over to the next chunk
+
+    Returns
+    -------
+    monthly : generator of pandas.DataFrame
+    '''
+
+    carry = None
+    last_month = None
+
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+
+        if len(chunk.index) == 0:
+            continue
+
+        months = chunk.index.to_period('M')
+        complete = np.asarray(months != months[-1])
+        carry = chunk[~complete]
+
+        if complete.any():
+            out = transf.resample_monthly(chunk[complete], how = how)
+            out, last_month = _continue_months(out, last_month)
+            yield out
+
+    if carry is not None and len(carry.index) > 0:
+        out = transf.resample_monthly(carry, how = how)
+        out, last_month = _continue_months(out, last_month)
+        yield out
+
+def _continue_months(out, last_month):
+    '''
+    Make sure months without any data between two chunks are not dropped
+    '''
+
+    if last_month is not None:
+        out = out.reindex(pd.date_range(last_month, out.index[-1], freq = 'M')[1:])
+
+    return out, out.index[-1]
+
+def log_returns(chunks):
+    '''
+    Calculate the trading day log returns of a stream of price chunks, carrying the last prices between chunks
+
+    Returns
+    -------
+    returns : generator of pandas.DataFrame
+    '''
+
+    prev = None
+    for chunk in chunks:
+        logp = np.log(chunk)
+        ret = logp - logp.shift(1)
+
+        if prev is not None and len(ret.index) > 0:
+            ret.iloc[0] = logp.iloc[0] - prev
+
+        if len(logp.index) > 0:
+            prev = logp.iloc[-1]
+
+        yield ret
+
+def momentum_monthly(chunks, start_lag, end_lag):
+    '''
+    Calculate the momentum from a stream of monthly price chunks, see transforms.momentum_monthly
+
+    Returns
+    -------
+    momentum : generator of pandas.DataFrame
+    '''
+
+    window = (start_lag, end_lag)
+    name = transf.horizon_name(window, 'M')
+    for mom in momentum_grid(chunks, [window], 'M'):
+        yield mom[name]
+
+def momentum_grid(chunks, grid, unit = 'M'):
+    '''
+    Calculate the momentum over a grid of (lookback, skip) pairs from a stream of price chunks, see
+    transforms.momentum_grid. The rows from the last max(lookback) trading days are carried between chunks.
+
+    Returns
+    -------
+    momentum : generator of dict
+        signal name -> momentum of the rows in the chunk
+    '''
+
+    lag = max(w[0] for w in grid)
+    carry = None
+
+    for chunk in chunks:
+        n = 0
+        if carry is not None:
+            n = len(carry.index)
+            chunk = pd.concat([carry, chunk])
+
+        mom = transf.momentum_grid(chunk, grid, unit)
+        yield dict((name, mom[name].iloc[n:]) for name in mom)
+
+        # the holidays are skipped by the windows, so the carry holds lag trading days
+        trading = np.flatnonzero(transf.trading_rows(chunk))
+        carry = chunk.iloc[trading[-lag] if len(trading) >= lag else 0:]
+
+def pead_momentum(announcement_chunks, close_chunks):
+    '''
+    Calculate the normalised post earnings announcement momentum from streams of announcement and price chunks
+    with the same dates, see transforms.pead_momentum. The last announcement and its price are carried between chunks.
+
+    Returns
+    -------
+    momentum : generator of pandas.DataFrame
+    '''
+
+    state = None
+    for ann, close in zip(announcement_chunks, close_chunks):
+        assert ann.index.equals(close.index)
+
+        mom, state = transf.pead_state(ann.reindex(columns = close.columns), close, state = state)
+        yield mom
+
+def to_csv(chunks, filepath):
+    '''
+    Write a stream of chunks to a single csv file as they arrive
+    '''
+
+    header = True
+    with atomic_write(filepath) as f:
+        for chunk in chunks:
+            chunk.sort_index(axis = 1).to_csv(f, header = header)
+            header = False
+
+def to_csvs(streams, filepaths):
+    '''
+    Write several streams derived from the same input to their csv files, the streams are advanced in turn so that
+    the shared input chunks are only buffered while the streams are apart
+    '''
+
+    with ExitStack() as stack:
+        files = [stack.enter_context(atomic_write(f)) for f in filepaths]
+        header = [True] * len(files)
+        active = list(range(len(files)))
+
+        while active:
+            for i in list(active):
+                try:
+                    chunk = next(streams[i])
+                except StopIteration:
+                    active.remove(i)
+                    continue
+
+                chunk.sort_index(axis = 1).to_csv(files[i], header = header[i])
+                header[i] = False
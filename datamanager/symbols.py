@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent integer symbol table of the tickers
+
+Every ticker gets a stable integer id the first time it is seen, ids are only ever appended and never reused, also
+after a delisting. The ids are only used by the merge: the columns of every frame are mapped to ids with one
+vectorized index lookup and the values are copied with integer array indexing. The storage, the loaders and the
+transforms still align on the ticker labels.
+'''
+
+import threading
+import numpy as np
+import pandas as pd
+from os import path
+from datamanager.storage import to_csv
+
+SYMBOLS_FILE = 'symbols.csv'
+
+class SymbolTable(object):
+    '''
+    The ticker of every id, the id is the position of the ticker in the table
+    '''
+
+    def __init__(self, tickers = ()):
+        self._index = pd.Index([str(t) for t in tickers], dtype = object)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def tickers(self):
+        return list(self._index)
+
+    def add(self, tickers):
+        '''
+        Assign ids to the tickers that are not in the table yet, in the order given
+        '''
+
+        labels = pd.Index(tickers, dtype = object).astype(str)
+        with self._lock:
+            new = labels[self._index.get_indexer(labels) < 0].drop_duplicates()
+            if len(new) > 0:
+                self._index = self._index.append(new)
+
+    def ids(self, tickers, add = False):
+        '''
+        The ids of the tickers, -1 for unknown tickers unless they are added
+
+        Return
+        ------
+        ids : numpy.ndarray of int64
+        '''
+
+        labels = pd.Index(tickers, dtype = object).astype(str)
+        if add:
+            self.add(labels)
+
+        return self._index.get_indexer(labels).astype(np.int64)
+
+    def labels(self, ids):
+        '''
+        The tickers of the ids
+        '''
+
+        return self._index.values[np.asarray(ids, dtype = np.int64)]
+
+    def positions(self, ids, within):
+        '''
+        The positions of ids in another array of ids, -1 where they are not in it
+        '''
+
+        ids = np.asarray(ids, dtype = np.int64)
+        within = np.asarray(within, dtype = np.int64)
+
+        lookup = np.empty(max(len(self._index), ids.max() + 1 if len(ids) else 0,
+                              within.max() + 1 if len(within) else 0), dtype = np.int64)
+        lookup[:] = -1
+        lookup[within] = np.arange(len(within))
+
+        pos = np.empty(len(ids), dtype = np.int64)
+        pos[:] = -1
+        known = ids >= 0
+        pos[known] = lookup[ids[known]]
+        return pos
+
+    def to_frame(self):
+        return pd.DataFrame({'ticker': self._index.values}, index = pd.Index(np.arange(len(self._index)), name = 'id'))
+
+    @classmethod
+    def from_frame(cls, frame):
+        frame = frame.sort_index()
+        if not (frame.index.values == np.arange(len(frame.index))).all():
+            raise ValueError('The symbol ids are not consecutive')
+
+        return cls(frame['ticker'].values)
+
+    def to_csv(self, filepath):
+        to_csv(self.to_frame(), filepath)
+
+def load_symbols(fpath):
+    '''
+    Load the symbol table of a data directory, an empty table if it has none
+    '''
+
+    filepath = path.join(fpath, SYMBOLS_FILE)
+    if not path.isfile(filepath):
+        return SymbolTable()
+
+    return SymbolTable.from_frame(pd.read_csv(filepath, sep = ',', index_col = 0, dtype = {'ticker': str},
+                                              keep_default_na = False))
+
+def update(values, index, ids, data, table):
+    '''
+    Overwrite a dates x ids array with the non NaN values of a DataFrame, like DataFrame.update but aligned on the
+    integer ids of the tickers
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The dates x tickers values that are updated in place
+
+    index : pandas.DatetimeIndex
+        The dates of the rows of values
+
+    ids : numpy.ndarray
+        The ids of the columns of values
+
+    data : pandas.DataFrame
+        The dates x tickers update, tickers that are not in ids and dates that are not in index are ignored
+
+    table : SymbolTable
+        The symbol table
+    '''
+
+    rows = index.get_indexer(data.index)
+    cols = table.positions(table.ids(data.columns, add = True), ids)
+    keep_rows = rows >= 0
+    keep_cols = cols >= 0
+
+    # the frame is converted before taking its values, the nullable integer fields hold NA and not NaN
+    new = data.iloc[keep_rows, keep_cols].astype(values.dtype).values
+    at = np.ix_(rows[keep_rows], cols[keep_cols])
+    values[at] = np.where(np.isnan(new), values[at], new)
@@ -3,21 +3,281 @@ import numpy as np
 from functools import partial
 from os import path
 from datamanager.envs import MASTER_DATA_PATH
+from datamanager.steps import StepField
+from datamanager.profiling import instrument
 
 '''
 This module contains equity indicator and transformation functions for time series data based on pandas DataFrame's
 '''
 
-def calc_booktomarket(close, bookvalue):
+# the maximum number of calendar days a fundamental value stays valid after it was made known
+FUNDAMENTAL_STALENESS = {'Book Value per Share': 450,
+                         'DY': 10,
+                         'EY': 10,
+                         'PE': 10}
+
+# the number of columns of a dense grid of updates gathered at a time by asof_join
+ASOF_BLOCK_COLUMNS = 64
+
+def asof_gather(cols, event_dates, values, ncols, dates, max_staleness = None, observed = None):
+    '''
+    Find the most recent event value of every column on or before each of the dates
+
+    The events are sorted by column and date, and the last event of every date is found with one binary search
+    per column that is written straight into the output, so only a few arrays of the length of the dates are held
+    next to the output.
+
+    Parameters
+    ----------
+    cols : numpy.ndarray
+        The column position of every event
+
+    event_dates : numpy.ndarray
+        The date (datetime64) of every event
+
+    values : numpy.ndarray
+        The value of every event
+
+    ncols : int
+        The number of columns of the output
+
+    dates : numpy.ndarray
+        The dates (datetime64) of the output rows
+
+    max_staleness : int
+        The maximum number of calendar days an event value stays valid, None for no limit
+
+    observed : numpy.ndarray
+        The last date (datetime64) every event value was observed, the age of a value is measured from its last
+        observation on or before each date. By default a value is only observed on its event date.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        The (dates x columns) event values, NaN where there is no valid event
+    '''
+
+    event_days = np.asarray(event_dates).astype('datetime64[D]').astype(np.int64)
+    observed_days = event_days if observed is None else np.asarray(observed).astype('datetime64[D]').astype(np.int64)
+    days = np.asarray(dates).astype('datetime64[D]').astype(np.int64)
+    cols = np.asarray(cols, dtype = np.int64)
+    out = np.empty((len(days), ncols))
+    out[:] = np.nan
+
+    if len(event_days) == 0 or len(days) == 0:
+        return out
+
+    # a stable sort, the last of several events of a column on the same date wins
+    order = np.lexsort((event_days, cols))
+    cols = cols[order]
+    event_days = event_days[order]
+    observed_days = observed_days[order]
+    values = np.asarray(values, dtype = float)[order]
+
+    bounds = np.searchsorted(cols, np.arange(ncols + 1))
+    for j in range(ncols):
+        lo, hi = bounds[j], bounds[j + 1]
+        if lo == hi:
+            continue
+
+        pos = np.searchsorted(event_days[lo:hi], days, side = 'right') - 1
+        found = pos >= 0
+        pos[~found] = 0
+        pos += lo
+
+        if max_staleness is not None:
+            found &= (days - np.minimum(days, observed_days[pos])) <= max_staleness
+
+        out[found, j] = values[pos[found]]
+
+    return out
+
+def asof_join(events, dates, max_staleness = None):
+    '''
+    Align sparse updates of a field to a set of dates, every date gets the most recently known value as long as
+    it is not older than max_staleness calendar days
+
+    Parameters
+    ----------
+    events : pandas.DataFrame or datamanager.steps.StepField
+        The updates (dates x tickers), NaN where a ticker has no update on a date, or a step-like field in its
+        compact change point form
+
+    dates : pandas.DatetimeIndex
+        The dates to align to, typically the index of the closing prices
+
+    max_staleness : int
+        The maximum age in calendar days of a value, None for no limit
+
+    Returns
+    -------
+    aligned : pandas.DataFrame
+        The values (dates x tickers) known on each date
+    '''
+
+    observed = None
+    days = pd.DatetimeIndex(dates).values
+
+    if isinstance(events, StepField):
+        # the change points are the updates, there is no need to expand the field. A value is observed on every
+        # day of its run, so the staleness is measured from the end of the run and not from the change point.
+        cols, event_dates, values, observed = events.events()
+        out = asof_gather(cols, event_dates, values, len(events.columns), days, max_staleness, observed)
+    else:
+        # the updates of a dense grid are gathered a block of columns at a time to bound the event arrays
+        out = np.empty((len(days), len(events.columns)))
+        for start in range(0, len(events.columns), ASOF_BLOCK_COLUMNS):
+            grid = events.iloc[:, start:start + ASOF_BLOCK_COLUMNS].values.astype(float)
+            rows, cols = np.nonzero(np.isfinite(grid))
+            out[:, start:start + grid.shape[1]] = asof_gather(cols, events.index.values[rows], grid[rows, cols],
+                                                              grid.shape[1], days, max_staleness)
+
+    return pd.DataFrame(out, index = dates, columns = events.columns)
+
+def calc_booktomarket(close, bookvalue, max_staleness = FUNDAMENTAL_STALENESS['Book Value per Share']):
     '''
+    Calculate the Book-to-Market ratio
+
+    The book-value made known at a certain date is valid until the next book value is available, as long as it is
+    not older than max_staleness calendar days. The book value can be a dense DataFrame or the compact StepField.
     '''
     
-    # should forward fill - the book-value made known at a certain date is valid for the next year / or until the next book value is available
-    bookval = bookvalue.ffill()
+    bookval = asof_join(bookvalue, close.index, max_staleness)
     b2m = bookval / close
 
     return b2m
+
+def calc_fundamental_ratios(close, fundamentals, staleness = FUNDAMENTAL_STALENESS):
+    '''
+    Align the fundamental fields to the closing price dates and derive the price ratios from them
+
+    Parameters
+    ----------
+    close : pandas.DataFrame
+        The closing prices, their dates are the dates of the output
+
+    fundamentals : dict
+        Field name -> sparse field updates, any of 'DY', 'EY' and 'PE'
+
+    staleness : dict
+        Field name -> maximum age in calendar days
+
+    Returns
+    -------
+    ratios : dict
+        The point-in-time fields (named '<field>-PIT') and the Earnings-to-Price ratio derived from the PE
+    '''
+
+    ratios = {}
+    for f in fundamentals:
+        ratios[f + '-PIT'] = asof_join(fundamentals[f], close.index, staleness.get(f))
+
+    if 'PE' in fundamentals:
+        pe = ratios['PE-PIT']
+        ratios['Earnings-to-Price'] = (1.0 / pe).where(pe != 0)
+
+    return ratios
     
+def _universe(data, mask):
+    '''
+    Remove all the values outside the point-in-time universe mask
+    '''
+
+    if mask is None:
+        return data
+
+    mask = mask.reindex(index = data.index, columns = data.columns).fillna(False).astype(bool)
+    return data.where(mask)
+
+def cs_rank(data, mask = None):
+    '''
+    Calculate the cross-sectional percentile rank (0, 1] of every ticker on each date
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The factor values (dates x tickers)
+
+    mask : pandas.DataFrame
+        Boolean universe mask (dates x tickers), values outside the universe are not ranked
+
+    Returns
+    -------
+    ranks : pandas.DataFrame
+    '''
+
+    return _universe(data, mask).rank(axis = 1, pct = True)
+
+def cs_zscore(data, mask = None, limit = 3.0):
+    '''
+    Calculate the cross-sectional z-score of every ticker on each date after winsorizing the values on each
+    date at limit standard deviations from the mean
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The factor values (dates x tickers)
+
+    mask : pandas.DataFrame
+        Boolean universe mask (dates x tickers), values outside the universe are excluded
+
+    limit : float
+        The number of standard deviations to winsorize at
+
+    Returns
+    -------
+    zscores : pandas.DataFrame
+    '''
+
+    data = _universe(data, mask)
+
+    mean = data.mean(axis = 1)
+    std = data.std(axis = 1)
+    winsorized = data.clip(mean - limit * std, mean + limit * std, axis = 0)
+
+    zscores = winsorized.sub(winsorized.mean(axis = 1), axis = 0).div(winsorized.std(axis = 1), axis = 0)
+    return zscores
+
+def cs_quantiles(data, n = 5, mask = None):
+    '''
+    Assign every ticker on each date to one of n cross-sectional quantile buckets, 1 holds the lowest values and n the highest
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The factor values (dates x tickers)
+
+    n : int
+        The number of quantiles
+
+    mask : pandas.DataFrame
+        Boolean universe mask (dates x tickers), values outside the universe are not assigned
+
+    Returns
+    -------
+    buckets : pandas.DataFrame
+    '''
+
+    ranks = cs_rank(data, mask)
+    return np.ceil(ranks * n)
+
+def cross_section(data, mask = None, n = 5, limit = 3.0):
+    '''
+    Calculate the cross-sectional ranks, winsorized z-scores and quantile buckets of a factor
+
+    Returns
+    -------
+    out : dict
+        The 'Rank', 'ZScore' and 'Quantile' DataFrames
+    '''
+
+    data = _universe(data, mask)
+    ranks = cs_rank(data)
+
+    return {'Rank': ranks,
+            'ZScore': cs_zscore(data, limit = limit),
+            'Quantile': np.ceil(ranks * n)}
+
 def detrended_oscillator(close):
     '''
     Calculate the detrended oscillator
@@ -46,6 +306,12 @@ def resample_monthly(data, how = 'last'):
        return data.resample('M').sum()
     elif(how == 'mean'):
         return data.resample('M').mean()
+    elif(how == 'first'):
+        return data.resample('M').first()
+    elif(how == 'max'):
+        return data.resample('M').max()
+    elif(how == 'min'):
+        return data.resample('M').min()
 
     return data.resample('M').last()
 
@@ -89,19 +355,72 @@ def momentum_monthly(close, start_lag, end_lag):
     
     '''
     
-    assert close.index.freq == "M"
-    
-    # shift dates to align and calculate momentum
-    mom = np.log(close.shift(end_lag)) - np.log(close.shift(start_lag))
-
-    return mom
+    # the lags are in rows, so every row should be a month
+    window = (start_lag, end_lag)
+    return momentum_grid(close, [window], unit = 'M')[horizon_name(window, 'M')]
     
 def earnings_momentum(ey, close, start_lag, end_lag):
     '''
     Calculate the momentum in the fundamental earnings of the company derived from the EY and the closing price
     '''
     
-def pead_momentum(announcements, close):
+def pead_state(announcements, close, logp = None, state = None):
+    '''
+    Calculate the normalised post earnings announcement momentum of a block of rows, carrying the state of the
+    previous block (see pead_momentum)
+
+    Parameters
+    -----------
+    announcements : pandas.DataFrame
+
+    close : pandas.DataFrame
+
+    logp : pandas.DataFrame
+        The log of the closing prices if already calculated (optional)
+
+    state : tuple
+        The state returned for the previous block of rows, None for the first block
+
+    Returns
+    -----------
+    norm_mom : pandas.DataFrame
+
+    state : tuple
+        The number of rows processed, the row of the last announcement and the log price on that announcement
+    '''
+
+    assert len(announcements.index) == len(close.index)
+    assert len(announcements.columns) == len(close.columns)
+
+    if logp is None:
+        logp = np.log(close.astype(float))
+
+    T, N = close.shape
+    offset, prev_ann, prev_logp = state if state is not None else (0, np.empty(N) * np.nan, np.empty(N) * np.nan)
+
+    ann = announcements.notnull().values
+    c = close.values
+    lp = logp.values
+    rows = np.arange(T)[:, np.newaxis]
+    cols = np.arange(N)[np.newaxis, :]
+
+    # days since the last announcement, counting from the start of the data before the first announcement
+    last_ann = np.where(ann, rows + offset, -1).astype(float)
+    last_ann[0] = np.fmax(last_ann[0], np.where(np.isnan(prev_ann), -1, prev_ann))
+    last_ann = np.maximum.accumulate(last_ann, axis = 0)
+    days_since = np.where(last_ann >= 0, rows + offset - last_ann + 1, rows + offset + 1)
+
+    # log price on the last announcement day that has a price
+    priced = ann & np.isfinite(c) & (c != 0)
+    last_priced = np.maximum.accumulate(np.where(priced, rows, -1), axis = 0)
+    last_ann_logp = np.where(last_priced >= 0, lp[np.maximum(last_priced, 0), cols], prev_logp[np.newaxis, :])
+
+    norm_mom = (lp - last_ann_logp) * (252.0 / days_since)
+    state = (offset + T, last_ann[-1] if T > 0 else prev_ann, last_ann_logp[-1] if T > 0 else prev_logp)
+
+    return pd.DataFrame(norm_mom, index = close.index, columns = close.columns), state
+
+def pead_momentum(announcements, close, logp = None):
     '''
     Calculate the price momentum from the most recent earnings announcement normalised to annualised returns
         
@@ -110,46 +429,16 @@ def pead_momentum(announcements, close):
     announcements : pandas.DataFraem
         
     close : pandas.DataFrame
+
+    logp : pandas.DataFrame
+        The log of the closing prices if already calculated (optional)
     
     Returns
     -----------
     
     '''
-    assert len(announcements.index) == len(close.index)
-    assert len(announcements.columns) == len(close.columns)
-
-    # make 1 at every earnings announcement
-    anndays = announcements.applymap(lambda x: 0 if np.isnan(x) else 1)
-    ann_data = anndays.as_matrix()
-
-    last_ann_price = close * anndays
-    last_ann_price = last_ann_price.applymap(lambda x: np.NaN if x == 0 else x)
-    last_ann_price = last_ann_price.ffill()
-
-    # convert this to util function taking a predicate
-    days_since_data = np.ndarray([len(anndays.index), len(anndays.columns)])
-    col = 0
-
-    ann_data = anndays.as_matrix()
-    for ticker in anndays.columns:
-        days_since = 0
-        row = 0
-        for day in anndays.index:
-            if (ann_data[row, col] == 1):
-                days_since = 1.0
-            else:
-                days_since += 1.0
-            
-            days_since_data[row, col] = days_since
-            row += 1
-        col += 1
-    
-    # calculate returns
-    dsdf = pd.DataFrame(days_since_data, index = anndays.index, columns = anndays.columns)
-
-    norm_factor = 252.0 / dsdf
-    norm_mom = (np.log(close) - np.log(last_ann_price)) * norm_factor
 
+    norm_mom, _ = pead_state(announcements, close, logp)
     return norm_mom
 
 def earnings_surprise(announcements, close):
@@ -190,8 +479,175 @@ def earnings_surprise_change_momentum(announcements, close):
     Calculate the price momentum since the most recent earnings surprise change normalised to annualised returns
     '''
 
+# trading day horizons of the multi-horizon returns
+RETURN_HORIZONS = [1, 5, 21, 63, 252]
+
+def horizon_name(window, unit = 'D'):
+    '''
+    The name of a return horizon: '21D' for 21 days or '252D-21D' for a 252 day lookback skipping the last 21 days
+    '''
+
+    if isinstance(window, tuple):
+        lookback, skip = window
+        if skip == 0:
+            return str(lookback) + unit
+        return str(lookback) + unit + '-' + str(skip) + unit
+
+    return str(window) + unit
+
+def window_returns(logp, windows):
+    '''
+    Calculate the log returns over several (lookback, skip) windows as differences of one log price matrix
+
+    Parameters
+    ----------
+    logp : numpy.ndarray
+        The log prices (rows x tickers)
+
+    windows : list
+        (lookback, skip) pairs in rows, the return from row t - lookback to row t - skip
+
+    Returns
+    -------
+    returns : list of numpy.ndarray
+        The returns of each window
+    '''
+
+    T = logp.shape[0]
+    out = []
+    for lookback, skip in windows:
+        assert lookback > skip >= 0
+
+        ret = np.empty_like(logp)
+        ret[:] = np.nan
+        if lookback < T:
+            ret[lookback:] = logp[lookback - skip:T - skip] - logp[:T - lookback]
+        out.append(ret)
+
+    return out
+
+def trading_rows(data, trading = None):
+    '''
+    The boolean mask of the rows that are trading days: the rows of the trading days given, or the rows on which any
+    column has a value. The holidays of the business day grid are NaN for the whole market.
+    '''
+
+    if trading is not None:
+        return np.asarray(data.index.isin(trading))
+
+    return np.asarray(data.notnull().any(axis = 1))
+
+def windowed_log_returns(logp, windows, unit = 'D', trading = None):
+    '''
+    Calculate the log returns over several (lookback, skip) windows from log prices that are already calculated
+
+    The windows count the trading days only, the other rows (holidays) are skipped and are NaN in the returns.
+
+    Parameters
+    ----------
+    logp : pandas.DataFrame
+        The log prices (dates x tickers)
+
+    windows : list
+        (lookback, skip) pairs in rows
+
+    unit : str
+        The unit of the rows used to name the windows
+
+    trading : pandas.DatetimeIndex
+        The trading days, defaults to the dates on which any ticker has a price. A block of tickers passes the
+        trading days of the whole market.
+
+    Returns
+    -------
+    returns : dict
+        window name (see horizon_name) -> log returns (dates x tickers)
+    '''
+
+    rows = trading_rows(logp, trading)
+
+    out = {}
+    for w, r in zip(windows, window_returns(logp.values[rows], windows)):
+        ret = np.empty(logp.shape)
+        ret[:] = np.nan
+        ret[rows] = r
+        out[horizon_name(w, unit)] = pd.DataFrame(ret, index = logp.index, columns = logp.columns)
+
+    return out
+
+def multi_horizon_returns(data, horizons = RETURN_HORIZONS, windows = None):
+    '''
+    Calculate trading day log returns over many horizons from a single log price pass
+
+    The returns are differences of the log price between trading days, not calendar days. The merged data is on a
+    business day grid, its holiday rows (NaN for every ticker) are skipped, so neither weekends nor holidays produce
+    gaps and 21D is 21 trading days.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The prices (dates x tickers)
+
+    horizons : list
+        The horizons in trading days
+
+    windows : list
+        Additional (lookback, skip) windows in trading days, e.g. (252, 21) for 12-1 momentum
+
+    Returns
+    -------
+    returns : dict
+        horizon name (see horizon_name) -> log returns (dates x tickers)
+    '''
+
+    windows = [(h, 0) for h in horizons] + list(windows or [])
+    return windowed_log_returns(np.log(data.astype(float)), windows)
+
+# (lookback, skip) pairs in months of the monthly momentum signals
+MOMENTUM_GRID = [(12, 1), (6, 1), (3, 1), (12, 0)]
+
+# (lookback, skip) pairs in trading days of the daily momentum signals
+DAILY_MOMENTUM_GRID = [(252, 21), (126, 21), (63, 5)]
+
+def momentum_grid(prices, grid = MOMENTUM_GRID, unit = 'M'):
+    '''
+    Calculate the momentum over a grid of (lookback, skip) pairs from one log price matrix
+
+    Parameters
+    ----------
+    prices : pandas.DataFrame
+        Monthly prices for monthly momentum, or daily prices for daily momentum (dates x tickers)
+
+    grid : list
+        (lookback, skip) pairs in rows (months or trading days), (12, 1) is the log return from 12 months ago
+        to 1 month ago
+
+    unit : str
+        The unit of the lookback and skip used to name the signals, 'M' or 'D'
+
+    Returns
+    -------
+    momentum : dict
+        signal name (e.g. '12M-1M') -> momentum (dates x tickers)
+    '''
+
+    return windowed_log_returns(np.log(prices.astype(float)), grid, unit)
+
+def signal_frame(signals):
+    '''
+    Combine several signals in a single DataFrame with (signal, ticker) columns
+    '''
+
+    names = sorted(signals.keys())
+    frame = pd.concat([signals[n] for n in names], axis = 1, keys = names)
+
+    # an index label keeps the two header rows apart from the data when written to csv
+    frame.index.name = 'Date'
+    return frame
+
 def log_returns(data):
     '''
+    Calculate the trading day log returns
 
     Parameters
     -----
@@ -200,12 +656,173 @@ def log_returns(data):
     :returns Pandas DataFrame
     '''
 
-    assert data.index.freq == "Day"
-    ret = np.log(data) - np.log(data.tshift(1))
-    return ret
+    return multi_horizon_returns(data, horizons = [1])['1D']
 
 def index_log_returns(price):
     
     logret = log_returns(price)
     logret.dropna(how = 'all', inplace=True)
-    return np.exp(logret.cumsum())*100
\ No newline at end of file
+    return np.exp(logret.cumsum())*100
+
+def _window_sums(x, window):
+    '''
+    The sums over the last window rows of every column of a matrix, from a single cumulative sum
+    '''
+
+    c = np.zeros((x.shape[0] + 1,) + x.shape[1:])
+    np.cumsum(x, axis = 0, out = c[1:])
+
+    sums = c[1:].copy()
+    sums[window:] -= c[1:-window]
+    return sums
+
+def rolling_regression(returns, index_returns, window = 252, min_periods = None):
+    '''
+    Calculate the rolling beta, correlation and idiosyncratic volatility of all tickers against one or more indices
+
+    The moments of every window are differences of the cumulative sums of the returns, their squares and their
+    products, so the cost is proportional to the number of tickers times the number of days and does not depend on
+    the window length. Only the days on which both the ticker and the index have a return are used.
+
+    Parameters
+    ----------
+    returns : pandas.DataFrame
+        The log returns of the equities (dates x tickers)
+
+    index_returns : pandas.DataFrame
+        The log returns of the indices (dates x indices)
+
+    window : int
+        The number of trading days in the window
+
+    min_periods : int
+        The minimum number of days with returns in the window, defaults to the window
+
+    Returns
+    -------
+    regression : dict
+        'Beta', 'Correlation' and 'Idiosyncratic-Volatility' -> index -> pandas.DataFrame (dates x tickers). The
+        idiosyncratic volatility is the daily standard deviation of the regression residuals.
+    '''
+
+    if min_periods is None:
+        min_periods = window
+
+    r = returns.values.astype(float)
+    out = {'Beta': {}, 'Correlation': {}, 'Idiosyncratic-Volatility': {}}
+
+    for name in index_returns.columns:
+        m = index_returns[name].reindex(returns.index).values.astype(float)[:, np.newaxis]
+
+        valid = np.isfinite(r) & np.isfinite(m)
+        x = np.where(valid, m, 0.0)
+        y = np.where(valid, r, 0.0)
+
+        n = _window_sums(valid.astype(float), window)
+        sx = _window_sums(x, window)
+        sy = _window_sums(y, window)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            # co-moments about the window means
+            cov = _window_sums(x * y, window) - sx * sy / n
+            vx = _window_sums(x * x, window) - sx * sx / n
+            vy = _window_sums(y * y, window) - sy * sy / n
+            vx[vx <= 0] = np.nan
+            vy[vy <= 0] = np.nan
+
+            beta = cov / vx
+            corr = cov / np.sqrt(vx * vy)
+            ivol = np.sqrt(np.maximum(vy - beta * cov, 0) / (n - 2))
+
+        few = n < max(min_periods, 3)
+        for stat, values in zip(['Beta', 'Correlation', 'Idiosyncratic-Volatility'], [beta, corr, ivol]):
+            values[few] = np.nan
+            out[stat][name] = pd.DataFrame(values, index = returns.index, columns = returns.columns)
+
+    return out
+
+def _float_values(data, index, columns):
+    # an input that is not available is all NaN
+    if data is None:
+        return np.full((len(index), len(columns)), np.nan)
+
+    # the nullable integer counts (Volume, Number Of Trades) are converted to float64 with NaN for missing values
+    return data.reindex(index = index, columns = columns).astype(float).values
+
+def liquidity(close, volume, trades, bid, offer, vwap, shares, price_scale = 0.01):
+    '''
+    Calculate the daily and monthly liquidity and spread metrics of all tickers in single vectorized passes over the
+    aligned matrices
+
+    Parameters
+    ----------
+    close, volume, trades, bid, offer, vwap, shares : pandas.DataFrame
+        The close, volume, number of trades, last bid, last offer, VWAP and total number of shares (dates x tickers),
+        all are aligned to the close. The number of trades is optional (None), without it a day with volume is a day
+        with trades.
+
+    price_scale : float
+        The rand value of one unit of the prices, the prices are in cents
+
+    Returns
+    -------
+    liquidity : dict
+        The daily (dates x tickers) and monthly (month ends x tickers) pandas.DataFrame of every metric:
+
+        - Amihud-Illiquidity: the absolute log return per million rand traded (at the VWAP, or the close if there is no
+          VWAP), monthly the average over the days with trades
+        - Relative-Spread: the quoted spread over the bid-offer midpoint, monthly the average
+        - Turnover: the volume over the total number of shares, monthly the sum
+        - Zero-Trade: 1 on the days a listed equity did not trade, monthly the fraction of zero trade days
+
+        The monthly metrics are named <metric>-monthly.
+    '''
+
+    index = close.index
+    columns = close.columns
+
+    p = close.values.astype(float)
+    v = _float_values(volume, index, columns)
+    n = _float_values(trades, index, columns)
+    b = _float_values(bid, index, columns)
+    o = _float_values(offer, index, columns)
+    w = _float_values(vwap, index, columns)
+    s = _float_values(shares, index, columns)
+
+    listed = np.isfinite(p)
+    traded = listed & (v > 0) & ~(n == 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r = np.empty_like(p)
+        r[0] = np.nan
+        r[1:] = np.abs(np.log(p[1:] / p[:-1]))
+
+        value = v * np.where(np.isfinite(w) & (w > 0), w, p) * price_scale
+        amihud = np.where(traded, r / value * 1e6, np.nan)
+
+        mid = (b + o) / 2
+        spread = np.where((b > 0) & (o >= b), (o - b) / mid, np.nan)
+
+        turnover = np.where(listed & (s > 0), np.where(np.isfinite(v), v, 0.0) / s, np.nan)
+
+    zero = np.where(listed, (~traded).astype(float), np.nan)
+
+    daily = {'Amihud-Illiquidity': amihud, 'Relative-Spread': spread, 'Turnover': turnover, 'Zero-Trade': zero}
+
+    out = {}
+    for name in daily:
+        out[name] = pd.DataFrame(daily[name], index = index, columns = columns)
+
+        if name == 'Turnover':
+            monthly = resample_monthly(out[name], how = 'sum')
+            days = resample_monthly(out[name].notnull().astype(float), how = 'sum')
+            monthly = monthly.where(days > 0)
+        else:
+            monthly = resample_monthly(out[name], how = 'mean')
+
+        out[name + '-monthly'] = monthly
+
+    return out
+
+# wrap the public functions when profiling is enabled, see datamanager.profiling
+instrument(globals(), __name__)
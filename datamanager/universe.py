@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+'''
+Point-in-time listing index of the equity universe
+
+Every ticker gets a single listing interval [start, end] built from the first and last valid observations
+in the merged data, refined by the listing_status and listing_date reference data fields. The intervals are
+kept sorted by start date so that universe queries are answered with a binary search instead of a scan of
+the full dates x tickers matrix.
+'''
+
+import numpy as np
+import pandas as pd
+
+# an open ended listing (a currently listed equity) never ends
+OPEN_END = np.datetime64('2262-04-11', 'D')
+
+def _to_day(date):
+    return np.datetime64(pd.Timestamp(date).date(), 'D')
+
+def first_last_valid(data):
+    '''
+    Find the first and last valid observation of every column in a dates x tickers DataFrame
+
+    Returns
+    -------
+    first, last : pandas.Series
+        The first and last valid dates per ticker (NaT if the ticker has no valid observations)
+    '''
+
+    valid = data.notnull().values
+    has_data = valid.any(axis=0)
+    dates = data.index.values.astype('datetime64[D]')
+
+    first = dates[valid.argmax(axis=0)].astype('datetime64[ns]')
+    last = dates[len(dates) - 1 - valid[::-1].argmax(axis=0)].astype('datetime64[ns]')
+    first[~has_data] = np.datetime64('NaT')
+    last[~has_data] = np.datetime64('NaT')
+
+    return pd.Series(first, index = data.columns), pd.Series(last, index = data.columns)
+
+class ListingIndex(object):
+    '''
+    Per ticker listing intervals with fast universe-at-date and universe-over-range queries
+    '''
+
+    def __init__(self, tickers, starts, ends, status = None):
+        '''
+        Parameters
+        ----------
+        tickers : list
+            The ticker of each interval
+
+        starts : array like
+            The first date the ticker was listed
+
+        ends : array like
+            The last date the ticker was listed, NaT for tickers that are still listed
+
+        status : array like
+            The listing status of each ticker (optional)
+        '''
+
+        starts = pd.to_datetime(pd.Series(list(starts))).values.astype('datetime64[D]')
+        ends = pd.to_datetime(pd.Series(list(ends))).values.astype('datetime64[D]')
+        ends = np.where(pd.isnull(ends), OPEN_END, ends)
+
+        if status is None:
+            status = [np.nan] * len(starts)
+
+        order = np.argsort(starts, kind='mergesort')
+        self.tickers = np.asarray(tickers, dtype=object)[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.status = np.asarray(status, dtype=object)[order]
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @classmethod
+    def from_data(cls, data, refdata = None):
+        '''
+        Build the listing index from the merged data of a field (typically Close) and the equity reference data
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Dates x tickers data, the first and last valid observation of each ticker defines its listing interval
+
+        refdata : pandas.DataFrame
+            Equity reference data indexed by ticker with a listing_status and listing_date column (optional).
+            An earlier listing_date extends the interval backwards and a CURRENT listing_status leaves it open ended.
+
+        Returns
+        -------
+        index : ListingIndex
+        '''
+
+        first, last = first_last_valid(data)
+        tickers = first.index[first.notnull()]
+        first = first[tickers]
+        last = last[tickers]
+        status = pd.Series(np.nan, index = tickers, dtype=object)
+
+        if refdata is not None:
+            ref = refdata.reindex(tickers)
+
+            if 'listing_date' in ref.columns:
+                listed = pd.to_datetime(ref['listing_date'], errors='coerce')
+                earlier = listed.notnull() & (listed < first)
+                first[earlier] = listed[earlier]
+
+            if 'listing_status' in ref.columns:
+                status = ref['listing_status']
+                current = (status == 'CURRENT').values
+                last[current] = pd.NaT
+
+        return cls(list(tickers), first.values, last.values, status.values)
+
+    @classmethod
+    def from_frame(cls, frame):
+        '''
+        Create the listing index from a DataFrame as written by to_frame
+        '''
+
+        status = frame['listing_status'].values if 'listing_status' in frame.columns else None
+        return cls(list(frame.index), frame['start'].values, frame['end'].values, status)
+
+    def to_frame(self):
+        '''
+        The listing intervals as a DataFrame indexed by ticker, with a NaT end for open ended listings
+        '''
+
+        ends = pd.Series(self.ends.astype('datetime64[ns]'))
+        ends[self.ends == OPEN_END] = pd.NaT
+
+        frame = pd.DataFrame({'start': self.starts.astype('datetime64[ns]'),
+                              'end': ends.values,
+                              'listing_status': self.status},
+                             index = pd.Index(self.tickers, name = 'ticker'),
+                             columns = ['start', 'end', 'listing_status'])
+        return frame
+
+    def universe(self, date):
+        '''
+        The tickers listed on a specific date
+        '''
+
+        d = _to_day(date)
+        # all intervals that started on or before the date
+        n = np.searchsorted(self.starts, d, side='right')
+        return list(self.tickers[:n][self.ends[:n] >= d])
+
+    def universe_between(self, start, end):
+        '''
+        The tickers listed at any time in the date range [start, end]
+        '''
+
+        s = _to_day(start)
+        e = _to_day(end)
+        n = np.searchsorted(self.starts, e, side='right')
+        return list(self.tickers[:n][self.ends[:n] >= s])
+
+    def mask(self, index, columns = None):
+        '''
+        Boolean dates x tickers membership mask, True where the ticker was listed on the date
+
+        Parameters
+        ----------
+        index : pandas.DatetimeIndex
+            The dates (rows) of the mask
+
+        columns : list
+            The tickers (columns) of the mask, defaults to all tickers in the index. Unknown tickers are never listed.
+        '''
+
+        if columns is None:
+            columns = self.tickers
+
+        pos = pd.Index(self.tickers).get_indexer(list(columns))
+        known = pos >= 0
+        starts = np.where(known, self.starts[pos], OPEN_END)
+        ends = np.where(known, self.ends[pos], OPEN_END)
+
+        dates = pd.DatetimeIndex(index).values.astype('datetime64[D]')[:, None]
+        listed = (dates >= starts[None, :]) & (dates <= ends[None, :]) & known[None, :]
+
+        return pd.DataFrame(listed, index = index, columns = columns)
@@ -4,7 +4,8 @@ Created on Fri Aug 15 14:37:02 2014
 
 @author: Niel
 """
-from os import path, listdir, remove
+from os import path, listdir, remove, replace
+import hashlib
 import pandas as pd
 import datetime as dt
 import calendar as cal
@@ -39,6 +40,44 @@ def date_days_ago(days=0):
 
     return str(tmpd.date())
 
+def file_digest(filepath, blocksize = 1 << 20):
+    '''
+    The md5 digest of the content of a file
+    '''
+
+    digest = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def replace_if_changed(tmppath, filepath):
+    '''
+    Move a newly written file over an existing file only if the content differs, so that an unchanged output keeps
+    its timestamp and is not seen as changed by the tasks that depend on it
+
+    Parameters
+    ----------
+    tmppath : str
+        The newly written file, it is removed or renamed
+
+    filepath : str
+        The output file
+
+    Return
+    ------
+    changed : bool
+        True if the output was replaced
+    '''
+
+    if path.isfile(filepath) and file_digest(filepath) == file_digest(tmppath):
+        remove(tmppath)
+        return False
+
+    replace(tmppath, filepath)
+    return True
+
 # helper functions    
 def clear_tempfiles(root):
     '''
@@ -4,14 +4,30 @@ import datetime as dt
 import calendar as cal
 import pandas as pd
 import string
+from doit.tools import config_changed
+import itertools
 import numpy as np
 
 from datamanager.envs import *
 from datamanager.load import *
-from datamanager.adjust import calc_adj_close
-from datamanager.utils import last_month_end
+from datamanager.adjust import calc_adjusted_prices
+from datamanager.universe import ListingIndex
+from datamanager.steps import StepField, STEPS_EXT
+from datamanager.dtypes import grid_dtype, as_field_dtype
+from datamanager.blocks import run_blocks
+from datamanager.indices import build_indices, default_memberships
+from datamanager.utils import last_month_end, replace_if_changed
 import datamanager.transforms as transf
-fields = marketdata_fields()
+import datamanager.stream as stream
+import datamanager.storage as storage
+import datamanager.snapshots as snapshots
+import datamanager.symbols as symbols
+import datamanager.provisional as prov
+import datamanager.schema as schema
+import datamanager.quality as quality
+# the fields are discovered from the headers of the downloads (cached by file signature), the known fields are used
+# if there are no downloads
+fields = get_marketdata_fields_from_files(DL_PATH) or marketdata_fields()
 
 # paths
 mergein_old = MASTER_DATA_PATH
@@ -20,7 +36,54 @@ mergein_new = CONVERT_PATH
 index_src_path = path.join(DL_PATH, 'Indices.xlsx')
 closepath = path.join(MERGED_PATH, "Close.csv")
 divpath = path.join(MERGED_PATH, "Dividend Ex Date.csv")
-bookvaluepath = path.join(MERGED_PATH, "Book Value per Share.csv")
+bookvaluepath = path.join(MERGED_PATH, "Book Value per Share" + STEPS_EXT)
+listingspath = path.join(MERGED_PATH, "Listings.csv")
+symbolspath = path.join(MERGED_PATH, symbols.SYMBOLS_FILE)
+refdatapath = path.join(MASTER_DATA_PATH, "jse_equities.csv")
+
+# factors that are ranked, scored and bucketed cross-sectionally, the multi-signal files hold several factors
+factors = ['Book-to-Market', 'Momentum', 'Daily-Momentum', 'Normalized-PEAD-Momentum']
+signal_files = ['Momentum', 'Daily-Momentum']
+quantiles = 5
+
+# trading day return horizons and (lookback, skip) windows
+return_horizons = [5, 21, 63, 252]
+return_windows = [(252, 21)]
+
+# the trading day windows derived from the daily close: the 1D log returns, the return horizons and the daily momentum
+return_names = dict((transf.horizon_name(w), 'Log-Returns-' + transf.horizon_name(w)) for w in [(h, 0) for h in return_horizons] + return_windows)
+return_names['1D'] = 'Log-Returns'
+daily_momentum_names = [transf.horizon_name(w) for w in transf.DAILY_MOMENTUM_GRID]
+close_windows = sorted(set([(1, 0)] + [(h, 0) for h in return_horizons] + return_windows + transf.DAILY_MOMENTUM_GRID))
+
+# the indices in Indices.csv the equities are regressed on: the FTSE/JSE All Share (J203) and Top 40 (J200)
+regression_indices = ['J203', 'J200']
+regression_window = 252
+regression_stats = ['Beta', 'Correlation', 'Idiosyncratic-Volatility']
+
+# the inputs of the liquidity metrics in the order of transforms.liquidity and the daily and monthly outputs
+liquidity_fields = ['Close', 'Volume', 'Number Of Trades', 'Last Bid', 'Last Offer', 'VWAP', 'Total Number Of Shares']
+# the number of trades is only in the master data if it is downloaded, the metrics are calculated without it otherwise
+liquidity_inputs = [f for f in liquidity_fields if f != 'Number Of Trades' or f in fields]
+liquidity_outputs = [m + p for m in ['Amihud-Illiquidity', 'Relative-Spread', 'Turnover', 'Zero-Trade'] for p in ['', '-monthly']]
+
+# the daily outputs that are recomputed for the provisional days of the daily refresh, and the number of master
+# trading days they look back
+provisional_outputs = ['Daily-Momentum'] + sorted(return_names.values()) + [m for m in liquidity_outputs if not m.endswith('-monthly')]
+provisional_lookback = max(w[0] for w in close_windows)
+
+# the outputs of the fused close derived stage
+close_outputs = ['Close-monthly', 'Momentum', 'Daily-Momentum', 'Normalized-PEAD-Momentum'] + sorted(return_names.values())
+
+def merged_target(fpath, field):
+    '''
+    The merged (and master) data of step-like fields is stored as change points
+    '''
+
+    if field in step_fields():
+        return path.join(fpath, field + STEPS_EXT)
+
+    return path.join(fpath, field + '.csv')
 
 def get_all_equities():
     new_all, _, _, _ = get_all_equities_from_data(MERGED_PATH, CONVERT_PATH, 'Close')
@@ -40,12 +103,51 @@ def convert_data(task):
     # drop all data for current month
     
     dropix = new_data.index[new_data.index.values.astype('datetime64[D]') > np.datetime64(last_month_end())]
-    new_data.drop(dropix).sort_index(axis = 1).to_csv(task.targets[0])
+    converted = as_field_dtype(new_data.drop(dropix), name)
+    storage.to_csv(converted.sort_index(axis = 1), task.targets[0])
+
+    # the new rows are checked in the same pass, the rows before them are only read for the scale of the returns
+    context = merged_tail(name, quality.CONTEXT_ROWS)
+    new_rows = converted[converted.index > context.index[-1]] if context is not None and len(context.index) else converted
+    storage.to_csv(quality.scan_field(new_rows, name, context), task.targets[1], index = False)
+
+def merged_tail(name, nrows):
+    filepath = path.join(MERGED_PATH, name + '.csv')
+    if name in step_fields() or not path.isfile(filepath):
+        return None
+
+    return prov.read_tail(filepath, nrows, name)
+
+def anomalies_file(name):
+    return path.join(CONVERT_PATH, name + '-anomalies.csv')
+
+def quality_report(dependencies, targets):
+    '''
+    Collect the anomalies of the converted fields, check the new market caps against close x shares and print a
+    summary of the anomalies
+    '''
+
+    reports = [quality.read_report(anomalies_file(f)) for f in fields if path.isfile(anomalies_file(f))]
+
+    inputs = ['Close', 'Total Number Of Shares', 'Market Cap']
+    if all(f in fields for f in inputs):
+        data = dict((f, load_ts(path.join(CONVERT_PATH, f + '.csv'))) for f in inputs)
+        context = merged_tail('Close', 1)
+        if context is not None and len(context.index):
+            data = dict((f, data[f][data[f].index > context.index[-1]]) for f in data)
+        reports.append(quality.scan_market_cap(data['Close'], data['Total Number Of Shares'], data['Market Cap']))
+
+    report = pd.concat(reports, ignore_index = True) if reports else quality.empty_report()
+    storage.to_csv(report.sort_values(['date', 'field', 'ticker']), targets[0], index = False)
+
+    counts = quality.summary(report)
+    for (field, check), n in counts.items():
+        print(field + ' ' + check + ': ' + str(n))
 
 def convert_indices(task):
     new_data = load_inetbfa_ts_data(index_src_path)
     dropix = new_data.index[new_data.index.values.astype('datetime64[D]') > np.datetime64(last_month_end())]
-    new_data.drop(dropix).sort_index(axis = 1).to_csv(task.targets[0])
+    storage.to_csv(new_data.drop(dropix).sort_index(axis = 1), task.targets[0])
 
 def merge_index(task): 
     new = load_ts(path.join(CONVERT_PATH, 'Indices.csv'))
@@ -55,117 +157,415 @@ def merge_index(task):
     merged.update(old)
     merged.update(new)
 
-    merged.sort_index(axis = 1).to_csv(task.targets[0])
+    storage.to_csv(merged.sort_index(axis = 1), task.targets[0])
+
+def master_end(filepath):
+    # the last date of a master file, from its header and last line only
+    if not path.isfile(filepath):
+        return None
+
+    return schema.read_schema(filepath).get('end')
+
+def refresh_provisional(task):
+    '''
+    Merge the days after the last month end of a download into the provisional rows of the field
+    '''
+
+    name = task.name.split(':')[1]
+    if name == 'Indices':
+        new_data = load_inetbfa_ts_data(index_src_path)
+        closed = path.join(MASTER_DATA_PATH, 'Indices.csv')
+    else:
+        new_data = as_field_dtype(load_inetbfa_ts_data(path.join(DL_PATH, name + '.xlsx')), name)
+        closed = field_file(MASTER_DATA_PATH, name)
+
+    _, new = prov.split_month(new_data, last_month_end())
+    merged = prov.merge_days(prov.load(name), new)
+
+    # the rows of the closed months are in the master data once the monthly update has run
+    merged = prov.prune(merged, master_end(closed))
+    storage.to_csv(merged.sort_index(axis = 1), task.targets[0])
+
+def provisional_derived(dependencies, targets):
+    '''
+    Recompute the daily derived outputs for the provisional days only, from the provisional rows and the tail of the
+    master data the windows look back on
+    '''
+
+    tail = prov.read_trading_tail(path.join(MASTER_DATA_PATH, 'Close.csv'), provisional_lookback, 'Close')
+    close = prov.extend(tail, prov.load('Close', PROVISIONAL_PATH))
+
+    windowed = transf.windowed_log_returns(np.log(close.astype(float)), close_windows)
+    out = {'Daily-Momentum': daily_momentum(windowed)}
+    for name in return_names:
+        out[return_names[name]] = windowed[name]
+
+    # the liquidity metrics only look back one day on the close, the number of trades is optional
+    out.update(transf.liquidity(close, *[prov.load(f, PROVISIONAL_PATH) for f in liquidity_fields[1:]]))
+
+    # the outputs are aligned to the close, the rows after the tail are the provisional days. The rows are selected
+    # by position so the Date label of the signal files is kept.
+    for name, target in zip(provisional_outputs, targets):
+        storage.to_csv(out[name].iloc[len(tail.index):].sort_index(axis = 1), target)
+
+def block_rows():
+    '''
+    The number of dates of the merged business day grid, used to size the ticker blocks
+    '''
+
+    return len(pd.bdate_range('1990-01-01', last_month_end()))
+
+def merge_frames(name, old, new, equities, table = None):
+    # the data is merged on a grid of the numpy dtype of the field and then converted to the dtype of the field
+    dtype = grid_dtype(name)
+    merged = empty_dataframe(equities, enddate = last_month_end(), dtype = dtype)
+
+    # the frames are aligned on the integer ids of the tickers
+    if table is None:
+        table = symbol_table()
+    ids = table.ids(merged.columns, add = True)
+
+    values = merged.values
+    if old is not None:
+        symbols.update(values, merged.index, ids, old, table)
+    symbols.update(values, merged.index, ids, new, table)
+
+    return pd.DataFrame(values, index = merged.index, columns = merged.columns)
 
 def merge_data(task): 
     
     name = task.name.split(':')[1]
+
+    # step-like fields are encoded as change points of the full grid and always merged in memory
+    table = symbol_table()
+    equities = sorted(get_all_equities())
+
+    # a newly downloaded field has no old data yet
+    has_old = path.isfile(field_file(mergein_old, name))
+
+    if MEMORY_LIMIT and name not in step_fields():
+        def merge(data, tickers):
+            return {task.targets[0]: as_field_dtype(merge_frames(name, data.get('old'), data['new'], tickers, table), name)}
+
+        inputs = {'new': (CONVERT_PATH, name)}
+        if has_old:
+            inputs['old'] = (mergein_old, name)
+        run_blocks(merge, inputs, task.targets, equities, block_rows())
+        return
+
     new = load_ts(path.join(CONVERT_PATH, name + '.csv'))
-    old = load_ts(path.join(MERGED_PATH, name + '.csv'))
-    
-    merged = empty_dataframe(get_all_equities(), enddate = last_month_end())
-    merged.update(old)
-    merged.update(new)
-          
-    merged.sort_index(axis = 1).to_csv(task.targets[0])
+    old = load_market_data(mergein_old, name) if has_old else None
+
+    merged = merge_frames(name, old, new, equities, table)
+
+    if name in step_fields():
+        StepField.encode(merged.sort_index(axis = 1)).to_csv(task.targets[0])
+    else:
+        storage.to_csv(as_field_dtype(merged, name).sort_index(axis = 1), task.targets[0])
+
+def symbol_table():
+    # the ids of the master data, new tickers get the next ids in the order of the equities and the ids of known
+    # tickers never change
+    table = symbols.load_symbols(mergein_old)
+    table.add(sorted(get_all_equities()))
+    return table
+
+def register_symbols(targets):
+    symbol_table().to_csv(targets[0])
+
+def build_listings(dependencies, targets):
+    close = load_field_ts(MERGED_PATH, field = "Close")
+
+    # the reference data refines the listing intervals if it is available
+    refdata = None
+    if path.isfile(refdatapath):
+        refdata = load_equities(MASTER_DATA_PATH)
+
+    listings = ListingIndex.from_data(close, refdata)
+    storage.to_csv(listings.to_frame(), targets[0])
+
+def custom_indices(dependencies, targets):
+    close = load_field_ts(MERGED_PATH, field = "Close")
+    adj_close = load_field_ts(MERGED_PATH, field = "Adjusted Close")
+    caps = load_field_ts(MERGED_PATH, field = "Market Cap")
+
+    listings = load_listings(MERGED_PATH)
+    universe = listings.mask(caps.index, caps.columns)
+
+    refdata = None
+    if path.isfile(refdatapath):
+        refdata = load_equities(MASTER_DATA_PATH)
+
+    masks = default_memberships(caps, universe, refdata)
+    levels, tr_levels = build_indices(masks, close, adj_close, caps, scheme = 'cap', freq = 'M')
+
+    storage.to_csv(levels.sort_index(axis = 1), targets[0])
+    storage.to_csv(tr_levels.sort_index(axis = 1), targets[1])
 
 def calc_adjusted_close(dependencies, targets):
     all_equities = get_all_equities()
 
-    # Import closing price data
-    close = load_field_ts(MERGED_PATH, field = "Close")
+    if MEMORY_LIMIT:
+        def adjust(data, tickers):
+            prices = dict((f, data[f]) for f in price_fields())
+            adjusted = calc_adjusted_prices(prices, data["Dividend Ex Date"], tickers, enddate = last_month_end())
+            return dict((path.join(MERGED_PATH, "Adjusted " + f + ".csv"), adjusted[f].sort_index(axis = 1)) for f in adjusted)
+
+        inputs = dict((f, (MERGED_PATH, f)) for f in price_fields() + ["Dividend Ex Date"])
+        run_blocks(adjust, inputs, targets, sorted(all_equities), block_rows())
+        return
+
+    # Import the data of all price fields
+    prices = load_field_ts(MERGED_PATH, field = price_fields())
 
     # Import dividend ex date data
     divs = load_field_ts(MERGED_PATH, field = "Dividend Ex Date")
-    adj_close = calc_adj_close(close, divs, all_equities, enddate = last_month_end())
-    adj_close.sort_index(axis = 1).to_csv(targets[0])
+
+    # the dividend multipliers are calculated once and applied to all the price fields
+    adjusted = calc_adjusted_prices(prices, divs, all_equities, enddate = last_month_end())
+    for f in adjusted:
+        storage.to_csv(adjusted[f].sort_index(axis = 1), path.join(MERGED_PATH, "Adjusted " + f + ".csv"))
 
 def booktomarket(dependencies, targets):
+    if MEMORY_LIMIT:
+        # the change points are compact, every block joins the change points of its tickers
+        steps = load_step_field(MERGED_PATH, field = "Book Value per Share")
+
+        def b2m(data, tickers):
+            return {targets[0]: transf.calc_booktomarket(data["Close"], steps.select(tickers)).sort_index(axis = 1)}
+
+        run_blocks(b2m, {"Close": (MERGED_PATH, "Close")}, targets, sorted(field_tickers(MERGED_PATH, "Close")), block_rows())
+        return
+
     # Import closing price data
     close = load_field_ts(MERGED_PATH, field = "Close")
 
-    # Import book value per share data
-    bookvalue = load_field_ts(MERGED_PATH, field = "Book Value per Share")
+    # Import the book value per share change points, the as-of join works on the compact form directly
+    bookvalue = load_step_field(MERGED_PATH, field = "Book Value per Share")
     b2m = transf.calc_booktomarket(close, bookvalue)
-    b2m.sort_index(axis = 1).to_csv(targets[0])
+    storage.to_csv(b2m.sort_index(axis = 1), targets[0])
+
+def fundamental_ratios(dependencies, targets):
+    close = load_field_ts(MERGED_PATH, field = "Close")
+    fundamentals = load_field_ts(MERGED_PATH, field = ['DY', 'EY', 'PE'])
+
+    ratios = transf.calc_fundamental_ratios(close, fundamentals)
+    for name in ratios:
+        storage.to_csv(ratios[name].sort_index(axis = 1), path.join(MERGED_PATH, name + '.csv'))
+
+# aggregation used to resample each field to monthly data
+monthly_how = {'Close': 'last',
+               'Adjusted Close': 'last',
+               'Open': 'first',
+               'High': 'max',
+               'Low': 'min',
+               'DY': 'last',
+               'EY': 'last',
+               'PE': 'last',
+               'Book-to-Market': 'last',
+               'Volume': 'sum',
+               'Total Number Of Shares': 'last',
+               'Number Of Trades': 'sum',
+               'Market Cap': 'last'}
 
 def resample_monthly(task):
 
     name = task.name.split(':')[1]
+    if name not in monthly_how:
+        return
+
+    how = monthly_how[name]
+    target = path.join(MASTER_DATA_PATH, name + '-monthly.csv')
+
+    # step-like fields are stored compactly and not streamed
+    if STREAM_CHUNKSIZE and name not in step_fields():
+        chunks = stream.read_chunks(path.join(MASTER_DATA_PATH, name + '.csv'), STREAM_CHUNKSIZE)
+        stream.to_csv(stream.resample_monthly(chunks, how = how), target)
+        return
+
     data = load_field_ts(MASTER_DATA_PATH, field = name)
-    
-    write = True
-    out = pd.DataFrame()
-
-    if name == 'Close':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'Adjusted Close':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'Open':
-        out = transf.resample_monthly(data, how = 'first')
-    elif name == 'High':
-        out = transf.resample_monthly(data, how = 'max')
-    elif name == 'Low':
-        out = transf.resample_monthly(data, how = 'min')
-    elif name == 'DY':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'EY':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'PE':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'Book-to-Market':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'Volume':
-        out = transf.resample_monthly(data, how = 'sum')
-    elif name == 'Total Number Of Shares':
-        out = transf.resample_monthly(data, how = 'last')
-    elif name == 'Number Of Trades':
-        out = transf.resample_monthly(data, how = 'sum')
-    elif name == 'Market Cap':
-        out = transf.resample_monthly(data, how = 'last')
-    else:
-        write = False
-    
-    if (write):
-        out.sort_index(axis = 1).to_csv(path.join(MASTER_DATA_PATH, name + '-monthly.csv'))
+    out = transf.resample_monthly(data, how = how)
+    storage.to_csv(out.sort_index(axis = 1), target)
 
-def monthly_avg_momentum(task):
-    # load the daily close
-    close = load_field_ts(MASTER_DATA_PATH, field = "Close")
+def monthly_momentum_chunks(close_m, avg_m):
+    '''
+    Stream the momentum signals of the month end and monthly average close, the two resampled streams are
+    consumed in lockstep so only one chunk of each is in memory
+    '''
 
-    # resample to monthly average data
-    close_m = transf.resample_monthly(close, how = 'mean')
-    
-    # calculate the momentum
-    mom = transf.momentum_monthly(close_m, 12, 1)
-    mom.sort_index(axis = 1).to_csv(path.join(MASTER_DATA_PATH, "Monthly-Avg-Momentum.csv"))
+    close_mom = stream.momentum_grid(close_m, transf.MOMENTUM_GRID, 'M')
+    avg_mom = stream.momentum_grid(avg_m, transf.MOMENTUM_GRID, 'M')
+
+    for c, a in zip(close_mom, avg_mom):
+        yield transf.signal_frame(momentum_signals(c, a))
 
-def monthly_close_momentum(task):
-    # load the daily close
-    close = load_field_ts(MASTER_DATA_PATH, field = "Close")
+def momentum_signals(close_mom, avg_mom):
+    signals = {}
+    for name in close_mom:
+        signals['Close-' + name] = close_mom[name]
+        signals['Avg-' + name] = avg_mom[name]
+
+    return signals
+
+def daily_momentum(windowed):
+    return transf.signal_frame(dict((n, windowed[n]) for n in daily_momentum_names))
+
+def select(chunks, name):
+    for c in chunks:
+        yield c[name]
+
+def close_derived_frames(close, announcements, trading = None):
+    '''
+    Calculate all the outputs derived from the close, the month end close, the monthly average close and the daily
+    log prices are each calculated once and shared by the outputs. A block of tickers passes the trading days of the
+    whole market.
+    '''
 
-    # resample to monthly close data
     close_m = transf.resample_monthly(close, how = 'last')
-    
-    # calculate the momentum
-    mom = transf.momentum_monthly(close_m, 12, 1)
-    mom.sort_index(axis = 1).to_csv(path.join(MASTER_DATA_PATH, "Monthly-Close-Momentum.csv"))
+    avg_m = transf.resample_monthly(close, how = 'mean')
+    logp = np.log(close.astype(float))
+
+    # the daily momentum and the log returns are differences of the same log prices
+    windowed = transf.windowed_log_returns(logp, close_windows, trading = trading)
+
+    momentum = momentum_signals(transf.momentum_grid(close_m, transf.MOMENTUM_GRID, 'M'),
+                                transf.momentum_grid(avg_m, transf.MOMENTUM_GRID, 'M'))
+
+    out = {'Close-monthly': close_m,
+           'Momentum': transf.signal_frame(momentum),
+           'Daily-Momentum': daily_momentum(windowed),
+           'Normalized-PEAD-Momentum': transf.pead_momentum(announcements, close, logp)}
+
+    for name in return_names:
+        out[return_names[name]] = windowed[name]
+
+    return out
+
+def close_derived_streams(close_chunks, announcement_chunks):
+    '''
+    Stream all the outputs derived from the close from one pass over the close chunks, see close_derived_frames
+    '''
+
+    last, mean, daily, pead = itertools.tee(close_chunks, 4)
+    close_m, close_m_mom = itertools.tee(stream.resample_monthly(last, how = 'last'), 2)
+    avg_m = stream.resample_monthly(mean, how = 'mean')
+
+    windowed = itertools.tee(stream.momentum_grid(daily, close_windows, 'D'), 1 + len(return_names))
+
+    out = {'Close-monthly': close_m,
+           'Momentum': monthly_momentum_chunks(close_m_mom, avg_m),
+           'Daily-Momentum': (daily_momentum(w) for w in windowed[0]),
+           'Normalized-PEAD-Momentum': stream.pead_momentum(announcement_chunks, pead)}
+
+    for name, chunks in zip(sorted(return_names), windowed[1:]):
+        out[return_names[name]] = select(chunks, name)
+
+    return out
+
+def close_derived(dependencies, targets):
+    closefile = path.join(MASTER_DATA_PATH, 'Close.csv')
+    annfile = path.join(MASTER_DATA_PATH, 'Dividend Declaration Date.csv')
 
-def calc_log_returns(task):
-    close = load_field_ts(MASTER_DATA_PATH, field = "Close")
+    # write every output next to its target and only replace the targets that changed
+    tmp = [t + '.tmp' for t in targets]
 
-    logret = transf.log_returns(close)
-    logret.sort_index(axis = 1).to_csv(path.join(MASTER_DATA_PATH, "Log-Returns.csv"))
+    if MEMORY_LIMIT:
+        # the holidays are skipped by the trading day windows, a block can not tell them from its own rows
+        trading = trading_days(MASTER_DATA_PATH, "Close")
 
-def calc_pead_momentum(task):
-    # load close
-    close = load_field_ts(MASTER_DATA_PATH, field = "Close")
+        def derive(data, tickers):
+            out = close_derived_frames(data["Close"], data["Dividend Declaration Date"], trading)
+            return dict((t, out[name].sort_index(axis = 1)) for name, t in zip(close_outputs, tmp))
 
-    # load dividend decl date
-    announcements = load_field_ts(MASTER_DATA_PATH, field = "Dividend Declaration Date")
-    pead = transf.pead_momentum(announcements, close)
+        inputs = dict((f, (MASTER_DATA_PATH, f)) for f in ["Close", "Dividend Declaration Date"])
+        run_blocks(derive, inputs, tmp, sorted(field_tickers(MASTER_DATA_PATH, "Close")), block_rows())
+    elif STREAM_CHUNKSIZE:
+        out = close_derived_streams(stream.read_chunks(closefile, STREAM_CHUNKSIZE), stream.read_chunks(annfile, STREAM_CHUNKSIZE))
+        stream.to_csvs([out[n] for n in close_outputs], tmp)
+    else:
+        close = load_field_ts(MASTER_DATA_PATH, field = "Close")
+        announcements = load_field_ts(MASTER_DATA_PATH, field = "Dividend Declaration Date")
+
+        out = close_derived_frames(close, announcements)
+        for name, t in zip(close_outputs, tmp):
+            storage.to_csv(out[name].sort_index(axis = 1), t)
+
+    for t, target in zip(tmp, targets):
+        replace_if_changed(t, target)
+
+def index_regression(dependencies, targets):
+    returns = load_field_ts(MASTER_DATA_PATH, field = "Log-Returns")
+    indices = load_ts(path.join(MASTER_DATA_PATH, 'Indices.csv'))
+
+    present = [i for i in regression_indices if i in indices.columns]
+    if not present:
+        # the other transforms do not depend on the regressions, so the task does not fail the stage
+        print('None of the regression indices ' + ', '.join(regression_indices) + ' is in Indices.csv, skipping the regressions')
+        return
+
+    index_returns = transf.log_returns(indices[present])
+    out = transf.rolling_regression(returns, index_returns, window = regression_window)
+
+    # one file per statistic with (index, ticker) columns
+    for stat, target in zip(regression_stats, targets):
+        storage.to_csv(transf.signal_frame(out[stat]), target)
+
+def liquidity(dependencies, targets):
+    if MEMORY_LIMIT:
+        def metrics(data, tickers):
+            out = transf.liquidity(*[data.get(f) for f in liquidity_fields])
+            return dict((t, out[name].sort_index(axis = 1)) for name, t in zip(liquidity_outputs, targets))
+
+        inputs = dict((f, (MASTER_DATA_PATH, f)) for f in liquidity_inputs)
+        run_blocks(metrics, inputs, targets, sorted(field_tickers(MASTER_DATA_PATH, "Close")), block_rows())
+        return
+
+    data = load_field_ts(MASTER_DATA_PATH, field = liquidity_inputs)
+    out = transf.liquidity(*[data.get(f) for f in liquidity_fields])
+
+    for name, target in zip(liquidity_outputs, targets):
+        storage.to_csv(out[name].sort_index(axis = 1), target)
 
-    pead.sort_index(axis = 1).to_csv(path.join(MASTER_DATA_PATH, "Normalized-PEAD-Momentum.csv"))
+def cross_section(task):
+    name = task.name.split(':')[1]
+    listings = load_listings(MASTER_DATA_PATH)
+
+    if name in signal_files:
+        signals = load_signals(MASTER_DATA_PATH, name)
+        out = {}
+        for s in signals:
+            # only rank the equities that were listed on each date
+            mask = listings.mask(signals[s].index, signals[s].columns)
+            for k, v in transf.cross_section(signals[s], mask, n = quantiles).items():
+                out.setdefault(k, {})[s] = v
+
+        for k in out:
+            storage.to_csv(transf.signal_frame(out[k]), path.join(MASTER_DATA_PATH, name + '-' + k + '.csv'))
+        return
+
+    data = load_field_ts(MASTER_DATA_PATH, field = name)
+
+    # only rank the equities that were listed on each date
+    mask = listings.mask(data.index, data.columns)
+
+    out = transf.cross_section(data, mask, n = quantiles)
+    for k in out:
+        storage.to_csv(out[k].sort_index(axis = 1), path.join(MASTER_DATA_PATH, name + '-' + k + '.csv'))
+
+def checkpoint(targets):
+    '''
+    Record the checksums of the completed outputs of a task in the manifests of their directories, the outputs are
+    written atomically so a task that did not complete has no outputs to record
+    '''
+
+    storage.record(targets)
+
+def promote_merged():
+    for f in storage.promote(MERGED_PATH, MASTER_DATA_PATH):
+        print(f)
+
+def snapshot(targets):
+    snapshots.take_snapshot(str(last_month_end()), MASTER_DATA_PATH)
 
 def swapaxes(dependencies, targets):
     
@@ -179,7 +579,7 @@ def swapaxes(dependencies, targets):
     out = panel.swapaxes(0, 2)
 
     for ticker in out.items:
-        out[ticker].dropna(how='all').sort_index(axis = 1).to_csv(path.join(CONVERT_PATH, "tickers", ticker + '.csv'), index_label = "Date")
+        storage.to_csv(out[ticker].dropna(how='all').sort_index(axis = 1), path.join(CONVERT_PATH, "tickers", ticker + '.csv'), index_label = "Date")
 
 ##########################################################################################
 # DOIT tasks
@@ -190,56 +590,112 @@ def task_convert():
     for f in fields:
         yield {
             'name':f,
-            'actions':[convert_data],
-            'targets':[path.join(CONVERT_PATH, f+ '.csv')],
+            'actions':[convert_data, checkpoint],
+            'targets':[path.join(CONVERT_PATH, f+ '.csv'), anomalies_file(f)],
             'file_dep':[path.join(DL_PATH, f + '.xlsx')],
         }
 
+def task_quality():
+    return {
+        'actions':[quality_report, checkpoint],
+        'file_dep':[path.join(CONVERT_PATH, f + '.csv') for f in fields] + [anomalies_file(f) for f in fields],
+        'targets':[path.join(CONVERT_PATH, 'Anomalies.csv')],
+        'verbosity': 2
+    }
+
 def task_convert_index():
      return {
-        'actions':[convert_indices],
+        'actions':[convert_indices, checkpoint],
         'file_dep': [path.join(DL_PATH, 'Indices.xlsx')],
         'targets':[path.join(CONVERT_PATH, "Indices.csv")]
     }
 
 def task_merge_index():
     return {
-        'actions':[merge_index],
+        'actions':[merge_index, checkpoint],
         'targets':[path.join(MERGED_PATH, "Indices.csv")],
         'file_dep':[path.join(CONVERT_PATH, "Indices.csv")]
     }
 
 # 2
+def task_symbols():
+    return {
+        'actions':[register_symbols, checkpoint],
+        'file_dep':[path.join(mergein_new, 'Close.csv'), path.join(mergein_old, 'Close.csv')],
+        'targets':[symbolspath]
+    }
+
 def task_merge():
     for f in fields:
+        # a newly downloaded field is merged without old data, the merge builds the same symbol table as the symbols task
+        deps = [path.join(mergein_new, f + '.csv')]
+        if path.isfile(field_file(mergein_old, f)):
+            deps.append(field_file(mergein_old, f))
+
         yield {
             'name':f,
-            'actions':[merge_data],
-            'targets':[path.join(MERGED_PATH, f + '.csv')],
-            'file_dep':[path.join(mergein_new, f + '.csv'), path.join(mergein_old, f + '.csv')]
+            'actions':[merge_data, checkpoint],
+            'targets':[merged_target(MERGED_PATH, f)],
+            'file_dep':deps
         }
+
+def task_listings():
+    deps = [closepath]
+    if path.isfile(refdatapath):
+        deps.append(refdatapath)
+
+    return {
+        'actions':[build_listings, checkpoint],
+        'file_dep': deps,
+        'targets':[listingspath]
+    }
+
+def task_promote():
+    # always compares the manifests, only the changed files are copied
+    return {
+        'actions':[promote_merged],
+        'uptodate':[False]
+    }
+
 # 3
 def task_adjusted_close():
     return {
-        'actions':[calc_adjusted_close],
-        'file_dep': [closepath,
-                     divpath],
-        'targets':[path.join(MERGED_PATH, "Adjusted Close.csv")]
+        'actions':[calc_adjusted_close, checkpoint],
+        'file_dep': [path.join(MERGED_PATH, f + '.csv') for f in price_fields()] + [divpath],
+        'targets':[path.join(MERGED_PATH, "Adjusted " + f + ".csv") for f in price_fields()]
+    }
+
+def task_custom_indices():
+    deps = [closepath, path.join(MERGED_PATH, "Adjusted Close.csv"), path.join(MERGED_PATH, "Market Cap.csv"), listingspath]
+    if path.isfile(refdatapath):
+        deps.append(refdatapath)
+
+    return {
+        'actions':[custom_indices, checkpoint],
+        'file_dep': deps,
+        'targets':[path.join(MERGED_PATH, "Custom-Indices.csv"), path.join(MERGED_PATH, "Custom-Indices-TR.csv")]
     }
 
 # 5
 def task_book2market():
     return {
-        'actions':[booktomarket],
+        'actions':[booktomarket, checkpoint],
         'file_dep': [closepath, bookvaluepath],
         'targets':[path.join(MERGED_PATH, "Book-to-Market.csv")]
     }
 
+def task_fundamentals():
+    return {
+        'actions':[fundamental_ratios, checkpoint],
+        'file_dep': [closepath] + [path.join(MERGED_PATH, f + '.csv') for f in ['DY', 'EY', 'PE']],
+        'targets':[path.join(MERGED_PATH, f + '.csv') for f in ['DY-PIT', 'EY-PIT', 'PE-PIT', 'Earnings-to-Price']]
+    }
+
 # 6
 def task_data_per_ticker():
     files = [path.join(CONVERT_PATH, f + '.csv') for f in fields]
     return {
-        'actions':[swapaxes],
+        'actions':[swapaxes, checkpoint],
         'file_dep': files,
         'targets':[path.join(CONVERT_PATH, "tickers")]
     }
@@ -247,35 +703,70 @@ def task_data_per_ticker():
 def task_resample_monthly():
     expanded = fields + ['Book-to-Market', 'Adjusted Close']
     for f in fields:
+        # the monthly close is written by the close derived stage
+        if f == 'Close':
+            continue
+
         yield {
             'name':f,
-            'actions':[resample_monthly],
+            'actions':[resample_monthly, checkpoint],
             'targets':[path.join(MASTER_DATA_PATH, f + '-monthly.csv')],
-            'file_dep':[path.join(MASTER_DATA_PATH, f + '.csv')],
+            'file_dep':[field_file(MASTER_DATA_PATH, f)],
         }
 
-def task_monthly_close_momentum():
+def task_close_derived():
     return {
-        'actions':[monthly_close_momentum],
-        'file_dep':[path.join(MASTER_DATA_PATH, 'Close.csv')],
+        'actions':[close_derived, checkpoint],
+        'file_dep':[path.join(MASTER_DATA_PATH, 'Close.csv'), path.join(MASTER_DATA_PATH, 'Dividend Declaration Date.csv')],
+        'targets':[path.join(MASTER_DATA_PATH, n + '.csv') for n in close_outputs]
     }
 
-def task_monthly_avg_momentum():
+def task_index_regression():
     return {
-        'actions':[monthly_avg_momentum],
-        'file_dep':[path.join(MASTER_DATA_PATH, 'Close.csv')],
-        'targets':[path.join(MASTER_DATA_PATH, "Monthly-Avg-Momentum.csv")]
+        'actions':[index_regression, checkpoint],
+        'file_dep':[path.join(MASTER_DATA_PATH, 'Log-Returns.csv'), path.join(MASTER_DATA_PATH, 'Indices.csv')],
+        'targets':[path.join(MASTER_DATA_PATH, s + '.csv') for s in regression_stats]
     }
 
-def task_log_returns():
+def task_liquidity():
+    return {
+        'actions':[liquidity, checkpoint],
+        'file_dep':[field_file(MASTER_DATA_PATH, f) for f in liquidity_inputs],
+        'targets':[path.join(MASTER_DATA_PATH, name + '.csv') for name in liquidity_outputs]
+    }
+
+def task_provisional():
+    # the daily refresh keeps the rows after the last month end of every download in the provisional layer
+    for f in fields + ['Indices']:
+        yield {
+            'name':f,
+            'actions':[refresh_provisional, checkpoint],
+            'targets':[prov.provisional_file(f)],
+            'file_dep':[path.join(DL_PATH, f + '.xlsx')],
+            'uptodate':[config_changed(str(last_month_end()))]
+        }
+
+def task_provisional_derived():
     return {
-        'actions':[calc_log_returns],
-        'file_dep':[path.join(MASTER_DATA_PATH, 'Close.csv')],
+        'actions':[provisional_derived, checkpoint],
+        # only the provisional files of the downloaded fields are refreshed, a missing input is all NaN
+        'file_dep':[prov.provisional_file(f) for f in liquidity_fields if f in fields] + [path.join(MASTER_DATA_PATH, 'Close.csv')],
+        'targets':[prov.provisional_file(n) for n in provisional_outputs]
     }
 
-def task_pead_momentum():
+def task_snapshot():
+    # a snapshot of the master data at the end of every month, only the changed chunks are stored
     return {
-        'actions':[calc_pead_momentum],
-        'file_dep':[path.join(MASTER_DATA_PATH, 'Close.csv'), path.join(MASTER_DATA_PATH, 'Dividend Declaration Date.csv')],
-        'targets':[path.join(MASTER_DATA_PATH, "Normalized-PEAD-Momentum.csv")]
-    }
\ No newline at end of file
+        'actions':[snapshot],
+        'file_dep':[path.join(MASTER_DATA_PATH, storage.MANIFEST)],
+        'targets':[snapshots.manifest_path(SNAPSHOT_PATH, str(last_month_end()))]
+    }
+
+def task_cross_section():
+    for f in factors:
+        yield {
+            'name':f,
+            'actions':[cross_section, checkpoint],
+            'file_dep':[path.join(MASTER_DATA_PATH, f + '.csv'), path.join(MASTER_DATA_PATH, 'Listings.csv')],
+            'targets':[path.join(MASTER_DATA_PATH, f + '-' + k + '.csv') for k in ['Rank', 'ZScore', 'Quantile']]
+        }
@@ -1,4 +1,6 @@
 mkdir -p master
 mkdir -p merged
 mkdir -p converted
-mkdir -p downloads
\ No newline at end of file
+mkdir -p downloads
+mkdir -p snapshots
+mkdir -p provisional
\ No newline at end of file
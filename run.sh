@@ -4,11 +4,24 @@ DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 root=$DIR
 
 cd $root
+set -e
+
+# the daily refresh only updates the provisional rows of the current month and their daily derived outputs
+if [ "$1" == "daily" ]; then
+    echo "Refreshing the provisional data..."
+    doit provisional provisional_derived
+    exit 0
+fi
+
+# every task writes its outputs atomically, a rerun after an interruption resumes from the last completed task
 echo "Updating data..."
-doit convert convert_index merge merge_index adjusted_close book2market 
+doit convert convert_index quality symbols merge merge_index listings adjusted_close custom_indices book2market fundamentals 
 
-echo "Copying data to master..."
-cp -ruv $root/merged/* $root/master/
+echo "Promoting data to master..."
+doit promote
 
 echo "Running transformation tasks..."
-doit monthly_avg_momentum pead_momentum
\ No newline at end of file
+doit close_derived index_regression liquidity cross_section
+
+echo "Taking a snapshot of the master data..."
+doit snapshot
\ No newline at end of file
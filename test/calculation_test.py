@@ -5,6 +5,12 @@ import datetime as dt
 import numpy as np
 import random
 import datamanager.transforms as t
+import datamanager.stream as stream
+from datamanager.indices import build_indices
+from datamanager.steps import StepField
+import datamanager.profiling as profiling
+import tempfile
+import tracemalloc
 from mock_data import TESTDATA
 
 def test_backwards_calc():
@@ -15,6 +21,34 @@ def test_adjusted_close():
     '''
     test should not be dependent on data in files
     '''
+
+    close = TESTDATA['2010-01-01':'2010-12-31']
+    divs = close * np.nan
+    divs.loc['2010-03-15', 'AGL'] = 100.0
+    divs.loc['2010-09-13', 'AGL'] = 150.0
+
+    adj = calc_adj_close(close, divs, close.columns, enddate = dt.date(2010, 12, 31))
+
+    # the per ticker backwards calculation gives the multipliers on the dividend dates
+    mult = calc_dividend_multiplier(divs['AGL'].dropna(), close['AGL'].dropna())
+    assert np.abs(adj.loc['2010-03-15', 'AGL'] - close.loc['2010-03-15', 'AGL'] * mult['2010-03-15']) < 1e-9
+    assert np.abs(adj.loc['2010-06-01', 'AGL'] - close.loc['2010-06-01', 'AGL'] * mult['2010-09-13']) < 1e-9
+    after = close.loc['2010-09-14':, 'AGL'].dropna()
+    assert (adj['AGL'][after.index] == after).all()
+    assert (adj['SOL'].dropna() == close['SOL'].dropna()).all()
+
+def test_adjusted_prices():
+    close = TESTDATA['2010-01-01':'2010-12-31']
+    divs = close * np.nan
+    divs.loc['2010-03-15', 'SAB'] = 80.0
+
+    prices = {'Close': close, 'Open': close * 0.99}
+    adjusted = calc_adjusted_prices(prices, divs, close.columns, enddate = dt.date(2010, 12, 31))
+    adj_close = calc_adj_close(close, divs, close.columns, enddate = dt.date(2010, 12, 31))
+
+    assert sorted(adjusted.keys()) == ['Close', 'Open']
+    assert np.nanmax(np.abs(adjusted['Close'].values - adj_close.values)) < 1e-9
+    assert np.nanmax(np.abs(adjusted['Open'].values - 0.99 * adj_close.values)) < 1e-9
     
 def test_book2market():
     '''
@@ -71,3 +105,241 @@ def test_cumulative_return():
 
     pctret = df.pct_change()
 
+
+def test_cross_section():
+    data = TESTDATA['2015-01-01':'2015-12-31'].dropna(how = 'any')
+    mask = data.notnull()
+    mask.loc[:, 'SOL'] = False
+
+    out = t.cross_section(data, mask, n = 2)
+    ranks = t.cs_rank(data, mask)
+
+    assert np.allclose(out['Rank'][['AGL', 'SAB']], ranks[['AGL', 'SAB']])
+    assert out['Rank']['SOL'].isnull().all()
+    assert set(out['Quantile'][['AGL', 'SAB']].values.ravel()) == set([1.0, 2.0])
+
+    expected = (data.iloc[0] - data.iloc[0].mean()) / data.iloc[0].std()
+    z = t.cs_zscore(data)
+    assert np.allclose(z.iloc[0].values, expected.values)
+
+def test_streaming():
+    chunks = lambda: (TESTDATA.iloc[i:i + 250] for i in range(0, len(TESTDATA.index), 250))
+
+    monthly = t.resample_monthly(TESTDATA, 'mean')
+    streamed = pd.concat(list(stream.resample_monthly(chunks(), 'mean')))
+    assert streamed.index.equals(monthly.index)
+    assert np.allclose(streamed.values, monthly.values, equal_nan = True)
+
+    mom = np.log(monthly.shift(1)) - np.log(monthly.shift(12))
+    streamed = pd.concat(list(stream.momentum_monthly(stream.resample_monthly(chunks(), 'mean'), 12, 1)))
+    assert np.allclose(streamed.values, mom.values, equal_nan = True)
+
+    logret = np.log(TESTDATA) - np.log(TESTDATA.shift(1))
+    streamed = pd.concat(list(stream.log_returns(chunks())))
+    assert np.allclose(streamed.values, logret.values, equal_nan = True)
+
+def test_custom_indices():
+    close = TESTDATA['2014-01-01':'2015-12-31'].ffill().dropna()
+    caps = close * [2.0, 1.0, 1.0]
+    masks = {'All': close.notnull(), 'AGL': close.notnull() & np.array([True, False, False])}
+
+    levels, tr_levels = build_indices(masks, close, close * 1.0, caps, scheme = 'cap', freq = 'M')
+
+    assert np.allclose(levels['AGL'].values, 100 * close['AGL'].values / close['AGL'].iloc[0])
+    assert np.allclose(levels.values, tr_levels.values)
+
+    # daily rebalancing of cap weights compounds the weighted daily returns
+    levels, _ = build_indices(masks, close, caps = caps, scheme = 'cap', freq = 'D')
+    w = caps.shift(1).div(caps.shift(1).sum(axis = 1), axis = 0)
+    ret = (w * close.pct_change()).sum(axis = 1)
+    assert np.allclose(levels['All'].values[1:], 100 * np.cumprod(1 + ret.values[1:]))
+
+def test_asof_join():
+    close = TESTDATA['2014-01-01':'2015-12-31']
+    bookvalue = close * np.nan
+    bookvalue.loc['2014-03-03', 'AGL'] = 2000.0
+    bookvalue.loc['2015-03-02', 'AGL'] = 2500.0
+    bookvalue.loc['2014-06-02', 'SOL'] = 1000.0
+
+    aligned = t.asof_join(bookvalue, close.index)
+    assert np.allclose(aligned.fillna(0).values, bookvalue.ffill().fillna(0).values)
+
+    b2m = t.calc_booktomarket(close, bookvalue, max_staleness = 200)
+    assert np.isnan(b2m.loc['2014-02-28', 'AGL'])
+    assert b2m.loc['2014-09-01', 'AGL'] == 2000.0 / close.loc['2014-09-01', 'AGL']
+    assert np.isnan(b2m.loc['2015-01-05', 'AGL'])
+    assert np.isnan(b2m.loc['2015-12-01', 'SOL'])
+    assert b2m['SAB'].isnull().all()
+
+    # the compact change point form gives the same result
+    compact = StepField.encode(bookvalue)
+    assert np.array_equal(t.calc_booktomarket(close, compact, max_staleness = 200).values, b2m.values, equal_nan = True)
+
+    # a book value that is reported unchanged for years stays valid, the staleness is measured from the last report
+    close = TESTDATA['2010-01-01':'2013-12-31']
+    bookvalue = pd.DataFrame(1000.0, index = close.index, columns = close.columns)
+    bookvalue.loc['2013-07-01':, 'SOL'] = np.nan
+    b2m = t.calc_booktomarket(close, bookvalue)
+    compact = StepField.encode(bookvalue)
+    assert np.array_equal(t.calc_booktomarket(close, compact).values, b2m.values, equal_nan = True)
+    assert np.array_equal(t.calc_booktomarket(close[['SOL']], compact.select(['SOL'])).values, b2m[['SOL']].values,
+                          equal_nan = True)
+    assert b2m['AGL'].notnull().sum() == close['AGL'].notnull().sum()
+
+def test_multi_horizon_returns():
+    close = TESTDATA['2010-01-01':'2012-12-31'].dropna()
+    returns = t.multi_horizon_returns(close, horizons = [1, 5, 21], windows = [(21, 5)])
+
+    assert sorted(returns.keys()) == ['1D', '21D', '21D-5D', '5D']
+    assert np.allclose(returns['1D'].values[1:], np.log(close.values[1:] / close.values[:-1]))
+    assert np.allclose(returns['5D'].values[5:], np.log(close.values[5:] / close.values[:-5]))
+    assert np.allclose(returns['21D-5D'].values[21:], np.log(close.values[16:-5] / close.values[:-21]))
+    assert np.isnan(returns['21D'].values[:21]).all()
+
+    # log returns no longer depend on a daily frequency of the index
+    assert np.allclose(t.log_returns(close).values[1:], returns['1D'].values[1:])
+
+    # the holidays of the business day grid are skipped, the windows count trading days
+    close = TESTDATA['2014-01-01':'2015-12-31'].reindex(pd.bdate_range('2014-01-01', '2015-12-31'))
+    close.loc[['2014-12-25', '2015-01-01']] = np.nan
+    trading = close.dropna(how = 'all')
+    returns = t.multi_horizon_returns(close, horizons = [1, 21])
+    expected = np.log(trading) - np.log(trading.shift(21))
+    assert np.allclose(returns['21D'].loc[trading.index].values, expected.values, equal_nan = True)
+    assert returns['1D'].loc[['2014-12-25', '2015-01-01']].isnull().all().all()
+    assert np.allclose(t.log_returns(close).loc['2015-01-02'], np.log(close.loc['2015-01-02'] / close.loc['2014-12-31']),
+                       equal_nan = True)
+    assert t.log_returns(close).loc['2015-01-02'].notnull().any()
+
+    # a block of tickers gets the trading days of the whole market, and the chunks of a stream carry trading days
+    block = t.windowed_log_returns(np.log(close[['AGL']]), [(21, 0)], trading = trading.index)['21D']
+    assert np.allclose(block.values, returns['21D'][['AGL']].values, equal_nan = True)
+    chunks = stream.momentum_grid((close.iloc[i:i + 30] for i in range(0, len(close.index), 30)), [(21, 0)], 'D')
+    streamed = pd.concat([c['21D'] for c in chunks])
+    assert np.allclose(streamed.values, returns['21D'].values, equal_nan = True)
+
+def test_momentum_grid():
+    monthly = t.resample_monthly(TESTDATA, 'last')
+    grid = t.momentum_grid(monthly, [(12, 1), (6, 0)], 'M')
+
+    assert sorted(grid.keys()) == ['12M-1M', '6M']
+    expected = np.log(monthly.shift(1)) - np.log(monthly.shift(12))
+    assert np.allclose(grid['12M-1M'].values, expected.values, equal_nan = True)
+    assert np.allclose(t.momentum_monthly(monthly, 12, 1).values, expected.values, equal_nan = True)
+
+    frame = t.signal_frame(grid)
+    assert list(frame.columns.levels[0]) == ['12M-1M', '6M']
+    assert np.allclose(frame['6M'].values, (np.log(monthly) - np.log(monthly.shift(6))).values, equal_nan = True)
+
+def test_pead_streaming():
+    close = TESTDATA['2010-01-01':'2012-12-31']
+    announcements = close * np.nan
+    announcements.iloc[[20, 300, 320], 0] = 1
+    announcements.iloc[[100, 510], 1] = 1
+
+    pead = t.pead_momentum(announcements, close)
+    assert pead.iloc[:20, 0].isnull().all()
+    assert pead.iloc[20:, 0].notnull().any()
+
+    # the last announcement is carried between chunks
+    chunks = lambda data: (data.iloc[i:i + 200] for i in range(0, len(data.index), 200))
+    streamed = pd.concat(list(stream.pead_momentum(chunks(announcements), chunks(close))))
+    assert np.allclose(streamed.values, pead.values, equal_nan = True)
+
+def test_rolling_regression():
+    returns = t.log_returns(TESTDATA)
+    index = pd.DataFrame({'IDX': returns.mean(axis = 1)})
+    returns.iloc[100:150, 0] = np.nan
+
+    out = t.rolling_regression(returns, index, window = 60, min_periods = 40)
+
+    for c in returns.columns:
+        cov = returns[c].rolling(60, min_periods = 40).cov(index['IDX'])
+        corr = returns[c].rolling(60, min_periods = 40).corr(index['IDX'])
+        var = index['IDX'].where(returns[c].notnull()).rolling(60, min_periods = 40).var()
+
+        assert np.allclose(out['Beta']['IDX'][c].values, (cov / var).values, equal_nan = True)
+        assert np.allclose(out['Correlation']['IDX'][c].values, corr.values, equal_nan = True)
+
+    # the residual volatility of an equity that is the index is zero
+    out = t.rolling_regression(index, index, window = 60)
+    assert np.allclose(out['Beta']['IDX'].dropna().values, 1.0)
+    assert np.allclose(out['Idiosyncratic-Volatility']['IDX'].dropna().values, 0.0, atol = 1e-8)
+
+def test_liquidity():
+    dates = pd.bdate_range('2015-01-01', '2015-02-27')
+    close = pd.DataFrame({'AGL': 1000.0, 'SOL': 2000.0}, index = dates)
+    close.iloc[1::2, 0] = 1100.0
+    close.iloc[:5, 1] = np.nan
+
+    volume = pd.DataFrame({'AGL': 10000.0, 'SOL': 500.0}, index = dates)
+    volume.iloc[::4, 1] = 0
+    trades = (volume / 100).round()
+    shares = pd.DataFrame(1e6, index = dates, columns = close.columns)
+
+    if hasattr(pd, 'Int64Dtype'):
+        volume = volume.astype('Int64')
+
+    out = t.liquidity(close, volume, trades, close - 5, close + 5, pd.DataFrame(np.nan, index = dates, columns = close.columns), shares)
+
+    # |log(1100 / 1000)| per million rand traded at the close
+    assert np.isclose(out['Amihud-Illiquidity']['AGL'].iloc[1], np.log(1.1) / (10000 * 1100 * 0.01) * 1e6)
+    assert np.isclose(out['Relative-Spread']['AGL'].iloc[0], 10.0 / 1000)
+    assert out['Turnover']['SOL'].iloc[:5].isnull().all()
+    assert np.isclose(out['Turnover-monthly']['AGL'].iloc[0], 10000 / 1e6 * len(close['2015-01'].index))
+
+    # only the listed days count towards the zero trade ratio
+    zero = out['Zero-Trade']['SOL']
+    assert zero.iloc[:5].isnull().all() and zero.iloc[8] == 1 and zero.iloc[9] == 0
+    assert np.isclose(out['Zero-Trade-monthly']['SOL'].iloc[0], zero['2015-01'].mean())
+    assert out['Zero-Trade-monthly']['AGL'].eq(0).all()
+
+    # without the number of trades a day with volume is a day with trades
+    vwap = pd.DataFrame(np.nan, index = dates, columns = close.columns)
+    without = t.liquidity(close, volume, None, close - 5, close + 5, vwap, shares)
+    for name in out:
+        assert np.allclose(without[name].values, out[name].values, equal_nan = True)
+
+def test_profiling():
+    # without DATAMANAGER_PROFILE the public functions are not wrapped
+    if not profiling.ENABLED:
+        assert not hasattr(t.pead_momentum, '__profiled__')
+
+    profiling.reset()
+    outer = profiling.profiled(lambda data: inner(data.cumsum()), 'outer')
+    inner = profiling.profiled(lambda data: data.diff(), 'inner')
+
+    for i in range(3):
+        outer(TESTDATA)
+
+    stats = profiling.stats()
+    assert stats['outer']['calls'] == 3 and stats['inner']['calls'] == 3
+    assert stats['outer']['shapes'] == [[list(TESTDATA.shape)]]
+    assert stats['inner']['output_bytes'] == 3 * TESTDATA.memory_usage(index = True).sum()
+    assert stats['outer']['cumulative'] >= stats['inner']['cumulative']
+    assert np.isclose(stats['outer']['self'], stats['outer']['cumulative'] - stats['inner']['cumulative'])
+
+    folded = tempfile.mktemp()
+    profiling.write_collapsed(folded)
+    stacks = [l.rsplit(' ', 1)[0] for l in open(folded).read().splitlines()]
+    assert stacks == ['outer', 'outer;inner']
+    profiling.reset()
+
+    # the peak memory of a call counts the temporaries freed before it returns, also in the enclosing call
+    if hasattr(tracemalloc, 'reset_peak'):
+        memory, tracing = profiling.MEMORY, tracemalloc.is_tracing()
+        profiling.MEMORY = True
+        tracemalloc.start()
+        try:
+            temporary = profiling.profiled(lambda n: np.ones(n).sum(), 'temporary')
+            outer = profiling.profiled(lambda n: temporary(n) + temporary(n // 2), 'outer')
+            outer(1000000)
+
+            stats = profiling.stats()
+            assert stats['temporary']['peak_bytes'] >= 8 * 1000000
+            assert stats['outer']['peak_bytes'] >= 8 * 1000000
+        finally:
+            profiling.MEMORY = memory
+            if not tracing:
+                tracemalloc.stop()
+            profiling.reset()
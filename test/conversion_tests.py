@@ -1,8 +1,456 @@
 from datamanager.utils import last_month_end
 from mock_data import TESTDATA
 import numpy as np
+import pandas as pd
+import tempfile
+import pytest
+from os import path
+from datamanager.load import read_fields, load_step_field, load_market_data, load_reference_history, iter_cross_sections
+from datamanager.load import load_inetbfa_ts_data, load_signals
+from datamanager.referencedata import ReferenceHistory
+from datamanager.blocks import run_blocks, block_size
+import datamanager.storage as storage
+import datamanager.snapshots as snapshots
+import datamanager.server as server
+import datamanager.client as client
+import datamanager.symbols as symbols
+import datamanager.schema as schema
+import datamanager.provisional as prov
+import datamanager.quality as quality
+import datamanager.load as load
+import threading
+from os import listdir
+from datamanager.steps import StepField, STEPS_EXT
+from datamanager.universe import ListingIndex
+from datamanager.dtypes import field_dtype, as_field_dtype, memory_usage
 
 def test_last_date_of_conversion():
     select = TESTDATA.index[TESTDATA.index.values.astype('datetime64[D]') > np.datetime64(last_month_end())]
 
     assert len(select) == 0
+
+def test_listing_index():
+    close = TESTDATA.copy()
+    close.loc[:'1995-06-30', 'SAB'] = np.nan
+    close.loc['2010-01-01':, 'SOL'] = np.nan
+
+    listings = ListingIndex.from_data(close)
+
+    assert sorted(listings.universe('1992-03-02')) == ['AGL', 'SOL']
+    assert sorted(listings.universe('2012-03-01')) == ['AGL', 'SAB']
+    assert sorted(listings.universe_between('1992-01-01', '1995-07-31')) == ['AGL', 'SAB', 'SOL']
+
+    mask = listings.mask(close.index, close.columns)
+    first = close['SAB'].first_valid_index()
+    assert mask['SAB'][first] and not mask['SAB'][:first].iloc[:-1].any()
+    assert mask['AGL']['2000-01-03':].all()
+
+    ref = pd.DataFrame({'listing_status': ['CURRENT', 'DELISTED']}, index = ['AGL', 'SOL'])
+    listings = ListingIndex.from_data(close, ref)
+    assert 'AGL' in listings.universe('2030-01-01')
+    assert 'SOL' not in listings.universe('2030-01-01')
+
+    restored = ListingIndex.from_frame(listings.to_frame())
+    assert restored.universe('2030-01-01') == listings.universe('2030-01-01')
+
+def test_read_fields():
+    tmp = tempfile.mkdtemp()
+    TESTDATA.to_csv(path.join(tmp, 'Close.csv'))
+    (TESTDATA * 2).to_csv(path.join(tmp, 'Open.csv'))
+    TESTDATA.iloc[:100].to_csv(path.join(tmp, 'High.csv'))
+
+    data = read_fields(tmp, ['Close', 'Open', 'High'], workers = 2)
+
+    assert data['Close'].index is data['Open'].index
+    assert data['High'].index.equals(TESTDATA.index[:100])
+    assert np.allclose(data['Open'].fillna(0).values, 2 * TESTDATA.fillna(0).values)
+
+def test_step_field_storage():
+    shares = pd.DataFrame(np.nan, index = pd.bdate_range('2014-01-01', '2015-12-31'), columns = ['AGL', 'SAB', 'SOL'])
+    shares.loc['2014-03-03':, 'AGL'] = 1000.0
+    shares.loc['2015-03-02':, 'AGL'] = 1100.0
+    shares.loc['2014-06-02':'2015-06-30', 'SOL'] = 500.0
+
+    steps = StepField.encode(shares)
+    assert len(steps.compact.index) == 4
+
+    tmp = tempfile.mkdtemp()
+    steps.to_csv(path.join(tmp, 'Total Number Of Shares' + STEPS_EXT))
+
+    restored = load_step_field(tmp, 'Total Number Of Shares')
+    assert restored.dense.index.equals(shares.index)
+    assert np.array_equal(restored.dense.values, shares.values, equal_nan = True)
+    assert np.array_equal(restored.decode(['SOL'])['SOL'].values, shares['SOL'].values, equal_nan = True)
+
+    # the loaders expand the change points transparently, in the dtype of the field
+    loaded = load_market_data(tmp, 'Total Number Of Shares')
+    assert np.array_equal(loaded.astype(float).values, shares.values, equal_nan = True)
+
+def test_field_dtypes():
+    close = TESTDATA.copy()
+    volume = (close * 1000).round()
+
+    tmp = tempfile.mkdtemp()
+    as_field_dtype(close, 'Close').to_csv(path.join(tmp, 'Close.csv'))
+    as_field_dtype(volume, 'Volume').to_csv(path.join(tmp, 'Volume.csv'))
+
+    data = read_fields(tmp, ['Close', 'Volume'])
+    assert (data['Close'].dtypes == np.float32).all()
+    assert (data['Volume'].dtypes == field_dtype('Volume')).all()
+
+    # float32 prices keep 7 significant digits and halve the memory, the counts are exact
+    assert np.allclose(data['Close'].values, close.values, rtol = 1e-7, equal_nan = True)
+    assert memory_usage(data['Close']) * 2 == memory_usage(close)
+    assert np.array_equal(data['Volume'].astype(float).values, volume.values, equal_nan = True)
+
+    # counts that are not integral are not rounded
+    assert (as_field_dtype(volume + 0.5, 'Volume').dtypes == np.float64).all()
+
+def test_reference_history():
+    history = ReferenceHistory()
+    snapshot = pd.DataFrame({'sector': ['Mining', 'Banks', 'Retail']}, index = ['AGL', 'SBK', 'SHP'])
+    history.record(snapshot, '2010-01-01')
+
+    snapshot.loc['SHP', 'sector'] = 'Food'
+    snapshot.loc['NPN'] = ['Media']
+    history.record(snapshot, '2012-06-01')
+    history.record(snapshot, '2012-06-01')
+    assert len(history) == 5
+
+    assert history.as_of('sector', '2011-01-03').to_dict() == {'AGL': 'Mining', 'SBK': 'Banks', 'SHP': 'Retail'}
+    assert history.as_of('sector', '2012-06-01')['SHP'] == 'Food'
+
+    tmp = tempfile.mkdtemp()
+    history.to_frame().to_csv(path.join(tmp, 'jse_equities_history.csv'), index = False)
+    history = load_reference_history(tmp)
+
+    # the matrix agrees with the lookup on every date
+    dates = pd.bdate_range('2009-12-01', '2013-01-31')
+    matrix = history.matrix('sector', dates)
+    for d in dates:
+        assert matrix.loc[d].dropna().to_dict() == history.as_of('sector', d).to_dict()
+
+    food = history.membership('sector', 'Food', dates)
+    assert food['SHP'].sum() == len(dates[dates >= '2012-06-01'])
+
+def test_ticker_blocks():
+    tmp = tempfile.mkdtemp()
+    TESTDATA.to_csv(path.join(tmp, 'Close.csv'))
+
+    # one ticker per block
+    assert block_size(len(TESTDATA.index), 2, memory_limit = 1, workers = 2) == 1
+
+    def double(data, tickers):
+        return {path.join(tmp, 'Double.csv'): data['Close'] * 2}
+
+    tickers = sorted(TESTDATA.columns) + ['NEW']
+    run_blocks(double, {'Close': (tmp, 'Close')}, [path.join(tmp, 'Double.csv')], tickers, len(TESTDATA.index), memory_limit = 1)
+
+    out = pd.read_csv(path.join(tmp, 'Double.csv'), index_col = 0, parse_dates = True)
+    assert list(out.columns) == tickers
+    assert out['NEW'].isnull().all()
+    assert np.allclose(out[TESTDATA.columns].values, TESTDATA.values.astype(np.float32) * 2, equal_nan = True)
+
+def test_atomic_storage():
+    src = tempfile.mkdtemp()
+    dst = tempfile.mkdtemp()
+
+    storage.to_csv(TESTDATA, path.join(src, 'Close.csv'))
+    storage.to_csv(TESTDATA * 2, path.join(src, 'Volume.csv'))
+
+    # an interrupted write leaves the previous output and no temporary file behind
+    try:
+        with storage.atomic_write(path.join(src, 'Close.csv')) as f:
+            f.write('half written')
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+
+    assert pd.read_csv(path.join(src, 'Close.csv'), index_col = 0).shape == TESTDATA.shape
+    assert sorted(listdir(src)) == ['Close.csv', 'Volume.csv']
+
+    storage.record([path.join(src, 'Close.csv')])
+    assert list(storage.read_manifest(src).index) == ['Close.csv']
+
+    assert storage.promote(src, dst) == ['Close.csv', 'Volume.csv']
+    assert storage.promote(src, dst) == []
+
+    storage.to_csv(TESTDATA * 3, path.join(src, 'Volume.csv'))
+    assert storage.promote(src, dst) == ['Volume.csv']
+    assert sorted(listdir(dst)) == ['Close.csv', 'Volume.csv', storage.MANIFEST]
+
+def test_snapshots():
+    master = tempfile.mkdtemp()
+    root = tempfile.mkdtemp()
+
+    close = TESTDATA['2010-01-01':'2012-12-31']
+    close.to_csv(path.join(master, 'Close.csv'))
+    StepField.encode(close.round(-2)).to_csv(path.join(master, 'Book Value per Share' + STEPS_EXT))
+    first = snapshots.take_snapshot('2012-12-31', master, root)
+    assert sorted(first['Close.csv']['chunks']) == ['2010', '2011', '2012']
+
+    # a new month and a new listing only change the chunk of the new year
+    later = TESTDATA['2010-01-01':'2013-01-31'].copy()
+    later.loc['2013-01-01':, 'NEW'] = 1.0
+    later.to_csv(path.join(master, 'Close.csv'))
+    second = snapshots.take_snapshot('2013-01-31', master, root)
+    assert all(second['Close.csv']['chunks'][y] == first['Close.csv']['chunks'][y] for y in ['2010', '2011', '2012'])
+
+    old = snapshots.load_field('2013-01-15', 'Close', start = '2011-01-01', end = '2011-12-31', root = root)
+    assert list(old.columns) == list(close.columns)
+    assert np.allclose(old.values, close['2011-01-01':'2011-12-31'].values.astype(np.float32), equal_nan = True)
+
+    new = snapshots.load_field('2013-01-31', 'Close', tickers = ['NEW'], start = '2012-12-01', end = '2013-01-31', root = root)
+    assert new['NEW']['2012'].isnull().all() and new['NEW']['2013'].notnull().all()
+
+    steps = snapshots.load_field('2012-12-31', 'Book Value per Share', root = root)
+    assert np.allclose(steps.values, close.round(-2).values, equal_nan = True)
+
+    restored = tempfile.mkdtemp()
+    snapshots.restore('2012-12-31', restored, root)
+    assert np.allclose(pd.read_csv(path.join(restored, 'Close.csv'), index_col = 0).values, close.values, equal_nan = True)
+
+def test_data_server(monkeypatch):
+    tempdir = tempfile.mkdtemp()
+    TESTDATA.to_csv(path.join(tempdir, 'Close.csv'))
+    (TESTDATA * 100).round().to_csv(path.join(tempdir, 'Volume.csv'))
+
+    address = path.join(tempdir, 'server.sock')
+    srv = server.make_server(address, cache_limit = 1)
+    threading.Thread(target = srv.serve_forever, daemon = True).start()
+
+    try:
+        tickers = list(TESTDATA.columns[:3]) + ['MISSING']
+        close = client.fetch(tempdir, 'Close', tickers = tickers, start = '2012-01-01', end = '2012-06-30', address = address)
+        expected = TESTDATA.loc['2012-01-01':'2012-06-30'].reindex(columns = tickers)
+        assert close.dtypes.iloc[0] == np.float32
+        assert list(close.columns) == tickers and close.index.equals(expected.index)
+        assert np.allclose(close.values, expected.values.astype(np.float32), equal_nan = True)
+
+        # a repeated slice is served from the cache
+        client.fetch(tempdir, 'Close', tickers = tickers, start = '2012-01-01', end = '2012-06-30', address = address)
+        assert len(srv.store.cache) == 1
+
+        volume = client.fetch(tempdir, 'Volume', address = address)
+        assert str(volume.dtypes.iloc[0]) == field_dtype('Volume')
+        assert np.allclose(volume.astype(float).values, (TESTDATA * 100).round().values, equal_nan = True)
+
+        # the single and multi field loaders read from the server without code changes
+        monkeypatch.setattr(load, 'DATA_SERVER', address)
+        data = load.load_fields(tempdir, ['Close', 'Volume'], tickers = tickers, start = '2012-01-01', end = '2012-06-30')
+        assert np.allclose(data['Close'].values, close.values, equal_nan = True)
+        assert data['Volume'].index.equals(expected.index)
+        assert load.load_field_ts(tempdir, 'Close').equals(client.fetch(tempdir, 'Close', start = '1990-01-01', address = address))
+        assert sorted(load.load_field_ts(tempdir, ['Close', 'Volume']).keys()) == ['Close', 'Volume']
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+def test_cross_sections():
+    tempdir = tempfile.mkdtemp()
+    close = TESTDATA['2010-01-01':'2012-12-31']
+    close.to_csv(path.join(tempdir, 'Close.csv'))
+    (close * 100).round()['2011-01-01':].to_csv(path.join(tempdir, 'Volume.csv'))
+
+    sections = list(iter_cross_sections(tempdir, ['Close', 'Volume'], start = '2010-06-01', rows = 7))
+    assert [d for d, _ in sections] == list(close['2010-06-01':].index)
+
+    for d, cs in sections[::50]:
+        assert list(cs.columns) == ['Close', 'Volume'] and list(cs.index) == list(close.columns)
+        assert np.allclose(cs['Close'].values, close.loc[d].values.astype(np.float32), equal_nan = True)
+        if d < pd.Timestamp('2011-01-01'):
+            assert cs['Volume'].isnull().all()
+        else:
+            assert np.allclose(cs['Volume'].values, (close.loc[d] * 100).round().values, equal_nan = True)
+
+    listings = ListingIndex.from_data(close)
+    monthly = list(iter_cross_sections(tempdir, ['Close'], freq = 'M', listings = listings, rows = 5))
+    assert [d for d, _ in monthly] == list(close.groupby(close.index.to_period('M')).apply(lambda g: g.index[-1]))
+    d, cs = monthly[-1]
+    assert sorted(cs.index) == sorted(listings.universe(d))
+
+def test_symbol_table():
+    tempdir = tempfile.mkdtemp()
+    table = symbols.load_symbols(tempdir)
+    table.add(['SOL', 'AGL'])
+    table.to_csv(path.join(tempdir, symbols.SYMBOLS_FILE))
+
+    # ids are stable and a new ticker gets the next id
+    table = symbols.load_symbols(tempdir)
+    assert list(table.ids(['AGL', 'SAB', 'SOL'], add = True)) == [1, 2, 0]
+    assert list(table.labels([2, 0])) == ['SAB', 'SOL']
+    assert list(table.ids(['XYZ'])) == [-1]
+
+    grid = pd.DataFrame(np.nan, index = TESTDATA.index, columns = ['AGL', 'SAB', 'SOL', 'XYZ'])
+    old = TESTDATA[:'2005-12-31'].iloc[:, :2]
+    new = TESTDATA['2005-01-01':].iloc[:, 1:]
+
+    values = grid.values.copy()
+    ids = table.ids(grid.columns, add = True)
+    symbols.update(values, grid.index, ids, old, table)
+    symbols.update(values, grid.index, ids, new, table)
+
+    grid.update(old)
+    grid.update(new)
+    assert np.allclose(values, grid.values, equal_nan = True)
+
+    # the nullable integer fields hold NA, e.g. the old Volume of a merge
+    volume = (old * 100).round().astype('Int64')
+    values = np.empty(grid.shape)
+    values[:] = np.nan
+    symbols.update(values, grid.index, ids, volume, table)
+    expected = pd.DataFrame(np.nan, index = grid.index, columns = grid.columns)
+    expected.update(volume.astype('float64'))
+    assert volume.isna().values.any()
+    assert np.allclose(values, expected.values, equal_nan = True)
+
+def test_schema_discovery():
+    tempdir = tempfile.mkdtemp()
+    cache = path.join(tempfile.mkdtemp(), 'schema.json')
+    close = TESTDATA['2010-01-01':'2012-12-31']
+    close.to_csv(path.join(tempdir, 'Close.csv'))
+    StepField.encode(close.round(-2)).to_csv(path.join(tempdir, 'Book Value per Share' + STEPS_EXT))
+    pd.DataFrame({'name': ['Anglo']}, index = ['AGL']).to_csv(path.join(tempdir, 'jse_equities.csv'))
+
+    # an I-Net BFA workbook: tickers in the first row, two skipped rows and a dropped row before the dates
+    openpyxl = pytest.importorskip('openpyxl')
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['', '', 'Date'] + [t + ':JSE' for t in close.columns])
+    for i in range(3):
+        ws.append(['', '', ''] + ['' for t in close.columns])
+    for d, row in close.iterrows():
+        ws.append(['', '', d.to_pydatetime()] + [None if np.isnan(v) else v for v in row.values])
+    wb.save(path.join(tempdir, 'Volume.xlsx'))
+
+    schemas = schema.discover(tempdir, cache)
+    assert schemas['Close'] == {'kind': 'timeseries', 'tickers': list(close.columns), 'file': 'Close.csv',
+                                'start': '2010-01-01', 'end': str(close.index[-1].date())}
+    assert schemas['Book Value per Share']['kind'] == 'steps'
+    assert schemas['jse_equities']['kind'] == 'table'
+
+    xl = load_inetbfa_ts_data(path.join(tempdir, 'Volume.xlsx'))
+    assert schemas['Volume']['tickers'] == list(xl.columns)
+    assert (schemas['Volume']['start'], schemas['Volume']['end']) == (str(xl.index[0].date()), str(xl.index[-1].date()))
+
+    assert schema.field_names(tempdir, cache) == ['Book Value per Share', 'Close', 'Volume']
+
+    # a file is only read again when its signature changes
+    close['2010-01-01':'2011-12-31'].to_csv(path.join(tempdir, 'Close.csv'))
+    assert schema.discover(tempdir, cache)['Close']['end'] == str(close['2011'].index[-1].date())
+
+def test_provisional_layer():
+    tempdir = tempfile.mkdtemp()
+    close = TESTDATA['2010-01-01':'2013-03-31']
+    closed, rows = prov.split_month(close, '2013-02-28')
+    assert closed.index[-1] <= pd.Timestamp('2013-02-28') and rows.index[0] > pd.Timestamp('2013-02-28')
+
+    closed.to_csv(path.join(tempdir, 'Close.csv'))
+    tail = prov.read_tail(path.join(tempdir, 'Close.csv'), 300, 'Close', blocksize = 1000)
+    assert tail.index.equals(closed.index[-300:])
+    assert np.allclose(tail.values, closed.values[-300:].astype(np.float32), equal_nan = True)
+
+    # a day that is downloaded again is updated
+    first = prov.merge_days(None, rows.iloc[:10])
+    revised = rows.iloc[9:15] + 1
+    merged = prov.merge_days(first, revised)
+    assert merged.index.equals(rows.index[:15])
+    assert np.allclose(merged.values, pd.concat([rows.iloc[:9], revised]).values, equal_nan = True)
+
+    extended = prov.extend(closed, merged)
+    assert extended.index.equals(closed.index.append(merged.index))
+
+    # the provisional rows are dropped once the month is in the master data
+    assert len(prov.prune(merged, '2013-03-31').index) == 0
+    assert prov.prune(merged, '2013-02-28').index.equals(merged.index)
+
+def test_provisional_derived(monkeypatch):
+    dodo = pytest.importorskip('dodo')
+    master, provisional = tempfile.mkdtemp(), tempfile.mkdtemp()
+
+    # a business day grid with a holiday every 25 rows
+    close = TESTDATA['2010-01-01':'2013-03-31'].reindex(pd.bdate_range('2010-01-01', '2013-03-31')).astype('float32')
+    close.iloc[::25] = np.nan
+    closed, rows = prov.split_month(close, '2013-02-28')
+    closed.to_csv(path.join(master, 'Close.csv'))
+    rows.to_csv(path.join(provisional, 'Close.csv'))
+
+    monkeypatch.setattr(dodo, 'MASTER_DATA_PATH', master)
+    monkeypatch.setattr(dodo, 'PROVISIONAL_PATH', provisional)
+    targets = [path.join(provisional, n + '.csv') for n in dodo.provisional_outputs]
+    dodo.provisional_derived([], targets)
+
+    # the provisional days get the same outputs as a full recompute, also the 252 trading day windows
+    full = dodo.close_derived_frames(close, close * np.nan)
+    for name, target in zip(dodo.provisional_outputs, targets):
+        if name not in full:
+            continue
+
+        if name == 'Daily-Momentum':
+            out = pd.concat(load_signals(provisional, name), axis = 1)
+        else:
+            out = pd.read_csv(target, header = 0, index_col = 0, parse_dates = True)
+        expected = full[name].loc[rows.index]
+        assert out.index.equals(rows.index)
+        assert expected.notnull().values.any()
+        assert np.allclose(out.values, expected.values, equal_nan = True)
+
+def test_merge_new_field(monkeypatch):
+    dodo = pytest.importorskip('dodo')
+    master, converted, merged = tempfile.mkdtemp(), tempfile.mkdtemp(), tempfile.mkdtemp()
+    field = 'Number Of Trades'
+    new = (TESTDATA['2015-01-01':'2015-06-30'] / 100).round()
+    new.to_csv(path.join(converted, field + '.csv'))
+
+    monkeypatch.setattr(dodo, 'fields', [field])
+    monkeypatch.setattr(dodo, 'mergein_old', master)
+    monkeypatch.setattr(dodo, 'mergein_new', converted)
+    monkeypatch.setattr(dodo, 'CONVERT_PATH', converted)
+    monkeypatch.setattr(dodo, 'MERGED_PATH', merged)
+    monkeypatch.setattr(dodo, 'get_all_equities', lambda: list(TESTDATA.columns))
+
+    # the ids come from the symbol table of the master data, new tickers get the next ids
+    symbols.SymbolTable(['SOL', 'XYZ']).to_csv(path.join(master, symbols.SYMBOLS_FILE))
+    assert list(dodo.symbol_table().ids(['SOL', 'XYZ', 'AGL', 'SAB'])) == [0, 1, 2, 3]
+
+    # a new download has no master file to depend on or merge with
+    task = next(dodo.task_merge())
+    assert task['file_dep'] == [path.join(converted, field + '.csv')]
+
+    class Task(object):
+        name = 'merge:' + field
+        targets = [path.join(merged, field + '.csv')]
+
+    for limit in [0, 1]:
+        monkeypatch.setattr(dodo, 'MEMORY_LIMIT', limit)
+        dodo.merge_data(Task())
+        data = load_market_data(merged, field)
+        assert np.allclose(data.loc[new.index, new.columns].astype(float).values, new.values, equal_nan = True)
+        assert data[:'2014-12-31'].isnull().values.all()
+
+def test_quality_scan():
+    close = TESTDATA['2010-01-01':'2013-03-31'].copy()
+    context, new = close[:'2012-12-31'], close['2013-01-01':].copy()
+
+    new.iloc[3, 0] = 0
+    new.iloc[5, 1] = new.iloc[4, 1] / 100
+    new.iloc[10, 2] = new.iloc[9, 2] * 3
+
+    report = quality.scan_field(new, 'Close', context)
+    found = set(zip(report['date'], report['ticker'], report['check']))
+    assert (new.index[3], new.columns[0], 'zero') in found
+    assert (new.index[5], new.columns[1], 'scale') in found
+    assert (new.index[10], new.columns[2], 'jump') in found
+    # the move back is also reported, nothing else is
+    assert len(report.index) == 5
+
+    volume = (new * 0 + 1000).fillna(0)
+    volume.iloc[2, 1] = -5
+    assert list(quality.scan_field(volume, 'Volume')['check']) == ['negative']
+    assert len(quality.scan_field(new, 'PE').index) == 0
+
+    shares = new * 0 + 1e6
+    mcap = new.replace(0, np.nan) * shares / 1e8
+    mcap.iloc[7, 2] *= 3
+    report = quality.scan_market_cap(new.replace(0, np.nan), shares, mcap)
+    assert list(zip(report['date'], report['ticker'])) == [(new.index[7], new.columns[2])]